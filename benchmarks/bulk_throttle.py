@@ -0,0 +1,107 @@
+"""
+Sends synthetic bulk requests with BulkSender to fake_bulk_server.py, to see how the throttling reacts to an
+overloaded cluster. Prints the throughput, the rejections and how the concurrency and request size were adapted.
+
+python benchmarks/bulk_throttle.py [--actions 200000] [--capacity 2] [--reject-rate 0.01] [--max-concurrency 8]
+"""
+
+import argparse
+import os
+import queue
+import sys
+import tempfile
+import threading
+import time
+
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fake_bulk_server  # noqa: E402
+
+
+def get_actions(num_actions, doc_size):
+    text = "x" * doc_size
+    for i in range(num_actions):
+        yield {"_index": "benchmark", "_source": {"doc_id": i, "text": text}}
+
+
+def run(args, work_dir):
+    config_path = os.path.join(work_dir, "config.yaml")
+    os.makedirs(os.path.join(work_dir, "settings", "corpora"))
+    with open(config_path, "w") as fp:
+        yaml.dump(
+            {
+                "elastic_hosts": [{"host": "127.0.0.1", "port": args.port, "scheme": "http"}],
+                "base_dir": work_dir,
+                "settings_dir": os.path.join(work_dir, "settings"),
+                "bulk_concurrency": args.concurrency,
+                "bulk_max_concurrency": args.max_concurrency,
+                "bulk_max_bytes": args.max_bytes,
+                "bulk_min_bytes": args.max_bytes // 8,
+                "bulk_target_latency": args.target_latency,
+                "bulk_backoff": 0.05,
+                "bulk_backoff_max": 1,
+                "bulk_poll_thread_pool": args.poll,
+            },
+            fp,
+        )
+    sys.argv += ["--config", config_path]
+
+    import strixpipeline.bulk as bulk
+
+    server, cluster = fake_bulk_server.start(
+        args.port, capacity=args.capacity, latency=args.latency, reject_rate=args.reject_rate
+    )
+    send_queue = queue.Queue(maxsize=16)
+    sender = bulk.BulkSender(send_queue)
+    sender.start()
+
+    timeline = []
+
+    def sample():
+        while sender.thread.is_alive():
+            timeline.append((sender.throttle.concurrency, sender.throttle.max_bytes.value, sender.in_flight))
+            time.sleep(0.1)
+
+    threading.Thread(target=sample, daemon=True).start()
+    t = time.time()
+    bulk.put_batches(
+        send_queue, "benchmark", get_actions(args.actions, args.doc_size), max_bytes=sender.throttle.max_bytes
+    )
+    sender.stop()
+    elapsed = time.time() - t
+    server.shutdown()
+
+    failed = sum(len(error.errors) for errors in sender.errors.values() for error in errors if hasattr(error, "errors"))
+    print(
+        f"{sender.sent_actions} of {args.actions} actions indexed in {elapsed:.1f}s ({sender.sent_actions / elapsed:.0f}/s)"
+    )
+    print(f"{sender.rejections} rejections, {sender.retries} retries, {failed} failed")
+    print(f"{sender.throttle.decreases} decreases, ended at {sender.throttle.concurrency} concurrent requests")
+    print(f"fake cluster: {cluster.stats}")
+    if timeline:
+        concurrency = [c for c, _, _ in timeline]
+        in_flight = [n for _, _, n in timeline]
+        max_bytes = [b for _, b, _ in timeline]
+        print(f"concurrency limit: min {min(concurrency)}, mean {sum(concurrency) / len(concurrency):.1f}")
+        print(f"requests in flight: max {max(in_flight)}, mean {sum(in_flight) / len(in_flight):.1f}")
+        print(f"request size limit: min {min(max_bytes) / 1e6:.1f} MB, max {max(max_bytes) / 1e6:.1f} MB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run BulkSender against a fake overloaded cluster.")
+    parser.add_argument("--port", type=int, default=9250)
+    parser.add_argument("--actions", type=int, default=200000)
+    parser.add_argument("--doc-size", type=int, default=200, help="Bytes of text per document")
+    parser.add_argument("--capacity", type=int, default=2, help="Concurrent requests the fake cluster handles")
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds per request of the fake cluster")
+    parser.add_argument("--reject-rate", type=float, default=0.0, help="Share of the items rejected at random")
+    parser.add_argument("--concurrency", type=int, default=4, help="bulk_concurrency")
+    parser.add_argument("--max-concurrency", type=int, default=8, help="bulk_max_concurrency")
+    parser.add_argument("--max-bytes", type=int, default=2 * 1024 * 1024, help="bulk_max_bytes")
+    parser.add_argument("--target-latency", type=float, default=1.0, help="bulk_target_latency")
+    parser.add_argument("--poll", type=float, default=0, help="bulk_poll_thread_pool")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        run(args, work_dir)
@@ -0,0 +1,179 @@
+"""
+A local stand-in for the bulk endpoint of Elasticsearch, for testing how the pipeline reacts to an overloaded
+cluster. Up to --capacity concurrent bulk requests are answered after --latency seconds. Each request over the
+capacity adds --latency to the response time and gets that share of its items rejected with 429. On top of that,
+--reject-rate of all items are rejected at random. /_cat/thread_pool/write reports the requests over the capacity
+as the write queue. _delete_by_query requests are answered as if nothing matched.
+
+python benchmarks/fake_bulk_server.py [--port 9250] [--capacity 4] [--latency 0.05] [--reject-rate 0]
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeCluster:
+    """
+    :param record_items: keep (_id, status) of every item that is answered in `items`, for tests
+    Items with an _id in `refused_ids` are answered with 400, like documents that do not match the mapping.
+    The (index, query) of each _delete_by_query request is kept in `delete_queries`.
+    """
+
+    def __init__(self, capacity=4, latency=0.05, reject_rate=0.0, seed=1, record_items=False):
+        self.capacity = capacity
+        self.latency = latency
+        self.reject_rate = reject_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.active = 0
+        self.stats = {"requests": 0, "items": 0, "indexed": 0, "rejected": 0, "max_active": 0}
+        self.record_items = record_items
+        self.items = []
+        self.refused_ids = set()
+        # the number of following bulk requests that are rejected as a whole with 429
+        self.rejected_requests = 0
+        self.delete_queries = []
+
+    def bulk(self, body):
+        with self.lock:
+            if self.rejected_requests:
+                self.rejected_requests -= 1
+                self.stats["requests"] += 1
+                return None
+            self.active += 1
+            active = self.active
+            self.stats["max_active"] = max(self.stats["max_active"], active)
+        try:
+            overload = max(0, active - self.capacity)
+            time.sleep(self.latency * (1 + overload))
+            reject_share = overload / active + self.reject_rate
+
+            lines = [json.loads(line) for line in body.split(b"\n") if line]
+            items = []
+            i = 0
+            while i < len(lines):
+                op_type = next(iter(lines[i]))
+                with self.lock:
+                    rejected = self.random.random() < reject_share
+                _id = lines[i][op_type].get("_id")
+                if _id in self.refused_ids:
+                    status = 400
+                    error = {"type": "mapper_parsing_exception", "reason": "failed to parse"}
+                    items.append({op_type: {"status": status, "error": error}})
+                elif rejected:
+                    status = 429
+                    error = {"type": "es_rejected_execution_exception", "reason": "rejected execution"}
+                    items.append({op_type: {"status": status, "error": error}})
+                else:
+                    status = 201
+                    items.append({op_type: {"status": status, "result": "created"}})
+                if self.record_items:
+                    with self.lock:
+                        self.items.append((_id, status))
+                i += 1 if op_type == "delete" else 2
+
+            statuses = [next(iter(item.values()))["status"] for item in items]
+            num_rejected = statuses.count(429)
+            num_indexed = statuses.count(201)
+            with self.lock:
+                self.stats["requests"] += 1
+                self.stats["items"] += len(items)
+                self.stats["rejected"] += num_rejected
+                self.stats["indexed"] += num_indexed
+            return {"took": 1, "errors": num_indexed < len(items), "items": items}
+        finally:
+            with self.lock:
+                self.active -= 1
+
+    def delete_by_query(self, index, body):
+        with self.lock:
+            self.delete_queries.append((index, json.loads(body)["query"]))
+        return {"took": 1, "timed_out": False, "total": 0, "deleted": 0, "failures": []}
+
+    def thread_pool(self):
+        with self.lock:
+            queue = max(0, self.active - self.capacity)
+            return [{"node_name": "fake", "queue": str(queue), "rejected": str(self.stats["rejected"])}]
+
+
+def get_handler(cluster, keep_alive=True):
+    """
+    :param keep_alive: keep connections open between requests, without it each response closes its connection so
+                       that no client keeps talking to the handler threads of a server that has been shut down
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def reply(self, obj, status=200):
+            body = json.dumps(obj).encode("utf-8")
+            self.send_response(status)
+            # checked by the Elasticsearch client
+            self.send_header("X-Elastic-Product", "Elasticsearch")
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            if not keep_alive:
+                self.send_header("Connection", "close")
+                self.close_connection = True
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path.startswith("/_cat/thread_pool"):
+                self.reply(cluster.thread_pool())
+            elif self.path.startswith("/_fake/stats"):
+                self.reply(cluster.stats)
+            else:
+                self.reply({"version": {"number": "8.15.1"}, "tagline": "You Know, for Search"})
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if "/_bulk" in self.path:
+                response = cluster.bulk(body)
+                if response is None:
+                    error = {"type": "es_rejected_execution_exception", "reason": "rejected execution"}
+                    self.reply({"error": error, "status": 429}, status=429)
+                else:
+                    self.reply(response)
+            elif "/_delete_by_query" in self.path:
+                index = urllib.parse.unquote(self.path.split("/")[1])
+                self.reply(cluster.delete_by_query(index, body))
+            else:
+                self.reply({})
+
+        do_PUT = do_POST
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def start(port=9250, keep_alive=True, **cluster_args):
+    """
+    start the server in a daemon thread
+    :param keep_alive: see get_handler
+    :return: the server and the FakeCluster, see FakeCluster.stats for what it has received
+    """
+    cluster = FakeCluster(**cluster_args)
+    server = ThreadingHTTPServer(("127.0.0.1", port), get_handler(cluster, keep_alive))
+    threading.Thread(target=server.serve_forever, name="fake-bulk-server", daemon=True).start()
+    return server, cluster
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a fake Elasticsearch bulk endpoint.")
+    parser.add_argument("--port", type=int, default=9250)
+    parser.add_argument("--capacity", type=int, default=4, help="Concurrent requests handled without pressure")
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds per request")
+    parser.add_argument("--reject-rate", type=float, default=0.0, help="Share of the items rejected at random")
+    args = parser.parse_args()
+
+    cluster = FakeCluster(capacity=args.capacity, latency=args.latency, reject_rate=args.reject_rate)
+    print(f"Listening on http://127.0.0.1:{args.port}")
+    ThreadingHTTPServer(("127.0.0.1", args.port), get_handler(cluster)).serve_forever()
@@ -0,0 +1,209 @@
+"""
+Times and memory-profiles the hot paths of the pipeline on a synthetic Sparv corpus (see sparv_generator.py) and
+writes the results as JSON. Nothing is sent to Elasticsearch.
+
+python benchmarks/run_benchmarks.py [--docs 50] [--tokens 2000] [--output results.json] [--compare baseline.json]
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import sparv_generator  # noqa: E402
+
+
+class InlineCorpusConfig:
+    """
+    The generated corpus configuration has all attributes inlined, so the settings repository is not needed
+    """
+
+    def __init__(self, corpus_conf):
+        self.corpus_conf = corpus_conf
+
+    def get_corpus_conf(self, corpus_id):
+        return self.corpus_conf
+
+    def is_corpus(self, corpus_id):
+        return corpus_id == self.corpus_conf["corpus_id"]
+
+
+def measure(fn, repeat):
+    """
+    run fn repeat times for the timings and once more with tracemalloc for the peak memory
+    :return: dict with the timings, the peak memory and the number of items that fn returned
+    """
+    timings = []
+    items = None
+    for _ in range(repeat):
+        t = time.perf_counter()
+        items = fn()
+        timings.append(time.perf_counter() - t)
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "seconds": timings,
+        "min": min(timings),
+        "median": statistics.median(timings),
+        "peak_mb": peak / 1e6,
+        "items": items,
+    }
+
+
+def get_git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(__file__)).decode().strip()
+    except Exception:
+        return None
+
+
+def run(args, work_dir):
+    corpus_id = "benchmark"
+    generator_args = {"docs": args.docs, "tokens": args.tokens, "seed": args.seed}
+    xml_path = sparv_generator.create_corpus(work_dir, corpus_id, **generator_args)
+    config_path = os.path.join(work_dir, "config.yaml")
+    with open(config_path, "w") as fp:
+        yaml.dump(
+            {
+                "elastic_hosts": [{"host": "localhost", "port": 9200, "scheme": "http"}],
+                "base_dir": work_dir,
+                "texts_dir": os.path.join(work_dir, "texts"),
+                "settings_dir": os.path.join(work_dir, "settings"),
+                "transformers_postprocess_dir": os.path.join(work_dir, "transformers"),
+            },
+            fp,
+        )
+    sys.argv += ["--config", config_path]
+
+    from strixpipeline.config import config
+    from strixpipeline import xmlparser
+    import strixpipeline.bulk as bulk
+    import strixpipeline.insertdata as insertdata
+    import strixpipeline.vectorgen as vectorgen
+    import strixpipeline.vectorstore as vectorstore
+
+    config.set_attr("corpusconf", InlineCorpusConfig(sparv_generator.get_corpus_config(corpus_id)))
+    insert_data = insertdata.InsertData(corpus_id)
+    plan = insert_data.parse_plan
+
+    # vectors for process_work
+    texts = list(xmlparser.parse_dump_xml(xml_path, "text", text_attributes={"_id": {}}, text_tags=["text"]))
+    doc_ids = [text["text_attributes"]["_id"] for text in texts]
+    generator = vectorgen.HashingVectorGenerator()
+    vectorstore.write_vectors(corpus_id, corpus_id, doc_ids, generator.encode([" ".join(t["dump"]) for t in texts]))
+
+    results = {}
+
+    def count(iterable):
+        return sum(1 for _ in iterable)
+
+    for backend in xmlparser.PARSER_BACKENDS:
+        if backend == "lxml":
+            try:
+                import lxml  # noqa: F401
+            except ImportError:
+                continue
+        results[f"parse_pipeline_xml[{backend}]"] = measure(
+            lambda: count(xmlparser.parse_with_plan(xml_path, plan, backend=backend)), args.repeat
+        )
+        results[f"parse_dump_xml[{backend}]"] = measure(
+            lambda: count(
+                xmlparser.parse_dump_xml(
+                    xml_path, "text", text_attributes={"_id": {}}, text_tags=["text"], backend=backend
+                )
+            ),
+            args.repeat,
+        )
+
+    task = {"text": xml_path}
+    results["process_work"] = measure(lambda: count(insert_data.process_work(corpus_id, task)), args.repeat)
+
+    docs = list(xmlparser.parse_with_plan(xml_path, plan, backend="expat"))
+    for term_storage in ("token", "sentence", "window"):
+        config.set_attr("term_storage", term_storage)
+        results[f"create_term_positions[{term_storage}]"] = measure(
+            lambda: sum(
+                count(
+                    insert_data.create_term_positions(
+                        doc["text_attributes"]["_id"],
+                        "x.xml",
+                        doc["token_lookup"],
+                        (corpus_id, "x.xml", n, doc["text_attributes"]["_id"]),
+                    )
+                )
+                for n, doc in enumerate(docs)
+            ),
+            args.repeat,
+        )
+    config.set_attr("term_storage", "token")
+
+    actions = list(insert_data.process_work(corpus_id, task))
+    results["serialize_bulk"] = measure(
+        lambda: sum(
+            num_actions
+            for _, num_actions in bulk.create_batches(actions, config.bulk_max_bytes, config.bulk_max_actions)
+        ),
+        args.repeat,
+    )
+
+    return {
+        "timestamp": datetime.datetime.now().isoformat(),
+        "git_commit": get_git_commit(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "corpus": dict(generator_args, file_size_mb=os.path.getsize(xml_path) / 1e6),
+        "repeat": args.repeat,
+        "results": results,
+    }
+
+
+def compare(report, baseline):
+    print(f"{'benchmark':40} {'median (s)':>12} {'baseline':>12} {'change':>8} {'peak MB':>10}")
+    for name, result in report["results"].items():
+        line = f"{name:40} {result['median']:12.3f}"
+        base = baseline["results"].get(name) if baseline else None
+        if base:
+            line += f" {base['median']:12.3f} {result['median'] / base['median'] - 1:+8.1%}"
+        else:
+            line += f" {'':12} {'':8}"
+        print(line + f" {result['peak_mb']:10.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the pipeline benchmarks.")
+    parser.add_argument("--docs", type=int, default=50, help="Documents in the synthetic corpus")
+    parser.add_argument("--tokens", type=int, default=2000, help="Tokens per document")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=3, help="Timed runs per benchmark")
+    parser.add_argument("--output", help="Write results to this file (default benchmarks/results/<timestamp>.json)")
+    parser.add_argument("--compare", help="Results from an earlier run to compare with")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        report = run(args, work_dir)
+
+    output = args.output or os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "results", time.strftime("%Y%m%d-%H%M%S") + ".json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as fp:
+        json.dump(report, fp, indent=2)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)
+    compare(report, baseline)
+    print(f"Results written to {output}")
@@ -0,0 +1,213 @@
+"""
+Generates synthetic Sparv export XML together with a matching Strix corpus configuration, for benchmarking.
+
+python benchmarks/sparv_generator.py <out_dir> [--docs 100] [--tokens 2000] ...
+
+writes <out_dir>/texts/<corpus>/<corpus>.xml and <out_dir>/settings/corpora/<corpus>.yaml
+"""
+
+import argparse
+import os
+import random
+from xml.sax.saxutils import escape, quoteattr
+
+import yaml
+
+POS_TAGS = ["NN", "VB", "PM", "JJ", "AB", "PP", "KN", "DT", "PN", "MAD", "MID", "PAD"]
+NE_TYPES = ["LOC", "PRS", "ORG", "EVN", "WRK", "OBJ", "MSR", "TME"]
+PLACES = ["Göteborg", "Stockholm", "Malmö", "Uppsala", "Lund", "Kiruna"]
+TAILS = ["\\s", "\\s", "\\s", "\\s", "", "\\n", "\\s\\n", "\\n\\n"]
+
+
+def get_corpus_config(corpus_id):
+    """
+    corpus configuration in the format created by sparv_decoder, with all attributes inlined
+    """
+    return {
+        "corpus_id": corpus_id,
+        "mode_id": "modern",
+        "title": "title",
+        "document_id": "_id",
+        "split": "text",
+        "text_tags": ["text"],
+        "analyze_config": {
+            "word_attributes": [
+                {"pos": {"name": "pos", "pos_index": True}},
+                {"msd": {"name": "msd"}},
+                {"lemma": {"name": "lemma", "set": True, "pos_index": True}},
+                {"lemgram": {"name": "lemgram", "nodeName": "lex", "set": True}},
+                {"sense": {"name": "sense", "set": True, "ranked": True}},
+                {"ref": {"name": "ref"}},
+                {"dephead": {"name": "dephead"}},
+                {"deprel": {"name": "deprel"}},
+            ],
+            "struct_attributes": {
+                "sentence": [{"sentence_id": {"name": "id"}}, {"sentence__geocontext": {"name": "_geocontext"}}],
+                "ne": [{"ne_name": {"name": "name"}}, {"ne_type": {"name": "type", "pos_index": True}}],
+                "paragraph": [],
+            },
+            "text_attributes": [
+                {"title": {"name": "title"}},
+                {"_id": {"name": "_id"}},
+                {"datefrom": {"name": "datefrom", "type": "date"}},
+                {"dateto": {"name": "dateto", "type": "date"}},
+                {"genre": {"name": "genre", "set": True}},
+            ],
+        },
+    }
+
+
+class SparvGenerator:
+    """
+    :param vocabulary_size: number of distinct word forms, the word frequencies follow Zipf's law
+    :param lemma_cardinality: maximum number of lemmas and lemgrams of a token
+    :param sentence_length: mean number of tokens in a sentence
+    :param paragraph_length: mean number of sentences in a paragraph
+    :param ne_rate: probability that a token starts a named entity
+    """
+
+    def __init__(
+        self,
+        docs=100,
+        tokens=2000,
+        vocabulary_size=20000,
+        lemma_cardinality=3,
+        sentence_length=15,
+        paragraph_length=5,
+        ne_rate=0.03,
+        seed=1,
+    ):
+        self.docs = docs
+        self.tokens = tokens
+        self.lemma_cardinality = lemma_cardinality
+        self.sentence_length = sentence_length
+        self.paragraph_length = paragraph_length
+        self.ne_rate = ne_rate
+        self.random = random.Random(seed)
+
+        self.vocabulary = [self.random_word() for _ in range(vocabulary_size)]
+        weights = [1 / rank for rank in range(1, vocabulary_size + 1)]
+        self.cumulative_weights = []
+        total = 0
+        for weight in weights:
+            total += weight
+            self.cumulative_weights.append(total)
+
+    def random_word(self):
+        length = self.random.randint(1, 12)
+        return "".join(self.random.choice("abcdefghijklmnoprstuvåäö") for _ in range(length))
+
+    def get_word(self):
+        return self.random.choices(self.vocabulary, cum_weights=self.cumulative_weights)[0]
+
+    def get_set(self, values):
+        return "|" + "".join(value + "|" for value in values)
+
+    def get_token(self, word, position, sentence_start):
+        pos = self.random.choice(POS_TAGS)
+        num_lemmas = self.random.randint(0, self.lemma_cardinality)
+        lemmas = [word] + [self.get_word() for _ in range(num_lemmas - 1)] if num_lemmas else []
+        lemgrams = [f"{lemma}..{pos.lower()}.{i + 1}" for i, lemma in enumerate(lemmas)]
+        senses = [f"{lemgram[:-2]}.{i + 1}:{0.9 / (i + 1):.3f}" for i, lemgram in enumerate(lemgrams)]
+        attrs = {
+            "pos": pos,
+            "msd": f"{pos}.UTR.SIN.IND.NOM",
+            "lemma": self.get_set(lemmas),
+            "lex": self.get_set(lemgrams),
+            "sense": self.get_set(senses),
+            "ref": str(position - sentence_start + 1),
+            "dephead": str(sentence_start + self.random.randint(1, self.sentence_length)),
+            "deprel": self.random.choice(["SS", "OO", "AT", "ET", "RA", "IP"]),
+            "_tail": self.random.choice(TAILS),
+        }
+        attr_str = " ".join(f"{name}={quoteattr(value)}" for name, value in attrs.items())
+        return f"<token {attr_str}>{escape(word)}</token>\n"
+
+    def get_text(self, doc_index):
+        attrs = {
+            "title": f"Text {doc_index}",
+            "_id": f"text{doc_index}",
+            "datefrom": f"{self.random.randint(1900, 2024)}0101",
+            "dateto": f"{self.random.randint(1900, 2024)}1231",
+            "genre": self.get_set(self.random.sample(["blogg", "nyheter", "roman", "debatt"], 2)),
+        }
+        out = ["<text " + " ".join(f"{name}={quoteattr(value)}" for name, value in attrs.items()) + ">\n"]
+        position = 0
+        sentence_count = 0
+        while position < self.tokens:
+            out.append("<paragraph>\n")
+            for _ in range(max(1, int(self.random.expovariate(1 / self.paragraph_length)))):
+                places = self.get_set(self.random.sample(PLACES, self.random.randint(0, 2)))
+                out.append(f'<sentence id="s{doc_index}-{sentence_count}" _geocontext={quoteattr(places)}>\n')
+                sentence_count += 1
+                sentence_start = position
+                ne_left = 0
+                for _ in range(max(1, int(self.random.gauss(self.sentence_length, self.sentence_length / 3)))):
+                    if not ne_left and self.random.random() < self.ne_rate:
+                        ne_left = self.random.randint(1, 3)
+                        name = self.random.choice(PLACES)
+                        out.append(f'<ne name="{name}" type="{self.random.choice(NE_TYPES)}" ex="ENAMEX">\n')
+                    out.append(self.get_token(self.get_word(), position, sentence_start))
+                    position += 1
+                    if ne_left:
+                        ne_left -= 1
+                        if not ne_left:
+                            out.append("</ne>\n")
+                if ne_left:
+                    out.append("</ne>\n")
+                out.append("</sentence>\n")
+            out.append("</paragraph>\n")
+        out.append("</text>\n")
+        return "".join(out)
+
+    def write(self, path, corpus_id):
+        with open(path, "w") as fp:
+            fp.write(f'<?xml version="1.0" encoding="UTF-8"?>\n<corpus id="{corpus_id}">\n')
+            for doc_index in range(self.docs):
+                fp.write(self.get_text(doc_index))
+            fp.write("</corpus>\n")
+
+
+def create_corpus(out_dir, corpus_id="benchmark", **generator_args):
+    """
+    :return: path to the generated XML file
+    """
+    texts_dir = os.path.join(out_dir, "texts", corpus_id)
+    corpora_dir = os.path.join(out_dir, "settings", "corpora")
+    os.makedirs(texts_dir, exist_ok=True)
+    os.makedirs(corpora_dir, exist_ok=True)
+    with open(os.path.join(corpora_dir, f"{corpus_id}.yaml"), "w") as fp:
+        yaml.dump(get_corpus_config(corpus_id), fp, sort_keys=False, allow_unicode=True)
+    xml_path = os.path.join(texts_dir, f"{corpus_id}.xml")
+    SparvGenerator(**generator_args).write(xml_path, corpus_id)
+    return xml_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic Sparv corpus.")
+    parser.add_argument("out_dir")
+    parser.add_argument("--corpus-id", default="benchmark")
+    parser.add_argument("--docs", type=int, default=100, help="Number of documents")
+    parser.add_argument("--tokens", type=int, default=2000, help="Tokens per document")
+    parser.add_argument("--vocabulary-size", type=int, default=20000)
+    parser.add_argument("--lemma-cardinality", type=int, default=3, help="Maximum number of lemmas per token")
+    parser.add_argument("--sentence-length", type=int, default=15, help="Mean tokens per sentence")
+    parser.add_argument("--paragraph-length", type=int, default=5, help="Mean sentences per paragraph")
+    parser.add_argument("--ne-rate", type=float, default=0.03, help="Probability of a named entity per token")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    print(
+        create_corpus(
+            args.out_dir,
+            args.corpus_id,
+            docs=args.docs,
+            tokens=args.tokens,
+            vocabulary_size=args.vocabulary_size,
+            lemma_cardinality=args.lemma_cardinality,
+            sentence_length=args.sentence_length,
+            paragraph_length=args.paragraph_length,
+            ne_rate=args.ne_rate,
+            seed=args.seed,
+        )
+    )
@@ -1,4 +1,5 @@
 import logging
+import sys
 import strixpipeline.loghelper
 import strixpipeline.pipeline as pipeline
 import strixpipeline.createindex as createindex
@@ -13,6 +14,10 @@ if __name__ == "__main__":
     def do_add(args):
         corpus = args.corpus
 
+        if args.workers:
+            config.set_attr("max_workers", args.workers)
+            config.set_attr("max_tasks_in_flight", 2 * args.workers)
+
         # add config file
         sparv_decoder.main(corpus)
 
@@ -27,15 +32,26 @@ if __name__ == "__main__":
             if not pipeline.check_vectors_exist(corpus):
                 raise RuntimeError("Must generate vectors first or use --vector-generation-type local/remote")
 
-        # create new index
-        strixpipeline.loghelper.setup_pipeline_logging(f"{corpus}-reindex")
-        createindex.create_index(corpus, delete_previous=args.delete_previous_version)
+        if args.resume and pipeline.can_resume(corpus):
+            # continue an interrupted run, skipping the files that were done
+            strixpipeline.loghelper.setup_pipeline_logging(corpus + "-resume")
+            failed_files = pipeline.do_run(corpus, resume=True)
+        elif args.incremental and pipeline.can_update_incrementally(corpus):
+            # only update the files that changed since last run
+            strixpipeline.loghelper.setup_pipeline_logging(corpus + "-update")
+            failed_files = pipeline.do_run(corpus, incremental=True)
+        else:
+            # create new index
+            strixpipeline.loghelper.setup_pipeline_logging(f"{corpus}-reindex")
+            createindex.create_index(corpus, delete_previous=args.delete_previous_version)
 
-        # run corpus
-        strixpipeline.loghelper.setup_pipeline_logging(corpus + "-run")
-        pipeline.do_run(corpus)
+            # run corpus
+            strixpipeline.loghelper.setup_pipeline_logging(corpus + "-run")
+            failed_files = pipeline.do_run(corpus)
 
-        pipeline.merge_indices(corpus)
+        if failed_files:
+            logger.error(f"{len(failed_files)} files could not be added, rerun with --resume to retry them")
+            sys.exit(1)
 
     def do_generate_vector_data(args):
         corpus = args.corpus
@@ -52,6 +68,28 @@ if __name__ == "__main__":
             # if corpus did not exist before generate vectors, remove it again
             pipeline.remove_config_file(corpus)
 
+    def do_replay_dead_letters(args):
+        if pipeline.replay_dead_letters(args.corpus, task_ids=args.task_id):
+            sys.exit(1)
+
+    def do_compare_runs(args):
+        comparison = pipeline.compare_runs(args.corpus, num_runs=args.runs, threshold=args.threshold)
+        if comparison is None:
+            print(f"No runs with metrics recorded for {args.corpus}")
+            return
+        print(f"Run {comparison['timestamp']} compared with {comparison['earlier']} earlier runs")
+        if not comparison["rows"]:
+            return
+        print(f"{'':24} {'latest':>14} {'median':>14} {'change':>8}")
+        for row in comparison["rows"]:
+            baseline = row["baseline"]
+            change = f"{row['value'] / baseline - 1:+8.1%}" if baseline else ""
+            print(f"{row['name']:24} {row['value']:14.4g} {baseline or 0:14.4g} {change:>8}  {row['unit']}".rstrip())
+        for name in comparison["regressions"]:
+            print(f"Regression: {name} dropped more than {args.threshold:.0%}")
+        if comparison["regressions"]:
+            sys.exit(1)
+
     def do_delete(args):
         corpus = args.corpus
         pipeline.do_delete(corpus)
@@ -68,9 +106,24 @@ if __name__ == "__main__":
     )
     add_parser.add_argument(
         "--vector-generation-type",
-        choices=["remote", "local", "none"],
+        choices=["remote", "local", "python", "none"],
         default="none",
-        help="Document vectors can be generated on config.vector_server, locally or not at all.",
+        help="Document vectors can be generated on config.vector_server, locally, in the pipeline process with config.vector_generator or not at all.",
+    )
+    add_parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only reindex files that were added, changed or removed since the last run. Falls back to creating a new index if the corpus configuration has changed or no previous run is recorded.",
+    )
+    add_parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue the last run of the corpus if it was interrupted or had failures, skipping the files that were already added. If there is nothing to resume, a new index is created, or the index is updated if --incremental is also given.",
+    )
+    add_parser.add_argument(
+        "--workers",
+        type=int,
+        help="Number of worker processes used for parsing and sending documents, overrides config.max_workers.",
     )
     add_parser.set_defaults(func=do_add)
 
@@ -81,6 +134,29 @@ if __name__ == "__main__":
     delete_parser.add_argument("corpus", help="Corpus to delete")
     delete_parser.set_defaults(func=do_delete)
 
+    replay_parser = subparsers.add_parser(
+        "replay-dead-letters",
+        help="Send the documents that could not be indexed in earlier runs again. Exits with 1 if some still fail.",
+    )
+    replay_parser.add_argument("corpus", help="Corpus to send documents for")
+    replay_parser.add_argument(
+        "--task-id",
+        action="append",
+        help="Only send the documents of this file (name without extension) or group of files, repeatable",
+    )
+    replay_parser.set_defaults(func=do_replay_dead_letters)
+
+    compare_runs_parser = subparsers.add_parser(
+        "compare-runs",
+        help="Compare the stage timings and throughput of the latest run of a corpus with earlier runs. Exits with 1 if the throughput dropped.",
+    )
+    compare_runs_parser.add_argument("corpus", help="Corpus to compare runs for")
+    compare_runs_parser.add_argument("--runs", type=int, default=5, help="Number of earlier runs to compare with")
+    compare_runs_parser.add_argument(
+        "--threshold", type=float, default=0.2, help="Relative throughput drop that counts as a regression"
+    )
+    compare_runs_parser.set_defaults(func=do_compare_runs)
+
     generate_vector_parser = subparsers.add_parser(
         "generate-vector-data",
         help="Either runs vector data generation locally or offloads vector creation to config.transformers_postprocess_server",
@@ -89,9 +165,9 @@ if __name__ == "__main__":
     # Same as for add_parser
     generate_vector_parser.add_argument(
         "--vector-generation-type",
-        choices=["remote", "local"],
+        choices=["remote", "local", "python"],
         default="local",
-        help="Document vectors can be generated on config.vector_server or locally",
+        help="Document vectors can be generated on config.vector_server, locally or in the pipeline process with config.vector_generator",
     )
     generate_vector_parser.set_defaults(func=do_generate_vector_data)
 
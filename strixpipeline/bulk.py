@@ -0,0 +1,351 @@
+"""
+Bulk requests sized by the serialized size of the actions. Documents can be large (whole books with `sent_vector`
+and `dump`) while term documents are small, so a fixed number of actions per request gives either very large or
+very small requests. Each action is serialized once and added to the current request until config.bulk_max_bytes
+or config.bulk_max_actions would be exceeded.
+
+The parse workers only serialize the batches to NDJSON bytes, which is all that is passed to the main process. They
+are sent as they are by a BulkSender in the main process so that the workers are not blocked by requests and the
+cluster gets a controlled number of concurrent requests, see Throttle.
+"""
+
+import asyncio
+import collections
+import logging
+import multiprocessing
+import random
+import threading
+import time
+
+import elasticsearch
+import orjson
+from elasticsearch.helpers import expand_action, BulkIndexError
+
+from strixpipeline.config import config
+import strixpipeline.metrics as metrics
+
+_logger = logging.getLogger(__name__)
+
+# vectors may be numpy arrays
+DUMPS_OPTIONS = orjson.OPT_SERIALIZE_NUMPY
+LINE_OPTIONS = DUMPS_OPTIONS | orjson.OPT_APPEND_NEWLINE
+
+
+def serialize_action(action):
+    """
+    :return: the NDJSON lines for an action in the format used by elasticsearch.helpers
+    """
+    header, body = expand_action(action)
+    lines = orjson.dumps(header, option=LINE_OPTIONS)
+    if body is not None:
+        lines += orjson.dumps(body, option=LINE_OPTIONS)
+    return lines
+
+
+def create_batches(actions, max_bytes, max_actions):
+    """
+    Group serialized actions into bulk request bodies. An action that is larger than max_bytes by itself is sent
+    in a request of its own.
+    :param max_bytes: an int, or the shared `Throttle.max_bytes` which is read again for each request
+    :return: generator of (body, number of actions), where body is the NDJSON bytes ready to be sent
+    """
+    get_max_bytes = (lambda: max_bytes.value) if hasattr(max_bytes, "value") else (lambda: max_bytes)
+    limit = get_max_bytes()
+    body = bytearray()
+    num_actions = 0
+    for action in actions:
+        lines = serialize_action(action)
+        if num_actions and (len(body) + len(lines) > limit or num_actions >= max_actions):
+            yield bytes(body), num_actions
+            body = bytearray()
+            num_actions = 0
+            limit = get_max_bytes()
+        body += lines
+        num_actions += 1
+    if num_actions:
+        yield bytes(body), num_actions
+
+
+def split_actions(body):
+    """
+    :return: the NDJSON lines of each action in a request body created by create_batches
+    """
+    lines = body.split(b"\n")[:-1]
+    actions = []
+    i = 0
+    while i < len(lines):
+        op_type = next(iter(orjson.loads(lines[i])))
+        num_lines = 1 if op_type == "delete" else 2
+        actions.append(b"".join(line + b"\n" for line in lines[i : i + num_lines]))
+        i += num_lines
+    return actions
+
+
+def get_failed_items(response):
+    """
+    :return: (position, status, item) for the failed items of a bulk response, where item is in the same format
+    as the errors of BulkIndexError from elasticsearch.helpers.streaming_bulk
+    """
+    failed = []
+    if response["errors"]:
+        for position, item in enumerate(response["items"]):
+            for op_type, result in item.items():
+                status = result.get("status", 500)
+                if not 200 <= status < 300:
+                    failed.append((position, status, {op_type: result}))
+    return failed
+
+
+class Throttle:
+    """
+    AIMD (additive increase, multiplicative decrease) control of the number of concurrent bulk requests and of the
+    size of the requests. Each request that is answered within config.bulk_target_latency increases the concurrency
+    by 1 / concurrency, so by one per round of requests, up to config.bulk_max_concurrency, and grows the request
+    size back towards config.bulk_max_bytes. Rejections (429), slow requests and a long write queue on the cluster
+    halve both, down to one request and config.bulk_min_bytes. Responses to requests that were sent before the last
+    decrease are from the same episode of pressure and do not decrease again.
+
+    max_bytes is shared with the parse workers, which read it for each request that they create.
+    """
+
+    def __init__(self, concurrency=None, max_concurrency=None, max_bytes=None):
+        self.max_concurrency = max_concurrency or config.bulk_max_concurrency
+        self.limit = float(min(concurrency or config.bulk_concurrency, self.max_concurrency))
+        self.ceiling_bytes = max_bytes or config.bulk_max_bytes
+        self.min_bytes = min(config.bulk_min_bytes, self.ceiling_bytes)
+        self.max_bytes = multiprocessing.Value("q", self.ceiling_bytes, lock=False)
+        self.target_latency = config.bulk_target_latency
+        self.last_decrease = None
+        self.decreases = 0
+
+    @property
+    def concurrency(self):
+        return int(self.limit)
+
+    def on_success(self, sent_at, latency):
+        if latency > self.target_latency:
+            self.decrease(sent_at, f"request took {latency:.1f}s")
+            return
+        self.limit = min(float(self.max_concurrency), self.limit + 1 / self.limit)
+        self.max_bytes.value = min(self.ceiling_bytes, self.max_bytes.value + self.ceiling_bytes // 16)
+
+    def decrease(self, sent_at, reason):
+        """
+        :param sent_at: time.monotonic() when the request that saw the pressure was sent, or now for pressure
+                        that is not related to a request
+        """
+        if self.last_decrease is not None and sent_at < self.last_decrease:
+            return
+        self.last_decrease = time.monotonic()
+        self.decreases += 1
+        self.limit = max(1.0, self.limit / 2)
+        self.max_bytes.value = max(self.min_bytes, self.max_bytes.value // 2)
+        _logger.info(
+            f"Throttling bulk requests ({reason}): {self.concurrency} concurrent, "
+            f"at most {self.max_bytes.value / 1024 / 1024:.1f} MiB"
+        )
+
+
+def get_backoff(attempt):
+    """
+    :return: seconds to wait before retry number attempt + 1, exponential with full jitter
+    """
+    return random.uniform(0, min(config.bulk_backoff_max, config.bulk_backoff * 2**attempt))
+
+
+class BulkSender:
+    """
+    Sends the batches that the parse workers put on `queue` from an event loop in a separate thread of the main
+    process, on one connection pool with the number of requests in flight controlled by a Throttle. Items that are
+    rejected with 429 are sent again after a jittered backoff, at most config.bulk_max_retries times. With
+    config.bulk_poll_thread_pool set, the write thread pool of the cluster is polled every that many seconds and
+    a queue longer than config.bulk_max_write_queue or new rejections throttle the requests.
+
+    Items on the queue are (task_id, body, number of actions), and None stops the sender once the pending
+    requests are done. The results per task_id are available in `counts`, `send_seconds` and `errors` after stop(),
+    `acked` has the number of actions per task_id that Elasticsearch has answered for good, indexed or failed. Items
+    that failed are written to `dead_letters` (a checkpoint.DeadLetters) if given.
+    The totals `sent_actions`, `sent_bytes`, `in_flight`, `rejections` and `retries` can be read while it is running.
+    """
+
+    def __init__(self, queue, concurrency=None, http_compress=None, throttle=None, dead_letters=None):
+        self.queue = queue
+        self.dead_letters = dead_letters
+        self.throttle = throttle or Throttle(concurrency=concurrency)
+        self.es = elasticsearch.AsyncElasticsearch(
+            config.elastic_hosts,
+            request_timeout=500,
+            retry_on_timeout=True,
+            # a rejected request (429) is retried by send() with a backoff and throttling, not right away
+            retry_on_status=(502, 503, 504),
+            connections_per_node=self.throttle.max_concurrency,
+            http_compress=config.http_compress if http_compress is None else http_compress,
+        )
+        self.counts = collections.Counter()
+        self.send_seconds = collections.Counter()
+        self.errors = collections.defaultdict(list)
+        self.acked = collections.Counter()
+        self.sent_actions = 0
+        self.sent_bytes = 0
+        self.in_flight = 0
+        self.rejections = 0
+        self.retries = 0
+        self.thread = None
+        self.slots = 0
+        self.condition = None
+
+    def start(self):
+        self.thread = threading.Thread(target=asyncio.run, args=(self.run(),), name="bulk-sender", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self.condition = asyncio.Condition()
+        pending = set()
+        poller = None
+        if config.bulk_poll_thread_pool:
+            poller = asyncio.create_task(self.poll_thread_pool(config.bulk_poll_thread_pool))
+        try:
+            while True:
+                # a slot is taken before the next batch is read, so that the workers wait while throttled
+                async with self.condition:
+                    await self.condition.wait_for(lambda: self.slots < self.throttle.concurrency)
+                    self.slots += 1
+                item = await loop.run_in_executor(None, self.queue.get)
+                if item is None:
+                    break
+                request = asyncio.create_task(self.send(*item))
+                pending.add(request)
+                request.add_done_callback(pending.discard)
+            if pending:
+                await asyncio.wait(pending)
+        finally:
+            if poller:
+                poller.cancel()
+            await self.es.close()
+
+    async def send(self, task_id, body, num_actions):
+        self.in_flight += 1
+        try:
+            for attempt in range(config.bulk_max_retries + 1):
+                can_retry = attempt < config.bulk_max_retries
+                sent_at = time.monotonic()
+                try:
+                    # bytes are passed on as they are by the NDJSON serializer
+                    response = await self.es.bulk(operations=body)
+                except elasticsearch.ApiError as e:
+                    if e.status_code != 429:
+                        raise
+                    self.rejections += num_actions
+                    self.throttle.decrease(sent_at, "bulk request rejected")
+                    if not can_retry:
+                        raise
+                    await self.retry(task_id, attempt, num_actions)
+                    continue
+
+                latency = time.monotonic() - sent_at
+                self.send_seconds[task_id] += latency
+                self.sent_bytes += len(body)
+                _logger.debug(f"Sent {num_actions} actions for {task_id}, took {latency:.2f}s")
+
+                failed = get_failed_items(response)
+                rejected = [position for position, status, _ in failed if status == 429]
+                errors = [
+                    (position, status, item) for position, status, item in failed if status != 429 or not can_retry
+                ]
+                if errors:
+                    self.errors[task_id].append(
+                        BulkIndexError(f"{len(errors)} document(s) failed to index.", [item for _, _, item in errors])
+                    )
+                    self.write_dead_letters(task_id, body, errors)
+                num_indexed = len(response["items"]) - len(failed)
+                self.counts[task_id] += num_indexed
+                self.acked[task_id] += num_indexed + len(errors)
+                self.sent_actions += num_indexed
+
+                if rejected:
+                    self.rejections += len(rejected)
+                    self.throttle.decrease(sent_at, f"{len(rejected)} items rejected")
+                else:
+                    self.throttle.on_success(sent_at, latency)
+                if not rejected or not can_retry:
+                    break
+                actions = split_actions(body)
+                body = b"".join(actions[position] for position in rejected)
+                num_actions = len(rejected)
+                await self.retry(task_id, attempt, num_actions)
+        except Exception as e:
+            _logger.error(f"Bulk request for {task_id} failed", exc_info=e)
+            self.errors[task_id].append(e)
+            self.acked[task_id] += num_actions
+            if self.dead_letters:
+                status = getattr(e, "status_code", None)
+                for action in split_actions(body):
+                    self.dead_letters.write(task_id, status, f"{type(e).__name__}: {e}", action)
+        finally:
+            self.in_flight -= 1
+            async with self.condition:
+                self.slots -= 1
+                self.condition.notify_all()
+
+    def write_dead_letters(self, task_id, body, errors):
+        if not self.dead_letters:
+            return
+        actions = split_actions(body)
+        for position, status, item in errors:
+            self.dead_letters.write(task_id, status, next(iter(item.values())).get("error"), actions[position])
+
+    async def retry(self, task_id, attempt, num_actions):
+        self.retries += 1
+        backoff = get_backoff(attempt)
+        _logger.debug(f"Retrying {num_actions} rejected actions for {task_id} in {backoff:.1f}s")
+        await asyncio.sleep(backoff)
+
+    async def poll_thread_pool(self, interval):
+        previous_rejected = None
+        while True:
+            # the pressure seen by a poll is from the interval since the previous poll
+            polled_at = time.monotonic()
+            await asyncio.sleep(interval)
+            try:
+                rows = await self.es.cat.thread_pool(
+                    thread_pool_patterns="write", format="json", h="node_name,queue,rejected"
+                )
+            except Exception as e:
+                _logger.debug(f"Could not poll the write thread pool ({type(e).__name__}: {e})")
+                continue
+            queue = max((int(row["queue"]) for row in rows), default=0)
+            rejected = sum(int(row["rejected"]) for row in rows)
+            if queue > config.bulk_max_write_queue:
+                self.throttle.decrease(polled_at, f"write queue is {queue}")
+            elif previous_rejected is not None and rejected > previous_rejected:
+                self.throttle.decrease(polled_at, f"{rejected - previous_rejected} writes rejected by cluster")
+            previous_rejected = rejected
+
+
+def put_batches(queue, task_id, actions, max_bytes=None, max_actions=None, timer=None):
+    """
+    Serialize actions and put them on the queue of a BulkSender, in requests of at most max_bytes / max_actions
+    :param max_bytes: see create_batches
+    :param timer: metrics.StageTimer, the time spent creating the actions is counted as "documents", serializing
+                  them as "serialize" and waiting for the sender as "queue_wait"
+    :return: number of actions
+    """
+    if timer is None:
+        timer = metrics.StageTimer()
+    if max_bytes is None:
+        max_bytes = config.bulk_max_bytes
+    max_actions = max_actions or config.bulk_max_actions
+    count = 0
+    batches = create_batches(timer.timed("documents", actions), max_bytes, max_actions)
+    for body, num_actions in timer.timed("serialize", batches):
+        with timer.stage("queue_wait"):
+            queue.put((task_id, body, num_actions))
+        count += num_actions
+        timer.counts["bulk_bytes"] += len(body)
+    timer.counts["actions"] += count
+    return count
@@ -0,0 +1,151 @@
+"""
+Recovery from runs that were interrupted or had failures.
+
+The journal is a JSON lines file <checkpoint_dir>/<corpus>.jsonl that records the files of a run whose documents
+have all been acknowledged by Elasticsearch. The first line describes the run:
+
+{"index": "<name of the index behind the corpus alias>", "config_hash": ..., "incremental": ..., "started": ...}
+{"file": "<original_file>", "hash": "<content hash from the manifest>"}
+...
+
+`add --resume` continues the run in the journal and skips the files that are in it with an unchanged hash. Since
+documents get deterministic ids, documents of a file that was only partly sent are overwritten when it is sent
+again. The journal is removed when a run finishes without failures.
+
+Bulk items that failed for good are appended to <checkpoint_dir>/<corpus>.dead.jsonl, one JSON object per item
+with the task_id, the name of the index of the run, status, error and the NDJSON lines of the action, so that they
+can be sent again with `replay-dead-letters` once the cause is fixed. The file is removed when a run that is not
+resumed starts, since that run sends the failed files again, and items for an index that is no longer behind the
+alias are not replayed.
+"""
+
+import datetime
+import json
+import os
+
+from strixpipeline.config import config
+
+
+def get_journal_path(corpus):
+    return os.path.join(config.checkpoint_dir, f"{corpus}.jsonl")
+
+
+def get_dead_letter_path(corpus):
+    return os.path.join(config.checkpoint_dir, f"{corpus}.dead.jsonl")
+
+
+def remove_dead_letters(corpus):
+    """
+    remove the dead-letter file of corpus and the file of an interrupted replay
+    :return: number of items that were removed
+    """
+    path = get_dead_letter_path(corpus)
+    count = 0
+    for dead_letter_path in (path, path + ".replay"):
+        if os.path.isfile(dead_letter_path):
+            with open(dead_letter_path) as fp:
+                count += sum(1 for _ in fp)
+            os.remove(dead_letter_path)
+    return count
+
+
+def load(corpus):
+    """
+    :return: the run described by the journal, with "files" as a dict of file name -> hash, or None if there is
+             no journal
+    """
+    try:
+        with open(get_journal_path(corpus)) as fp:
+            run = json.loads(fp.readline())
+            run["files"] = {}
+            for line in fp:
+                # the last line may be cut off if the run was killed while writing it
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    break
+                run["files"][entry["file"]] = entry["hash"]
+            return run
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def remove(corpus):
+    path = get_journal_path(corpus)
+    if os.path.isfile(path):
+        os.remove(path)
+
+
+def get_done_files(run, files):
+    """
+    :param files: the manifest entries of the files of the current run
+    :return: names of the files that the journal has with the same content
+    """
+    return {name for name, file_hash in run["files"].items() if name in files and files[name]["hash"] == file_hash}
+
+
+class Journal:
+    """
+    :param files: manifest entries of the files of the run, the hash of each file is recorded with it
+    """
+
+    def __init__(self, corpus, files):
+        self.path = get_journal_path(corpus)
+        self.files = files
+
+    def start(self, index_name, config_hash, incremental):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        run = {
+            "index": index_name,
+            "config_hash": config_hash,
+            "incremental": incremental,
+            "started": datetime.datetime.now().isoformat(),
+        }
+        with open(self.path, "w") as fp:
+            fp.write(json.dumps(run) + "\n")
+
+    def add(self, file_name):
+        with open(self.path, "a") as fp:
+            fp.write(json.dumps({"file": file_name, "hash": self.files[file_name]["hash"]}) + "\n")
+            fp.flush()
+            os.fsync(fp.fileno())
+
+
+class DeadLetters:
+    """
+    Appends failed bulk items to the dead-letter file of a corpus, used by BulkSender
+    :param index_name: the index behind the corpus alias that the items were sent to, recorded with each item
+    """
+
+    def __init__(self, corpus, index_name=None, path=None):
+        self.path = path or get_dead_letter_path(corpus)
+        self.index_name = index_name
+        self.count = 0
+
+    def write(self, task_id, status, error, lines):
+        """
+        :param lines: the NDJSON bytes of the action
+        """
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, "a") as fp:
+            entry = {
+                "task_id": task_id,
+                "index": self.index_name,
+                "status": status,
+                "error": error,
+                "lines": lines.decode("utf-8"),
+            }
+            fp.write(json.dumps(entry) + "\n")
+        self.count += 1
+
+
+def read_dead_letters(path, task_ids=None):
+    """
+    :param task_ids: only read the items of these tasks
+    :return: generator of the entries in a dead-letter file
+    """
+    with open(path) as fp:
+        for line in fp:
+            entry = json.loads(line)
+            if task_ids is None or entry["task_id"] in task_ids:
+                yield entry
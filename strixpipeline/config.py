@@ -2,6 +2,7 @@ import yaml
 import sys
 import os
 import logging
+import multiprocessing
 
 
 class StrixConfig:
@@ -35,6 +36,80 @@ class StrixConfig:
     def set_defaults(self):
         if "base_dir" not in self.config:
             self.config["base_dir"] = "."
+        if "manifest_dir" not in self.config:
+            self.config["manifest_dir"] = os.path.join(self.config["base_dir"], "manifests")
+        if "checkpoint_dir" not in self.config:
+            self.config["checkpoint_dir"] = os.path.join(self.config["base_dir"], "checkpoints")
+        if "xml_parser" not in self.config:
+            self.config["xml_parser"] = "etree"
+        if "decode_cache_size" not in self.config:
+            self.config["decode_cache_size"] = 65536
+        if "max_workers" not in self.config:
+            self.config["max_workers"] = min(multiprocessing.cpu_count(), 16)
+        if "max_tasks_in_flight" not in self.config:
+            self.config["max_tasks_in_flight"] = 2 * self.config["max_workers"]
+        if "task_order" not in self.config:
+            self.config["task_order"] = "size"
+        if "group_task_bytes" not in self.config:
+            self.config["group_task_bytes"] = 4 * 1024 * 1024
+        if "group_max_files" not in self.config:
+            self.config["group_max_files"] = 1000
+        if "split_file_bytes" not in self.config:
+            self.config["split_file_bytes"] = 256 * 1024 * 1024
+        if "split_range_bytes" not in self.config:
+            self.config["split_range_bytes"] = 32 * 1024 * 1024
+        if "split_index_dir" not in self.config:
+            self.config["split_index_dir"] = os.path.join(self.config["base_dir"], "split_indexes")
+        if "save_split_index" not in self.config:
+            self.config["save_split_index"] = True
+        if "bulk_max_bytes" not in self.config:
+            self.config["bulk_max_bytes"] = 10 * 1024 * 1024
+        if "bulk_max_actions" not in self.config:
+            self.config["bulk_max_actions"] = 10000
+        if "bulk_concurrency" not in self.config:
+            self.config["bulk_concurrency"] = 4
+        if "bulk_max_concurrency" not in self.config:
+            self.config["bulk_max_concurrency"] = self.config["bulk_concurrency"]
+        if "bulk_min_bytes" not in self.config:
+            self.config["bulk_min_bytes"] = 1024 * 1024
+        if "bulk_target_latency" not in self.config:
+            self.config["bulk_target_latency"] = 30
+        if "bulk_max_retries" not in self.config:
+            self.config["bulk_max_retries"] = 8
+        if "bulk_backoff" not in self.config:
+            self.config["bulk_backoff"] = 1
+        if "bulk_backoff_max" not in self.config:
+            self.config["bulk_backoff_max"] = 60
+        if "bulk_poll_thread_pool" not in self.config:
+            self.config["bulk_poll_thread_pool"] = 0
+        if "bulk_max_write_queue" not in self.config:
+            self.config["bulk_max_write_queue"] = 500
+        if "send_queue_size" not in self.config:
+            self.config["send_queue_size"] = 4 * self.config["bulk_concurrency"]
+        if "http_compress" not in self.config:
+            self.config["http_compress"] = False
+        if "progress_dir" not in self.config:
+            self.config["progress_dir"] = os.path.join(self.config["base_dir"], "progress")
+        if "progress_interval" not in self.config:
+            self.config["progress_interval"] = 10
+        if "metrics_port" not in self.config:
+            self.config["metrics_port"] = None
+        if "term_storage" not in self.config:
+            self.config["term_storage"] = "token"
+        if "term_window_size" not in self.config:
+            self.config["term_window_size"] = 256
+        if "vector_field" not in self.config:
+            self.config["vector_field"] = {}
+        if "vector_field_modes" not in self.config:
+            self.config["vector_field_modes"] = {}
+        if "vector_generator" not in self.config:
+            self.config["vector_generator"] = "hashing"
+        if "vector_generator_options" not in self.config:
+            self.config["vector_generator_options"] = {}
+        if "vector_batch_size" not in self.config:
+            self.config["vector_batch_size"] = 64
+        if "vector_threads" not in self.config:
+            self.config["vector_threads"] = 1
 
     def create_corpus_config(self):
         import strixconfigurer.corpusconf
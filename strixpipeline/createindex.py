@@ -13,10 +13,12 @@ from elasticsearch_dsl import (
     MetaField,
     InnerDoc,
     DenseVector,
+    IntegerRange,
 )
 import strixpipeline.mappingutil as mappingutil
 from strixpipeline.config import config
 import strixpipeline.elasticapi as elasticapi
+import strixpipeline.vectorstore as vectorstore
 import elasticsearch
 
 
@@ -97,6 +99,10 @@ class CreateIndex:
         return index, index_name
 
     def create_term_position_index(self, index_name):
+        if config.term_storage != "token":
+            self.create_packed_term_position_index(index_name)
+            return
+
         m = Mapping()
         m.meta("dynamic", "strict")
         m.meta("date_detection", False)
@@ -117,6 +123,22 @@ class CreateIndex:
 
         m.field("term", Object(dynamic=True, properties={"attrs": Object()}))
         m.field("doc_id", "keyword")
+        m.field("original_file", "keyword")
+        m.save(index_name, using=self.es)
+
+    def create_packed_term_position_index(self, index_name):
+        """
+        Terms are grouped in documents with the tokens as parallel arrays, see README.md. Only the positions
+        are searchable, the terms are fetched from _source.
+        """
+        m = Mapping()
+        m.meta("dynamic", "strict")
+        m.field("positions", IntegerRange())
+        m.field("start", "integer")
+        m.field("length", "integer")
+        m.field("terms", Object(DisabledObject))
+        m.field("doc_id", "keyword")
+        m.field("original_file", "keyword")
         m.save(index_name, using=self.es)
 
     @staticmethod
@@ -183,7 +205,7 @@ class CreateIndex:
         m.field("most_common_words", Text())
         m.field("ner_tags", Text())
         m.field("geo_location", Keyword(multi=True))
-        m.field("sent_vector", DenseVector(dims=768))
+        m.field("sent_vector", DenseVector(**vectorstore.get_dense_vector_options(self.alias)))
 
         # TODO: is the standard analyzer field used? otherwise move "analyzed" sub-field to top level
         title_field = Text(
@@ -1,24 +1,40 @@
-import json
+import base64
+import hashlib
 import os
 import logging
-import itertools
-import hashlib
-import time
 import uuid
 import glob
 import strixpipeline.xmlparser as xmlparser
+import strixpipeline.vectorstore as vectorstore
+import strixpipeline.metrics as metrics
 from strixpipeline.config import config
 
 _logger = logging.getLogger(__name__)
 
+# "token": one document per token, "sentence" and "window": one document per sentence / number of tokens
+TERM_STORAGE_MODES = ("token", "sentence", "window")
 
-def get_paths_for_corpus(corpus_id):
+
+def get_document_id(*parts):
+    """
+    _id made from corpus, path of the file, number of the document in the file, doc_id and (for term documents)
+    position, so that a document that is sent again overwrites the earlier copy
+    """
+    key = "\x1f".join(str(part) for part in parts).encode("utf-8")
+    return base64.urlsafe_b64encode(hashlib.blake2b(key, digest_size=15).digest()).decode("ascii")
+
+
+def get_texts_dir(corpus_id):
     conf = config.corpusconf.get_corpus_conf(corpus_id)
     corpus_dir_name = conf.get("corpus_dir") or conf.get("corpus_id")
     if config.texts_dir.startswith("/"):
-        texts_dir = os.path.join(config.texts_dir, corpus_dir_name)
+        return os.path.join(config.texts_dir, corpus_dir_name)
     else:
-        texts_dir = os.path.join(config.base_dir, config.texts_dir, corpus_dir_name)
+        return os.path.join(config.base_dir, config.texts_dir, corpus_dir_name)
+
+
+def get_paths_for_corpus(corpus_id):
+    texts_dir = get_texts_dir(corpus_id)
     return glob.glob(os.path.join(texts_dir, "**/*.xml")) + glob.glob(os.path.join(texts_dir, "*.xml"))
 
 
@@ -26,28 +42,22 @@ class InsertData:
     def __init__(self, index):
         self.index = index
         self.corpus_conf = config.corpusconf.get_corpus_conf(self.index)
+        self.texts_dir = get_texts_dir(self.index)
+        if config.term_storage not in TERM_STORAGE_MODES:
+            raise ValueError(f"Unknown term_storage: {config.term_storage}, use one of {', '.join(TERM_STORAGE_MODES)}")
+        # the sentences are found by the is_start of the sentence struct attribute of the tokens
+        if (
+            config.term_storage == "sentence"
+            and "sentence" not in self.corpus_conf["analyze_config"]["struct_attributes"]
+        ):
+            raise ValueError(
+                f'term_storage "sentence" needs the struct attribute "sentence", which {index} does not have'
+            )
+        # compiled once and sent to the workers together with this object
+        self.compile_parse_plan()
+        self.pca = vectorstore.load_pca(index) if vectorstore.get_vector_field_conf(index).get("pca_dims") else None
 
-    def prepare_urls(self):
-        urls = []
-        tot_size = 0
-        paths = get_paths_for_corpus(self.index)
-
-        for text in paths:
-            text_id = os.path.splitext(os.path.basename(text))[0]
-            if os.path.isfile(text):
-                f = open(text)
-                size = os.fstat(f.fileno()).st_size
-                tot_size += size
-                urls.append(("text", text_id, size, {"text": text}))
-                _logger.info(f"Adding file: {text}")
-        return urls, tot_size
-
-    def process(self, _, task_id, task_data):
-        process_t = time.time()
-        tasks = self.process_work(task_id, task_data)
-        return tasks, time.time() - process_t
-
-    def process_work(self, task_id, task):
+    def compile_parse_plan(self):
         word_attrs = []
         pos_index = []
         for attr_name in self.corpus_conf["analyze_config"]["word_attributes"]:
@@ -86,21 +96,10 @@ class InsertData:
                     if not text_attribute.get("save", True):
                         remove_later.append(attr_type)
 
-        split_document = self.corpus_conf.get("split", "text")
-        file_path = task["text"]
-        text_tags = self.corpus_conf.get("text_tags")
-
-        # load preprocessed document vectors
-        transformer_output = {}
-        with open(os.path.join(config.transformers_postprocess_dir, self.index, f"vectors/{task_id}.jsonl")) as fp:
-            for row in fp:
-                [doc_id, doc_vector] = json.loads(row)
-                transformer_output[doc_id] = doc_vector
-
-        texts = []
-        for text in xmlparser.parse_pipeline_xml(
-            file_path,
-            split_document,
+        self.text_attributes = text_attributes
+        self.remove_later = remove_later
+        self.parse_plan = xmlparser.ParsePlan(
+            self.corpus_conf.get("split", "text"),
             word_annotations,
             struct_annotations=struct_annotations,
             text_attributes=text_attributes,
@@ -108,32 +107,89 @@ class InsertData:
             add_most_common_words=True,
             save_whitespace_per_token=True,
             pos_index_attributes=pos_index,
-            text_tags=text_tags,
-        ):
-            texts.append(text)
-
-        tasks = []
-        terms = []
-
-        file_name = os.path.basename(file_path)
-        for text in texts:
-            text["mode_id"] = self.corpus_conf["mode_id"]
-            doc_id = text["text_attributes"]["_id"]
-            text["doc_id"] = doc_id
-            text["sent_vector"] = transformer_output.pop(doc_id)
-            self.generate_title(text, text_attributes)
-            text["corpus_id"] = self.index
-            text["original_file"] = file_name
-            task = self.get_doc_task(text)
-            task_terms = self.create_term_positions(doc_id, text["token_lookup"])
-            del text["token_lookup"]
-            for attribute in remove_later:
-                if attribute in text["text_attributes"]:
-                    del text["text_attributes"][attribute]
-            tasks.append(task)
-            terms.extend(task_terms)
-
-        return itertools.chain(tasks, terms or [])
+            text_tags=self.corpus_conf.get("text_tags"),
+            cache_size=config.decode_cache_size,
+        )
+
+    def prepare_urls(self):
+        urls = []
+        tot_size = 0
+        paths = get_paths_for_corpus(self.index)
+
+        for text in paths:
+            text_id = os.path.splitext(os.path.basename(text))[0]
+            if os.path.isfile(text):
+                f = open(text)
+                size = os.fstat(f.fileno()).st_size
+                tot_size += size
+                urls.append(("text", text_id, size, {"text": text}))
+                _logger.info(f"Adding file: {text}")
+        return urls, tot_size
+
+    def process(self, _, task_id, task_data, timer=None):
+        return self.process_work(task_id, task_data, timer=timer)
+
+    def process_work(self, task_id, task, timer=None):
+        """
+        Generator of bulk actions for a file, each document is followed by its term documents
+        :param timer: metrics.StageTimer that gets the time spent parsing and creating term documents
+        """
+        if timer is None:
+            timer = metrics.StageTimer()
+        file_path = task["text"]
+        # a task for a range of the split_document elements of a large file, see splitindex.split_tasks
+        text_range = task.get("range")
+        if text_range:
+            source = xmlparser.RangeReader(
+                file_path, text_range["start"], text_range["end"], text_range["prefix"], text_range["suffix"]
+            )
+            timer.counts["input_bytes"] += text_range["end"] - text_range["start"]
+        else:
+            source = file_path
+            timer.counts["input_bytes"] += os.path.getsize(file_path)
+
+        try:
+            # preprocessed document vectors, saved per file
+            vectors = vectorstore.VectorFile(self.index, task.get("file_id", task_id), pca=self.pca)
+
+            file_name = os.path.basename(file_path)
+            # the _ids use the path in the corpus and the number of the document in the file, since file names can
+            # be repeated in subdirectories and doc_ids in a file
+            relative_path = os.path.relpath(file_path, self.texts_dir)
+            document_number = text_range["first_document"] if text_range else 0
+            texts = xmlparser.parse_with_plan(source, self.parse_plan, backend=config.xml_parser)
+            for text in timer.timed("parse", texts):
+                text["mode_id"] = self.corpus_conf["mode_id"]
+                doc_id = text["text_attributes"]["_id"]
+                text["doc_id"] = doc_id
+                text["sent_vector"] = vectors.get(doc_id)
+                self.generate_title(text, self.text_attributes)
+                text["corpus_id"] = self.index
+                text["original_file"] = file_name
+                token_lookup = text.pop("token_lookup")
+                for attribute in self.remove_later:
+                    if attribute in text["text_attributes"]:
+                        del text["text_attributes"][attribute]
+                timer.counts["docs"] += 1
+                timer.counts["tokens"] += text["word_count"]
+                document_key = (self.index, relative_path, document_number, doc_id)
+                document_number += 1
+                yield self.get_doc_task(text, document_key)
+                yield from timer.timed(
+                    "term_docs", self.create_term_positions(doc_id, file_name, token_lookup, document_key)
+                )
+        finally:
+            # the whole files are opened and closed by the parser
+            if text_range:
+                source.close()
+
+        if _logger.isEnabledFor(logging.DEBUG):
+            hit_rates = []
+            for name, stats in self.parse_plan.get_cache_stats().items():
+                lookups = stats["hits"] + stats["misses"]
+                if lookups:
+                    hit_rates.append(f"{name}: {stats['hits'] / lookups:.1%} ({stats['currsize']} values)")
+            _logger.debug(f"Decode cache hit rates after {task_id}: {', '.join(hit_rates)}")
 
     def generate_title(self, text, text_attributes):
         if self.corpus_conf["title"] == "n/a":
@@ -148,18 +204,68 @@ class InsertData:
         if "title" not in text:
             raise RuntimeError('Configure "title" for corpus')
 
-    def get_doc_task(self, text):
-        return {"_index": self.index, "_source": text}
+    def get_doc_task(self, text, document_key):
+        """
+        :param document_key: the parts of the _id of the document, see get_document_id
+        """
+        _id = get_document_id(*document_key)
+        return {"_index": self.index, "_id": _id, "_source": text}
 
-    def create_term_positions(self, text_id, token_lookup):
-        terms = []
+    def create_term_positions(self, text_id, file_name, token_lookup, document_key):
+        if config.term_storage != "token":
+            yield from self.create_packed_term_positions(text_id, file_name, token_lookup, document_key)
+            return
         for token in token_lookup:
-            term = {
+            yield {
                 "doc_id": text_id,
+                "original_file": file_name,
                 "_index": self.index + "_terms",
+                "_id": get_document_id(*document_key, token["position"]),
                 "_op_type": "index",
                 "position": token["position"],
                 "term": token,
             }
-            terms.append(term)
-        return terms
+
+    def create_packed_term_positions(self, text_id, file_name, token_lookup, document_key):
+        """
+        Group the tokens of a document into packed term documents of at most config.term_window_size tokens.
+        In "sentence" mode a new group is also started at each sentence.
+        """
+        window_size = config.term_window_size
+        split_on_sentence = config.term_storage == "sentence"
+        group = []
+        for token in token_lookup:
+            if group and (
+                len(group) >= window_size
+                or (split_on_sentence and token["attrs"].get("sentence", {}).get("is_start", False))
+            ):
+                yield self.get_packed_term_task(text_id, file_name, group, document_key)
+                group = []
+            group.append(token)
+        if group:
+            yield self.get_packed_term_task(text_id, file_name, group, document_key)
+
+    def get_packed_term_task(self, text_id, file_name, tokens, document_key):
+        """
+        The tokens are stored as parallel arrays, the i:th value of each array belongs to the token at position
+        start + i. Attributes that are missing on a token (e.g. a struct the token is not inside) are null.
+        """
+        attr_names = {}
+        for token in tokens:
+            attr_names.update(dict.fromkeys(token["attrs"]))
+        start = tokens[0]["position"]
+        return {
+            "doc_id": text_id,
+            "original_file": file_name,
+            "_index": self.index + "_terms",
+            "_id": get_document_id(*document_key, start),
+            "_op_type": "index",
+            "positions": {"gte": start, "lte": start + len(tokens) - 1},
+            "start": start,
+            "length": len(tokens),
+            "terms": {
+                "word": [token["word"] for token in tokens],
+                "whitespace": [token.get("whitespace") for token in tokens],
+                "attrs": {name: [token["attrs"].get(name) for token in tokens] for name in attr_names},
+            },
+        }
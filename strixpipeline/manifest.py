@@ -0,0 +1,126 @@
+"""
+The manifest records the content hash of every file that is in the live index of a corpus, together with a
+hash of the corpus configuration that was used. It is written after each successful run and makes it possible
+for `add --incremental` to only reparse the files that changed since then.
+
+{
+    "index": "<name of the index behind the corpus alias>",
+    "config_hash": "<hash of corpus configuration>",
+    "files": {"<original_file>": {"path": ..., "size": ..., "mtime": ..., "hash": ...}}
+}
+"""
+
+import json
+import os
+import hashlib
+
+from strixpipeline.config import config
+import strixpipeline.vectorstore
+
+
+def get_manifest_path(corpus):
+    return os.path.join(config.manifest_dir, f"{corpus}.json")
+
+
+def load(corpus):
+    try:
+        with open(get_manifest_path(corpus)) as fp:
+            return json.load(fp)
+    except FileNotFoundError:
+        return None
+
+
+def save(corpus, manifest):
+    path = get_manifest_path(corpus)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as fp:
+        json.dump(manifest, fp, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def remove(corpus):
+    path = get_manifest_path(corpus)
+    if os.path.isfile(path):
+        os.remove(path)
+
+
+def create(index_name, config_hash, files):
+    return {"index": index_name, "config_hash": config_hash, "files": files}
+
+
+def get_file_hash(file_path, block_size=1 << 20):
+    h = hashlib.blake2b(digest_size=20)
+    with open(file_path, "rb") as fp:
+        for block in iter(lambda: fp.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def get_file_entry(file_path, previous_entry=None):
+    """
+    describe file for the manifest, the file is only read and hashed if size or modification time
+    differs from the previous entry
+    """
+    stat = os.stat(file_path)
+    entry = {"path": file_path, "size": stat.st_size, "mtime": stat.st_mtime_ns}
+    if (
+        previous_entry
+        and previous_entry["size"] == entry["size"]
+        and previous_entry["mtime"] == entry["mtime"]
+        and previous_entry.get("hash")
+    ):
+        entry["hash"] = previous_entry["hash"]
+    else:
+        entry["hash"] = get_file_hash(file_path)
+    return entry
+
+
+def get_config_hash(corpus):
+    """
+    hash the corpus configuration with all attribute references resolved, so that changes in the
+    shared attribute files also invalidates the manifest
+    """
+    corpus_conf = dict(config.corpusconf.get_corpus_conf(corpus))
+    # set on every run by sparv_decoder
+    corpus_conf.pop("updated_at", None)
+
+    analyze_config = corpus_conf.get("analyze_config", {})
+    resolved = {"word_attributes": [], "struct_attributes": {}, "text_attributes": []}
+    for attr_name in analyze_config.get("word_attributes", []):
+        for attr_type, attr in attr_name.items():
+            if type(attr) is str:
+                attr = config.corpusconf.get_word_attribute(attr)
+            resolved["word_attributes"].append({attr_type: attr})
+    for node_name, attr_names in analyze_config.get("struct_attributes", {}).items():
+        structs = []
+        for attr_name in attr_names:
+            for attr_type, attr in attr_name.items():
+                if type(attr) is str:
+                    attr = config.corpusconf.get_struct_attribute(attr)
+                structs.append({attr_type: attr})
+        resolved["struct_attributes"][node_name] = structs
+    for attr_name in analyze_config.get("text_attributes", []):
+        for attr_type, attr in attr_name.items():
+            if type(attr) is str:
+                attr = config.corpusconf.get_struct_attribute(attr)
+            resolved["text_attributes"].append({attr_type: attr})
+    corpus_conf["analyze_config"] = resolved
+    # the layout of the _terms index is not part of the corpus configuration
+    corpus_conf["term_storage"] = [config.term_storage, config.term_window_size]
+    corpus_conf["vector_field"] = strixpipeline.vectorstore.get_vector_field_conf(corpus)
+
+    serialized = json.dumps(corpus_conf, sort_keys=True, default=str)
+    return hashlib.blake2b(serialized.encode("utf-8"), digest_size=20).hexdigest()
+
+
+def get_changes(manifest, files):
+    """
+    :param manifest: manifest from previous run
+    :param files: dict of original_file -> manifest entry for the files currently in the corpus
+    :return: list of files that are new or changed and list of files that have been removed
+    """
+    previous_files = manifest["files"]
+    changed = [name for name, entry in files.items() if previous_files.get(name, {}).get("hash") != entry["hash"]]
+    removed = [name for name in previous_files if name not in files]
+    return changed, removed
@@ -0,0 +1,107 @@
+"""
+Timing of the stages of a run. The stages of processing a file are interleaved, since the documents are parsed,
+converted and serialized one at a time, so each stage is timed exclusively: time spent in a nested stage is not
+counted for the stage around it.
+"""
+
+import collections
+import contextlib
+import time
+
+
+class StageTimer:
+    def __init__(self):
+        self.seconds = collections.Counter()
+        self.counts = collections.Counter()
+        self.current = None
+        self.last = time.perf_counter()
+
+    def switch(self, stage):
+        """
+        charge the time since last switch to the current stage and make stage the current one
+        :return: the previous stage
+        """
+        now = time.perf_counter()
+        if self.current is not None:
+            self.seconds[self.current] += now - self.last
+        self.last = now
+        previous = self.current
+        self.current = stage
+        return previous
+
+    @contextlib.contextmanager
+    def stage(self, stage):
+        previous = self.switch(stage)
+        try:
+            yield
+        finally:
+            self.switch(previous)
+
+    def timed(self, stage, iterable):
+        """
+        iterate over iterable and charge the time spent producing the items to stage
+        """
+        # this is called for every document, so switch is inlined
+        perf_counter = time.perf_counter
+        seconds = self.seconds
+        iterator = iter(iterable)
+        while True:
+            now = perf_counter()
+            previous = self.current
+            if previous is not None:
+                seconds[previous] += now - self.last
+            self.last = now
+            self.current = stage
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                now = perf_counter()
+                seconds[self.current] += now - self.last
+                self.last = now
+                self.current = previous
+            yield item
+
+    def get_result(self):
+        self.switch(self.current)
+        return {"seconds": dict(self.seconds), "counts": dict(self.counts)}
+
+
+def add_results(total, result):
+    """
+    sum results from StageTimer.get_result into total
+    """
+    for key in ("seconds", "counts"):
+        for name, value in result[key].items():
+            total.setdefault(key, {})
+            total[key][name] = total[key].get(name, 0) + value
+    return total
+
+
+def get_worker_utilization(results, start, end):
+    """
+    :param results: results of process_task and process_group, with the worker pid, when the task started and how
+                    long it took
+    :return: list with the pid, number of files, busy seconds and the share of start - end that it was busy for
+             each worker
+    """
+    workers = {}
+    for result in results:
+        worker = workers.setdefault(result["worker"], {"worker": result["worker"], "files": 0, "busy_seconds": 0.0})
+        worker["files"] += len(result.get("task_ids", ())) or 1
+        worker["busy_seconds"] += result["time"]
+    for worker in workers.values():
+        worker["utilization"] = worker["busy_seconds"] / (end - start) if end > start else 0.0
+    return sorted(workers.values(), key=lambda worker: worker["worker"])
+
+
+def get_throughput(counts, seconds):
+    if not seconds:
+        return {}
+    return {
+        "tokens_per_s": counts.get("tokens", 0) / seconds,
+        "docs_per_s": counts.get("docs", 0) / seconds,
+        "bytes_per_s": counts.get("input_bytes", 0) / seconds,
+        "bulk_bytes_per_s": counts.get("bulk_bytes", 0) / seconds,
+    }
@@ -1,11 +1,11 @@
+import collections
 import json
-import sys
 import time
 from concurrent import futures
 import multiprocessing
+import queue
 
 import elasticsearch
-import elasticsearch.helpers
 import elasticsearch.exceptions
 from elasticsearch import serializer, exceptions
 from pathlib import Path
@@ -14,10 +14,20 @@ from strixpipeline import xmlparser
 from strixpipeline.config import config
 import strixpipeline.insertdata as insert_data_strix
 import strixpipeline.createindex as create_index_strix
+import strixpipeline.elasticapi as elasticapi
+import strixpipeline.bulk
+import strixpipeline.checkpoint
+import strixpipeline.manifest
+import strixpipeline.metrics
+import strixpipeline.progress
 import strixpipeline.runhistory
+import strixpipeline.splitindex
+import strixpipeline.vectorgen
+import strixpipeline.vectorstore
 import logging
 import datetime
 import os
+import statistics
 import orjson
 
 
@@ -29,7 +39,7 @@ class ORJSONSerializer(serializer.JSONSerializer):
         if not isinstance(data, (dict, list)):
             raise exceptions.SerializationError(f"Cannot serialize {type(data)}. Must be dict or list.")
         try:
-            return orjson.dumps(data).decode("utf-8")
+            return orjson.dumps(data, option=strixpipeline.bulk.DUMPS_OPTIONS)
         except Exception as e:
             raise exceptions.SerializationError(f"Orjson serialization error: {e}")
 
@@ -49,97 +59,573 @@ es = elasticsearch.Elasticsearch(
 _logger = logging.getLogger(__name__)
 
 
-def partition_tasks(task_queue, num_tasks):
-    threshold = 10000  # KB
-    current_size = 0
-    current_tasks = []
-    work_size_accu = 0
+TASK_ORDERS = ("size", "none")
 
-    while True:
-        if num_tasks < 1:
-            _logger.info("Processing complete")
-            break
+# set in each worker process by init_worker
+_insert_data = None
+_send_queue = None
+_max_bytes = None
 
-        (task_data, process_time, work_size) = task_queue.get()
-        work_size_accu += work_size
-        num_tasks -= 1
 
-        for task in task_data:
-            if "_source" in task and "text" in task["_source"]:
-                task_size = len(task["_source"]["text"]) / 1024.0  # B to KB
-            else:
-                task_size = 0.5
+def init_worker(insert_data, send_queue, max_bytes):
+    global _insert_data, _send_queue, _max_bytes
+    _insert_data = insert_data
+    _send_queue = send_queue
+    _max_bytes = max_bytes
 
-            if current_size + task_size >= threshold:
-                yield (current_tasks, current_size, work_size_accu)
-                current_size = 0
-                current_tasks = []
 
-            current_tasks.append(task)
-            current_size += task_size
-    if current_tasks:
-        yield (current_tasks, current_size, work_size_accu)
+def process_task(task_type, task_id, task):
+    """
+    Runs in a worker process, exceptions are passed on to process_corpus. The documents are
+    parsed while the batches are sent by the BulkSender in the main process.
+    """
+    t = time.time()
 
+    timer = strixpipeline.metrics.StageTimer()
+    tasks = _insert_data.process(task_type, task_id, task, timer=timer)
+    count = strixpipeline.bulk.put_batches(_send_queue, task_id, tasks, max_bytes=_max_bytes, timer=timer)
 
-def process_task(insert_data, size, process_args):
-    _task_id = process_args[1]
+    delta_t = time.time() - t
+    _logger.info("Processed id: %s, %s documents, took %0.1fs" % (task_id, count, delta_t))
+    return {"count": count, "time": delta_t, "started": t, "worker": os.getpid(), **timer.get_result()}
 
-    try:
-        (tasks, delta_t) = insert_data.process(*process_args)
-    except Exception:
-        _logger.exception("Failed to process %s" % _task_id)
-        sys.exit()
 
-    try:
-        count = 0
-        res = elasticsearch.helpers.streaming_bulk(es, tasks)
-        for _ in res:
-            count += 1
-        _logger.info(f"Added {count} documents to index")
-    except Exception as e:
-        _logger.exception(e)
-        sys.exit()
+def process_group(group_id, tasks):
+    """
+    Runs in a worker process like process_task, for a group of small files whose actions are sent in one stream
+    of bulk requests under group_id. A file that fails does not stop the others, its exception is returned in
+    "failed" of the result.
+    """
+    t = time.time()
 
-    _logger.info("Processed id: %s, took %0.1fs" % (_task_id, delta_t))
+    timer = strixpipeline.metrics.StageTimer()
+    failed = {}
 
+    def get_actions():
+        for task_type, task_id, _, task in tasks:
+            try:
+                yield from _insert_data.process(task_type, task_id, task, timer=timer)
+            except Exception as e:
+                _logger.error("Failed to process %s" % task_id, exc_info=e)
+                failed[task_id] = e
 
-def process_corpus(index):
-    t = time.time()
-    insert_data = insert_data_strix.InsertData(index)
-    task_data, tot_size = insert_data.prepare_urls()
+    count = strixpipeline.bulk.put_batches(_send_queue, group_id, get_actions(), max_bytes=_max_bytes, timer=timer)
+
+    delta_t = time.time() - t
+    _logger.info("Processed id: %s (%s files), %s documents, took %0.1fs" % (group_id, len(tasks), count, delta_t))
+    return {
+        "count": count,
+        "time": delta_t,
+        "started": t,
+        "worker": os.getpid(),
+        **timer.get_result(),
+        "failed": failed,
+    }
 
-    with futures.ProcessPoolExecutor(max_workers=min(multiprocessing.cpu_count(), 16)) as executor:
-        assert len(task_data)
-        _logger.info("Scheduling %s tasks..." % len(task_data))
-        for task_type, task_id, size, task in task_data:
-            task_args = (task_type, task_id, task)
-            executor.submit(process_task, insert_data, size, task_args)
 
-    _logger.info(index + " pipeline complete, took %i min and %i sec. " % divmod(time.time() - t, 60))
+def order_tasks(task_data):
+    """
+    with config.task_order "size" the largest files are scheduled first, so that a large file does not keep one
+    worker busy while the others are idle at the end of the run, with "none" they are kept in the order they
+    were found
+    """
+    if config.task_order not in TASK_ORDERS:
+        raise ValueError(f'Unknown task_order "{config.task_order}", use one of {", ".join(TASK_ORDERS)}')
+    if config.task_order == "size":
+        return sorted(task_data, key=lambda task: task[2], reverse=True)
+    return task_data
 
 
-def do_run(index):
+def group_tasks(task_data, max_workers):
+    """
+    Pack the tasks of files smaller than config.group_task_bytes into groups of at most that size, and at most
+    config.group_max_files files, that are processed by one worker as one task. The groups are made smaller when
+    there would be fewer than four of them per worker.
+    :return: list of groups, each a list of tasks, in the order of task_data
+    """
+    if not config.group_task_bytes:
+        return [[task] for task in task_data]
+    small_size = sum(size for _, _, size, _ in task_data if size < config.group_task_bytes)
+    group_bytes = min(config.group_task_bytes, max(1, small_size // (4 * max_workers)))
+    groups = []
+    group = []
+    group_size = 0
+    for task in task_data:
+        if task[2] >= group_bytes:
+            groups.append([task])
+            continue
+        if group and (group_size + task[2] > group_bytes or len(group) >= config.group_max_files):
+            groups.append(group)
+            group = []
+            group_size = 0
+        group.append(task)
+        group_size += task[2]
+    if group:
+        groups.append(group)
+    return groups
+
+
+def process_corpus(insert_data, task_data, journal=None, dead_letters=None):
+    """
+    Process the tasks on a pool of config.max_workers processes, with at most config.max_tasks_in_flight
+    tasks submitted at a time. Small files are processed in groups, see group_tasks.
+    :param journal: checkpoint.Journal that gets each file once all its documents have been indexed
+    :param dead_letters: checkpoint.DeadLetters that gets the bulk items that failed
+    :return: dict of task_id -> result for the completed tasks and dict of task_id -> exception for the failed tasks,
+             the result has the time spent in each stage, see metrics.StageTimer. A group of files has one result,
+             under the id <first task_id>+<number of other files>, with the task_ids of its files in "task_ids".
+    """
+    t = time.time()
+    assert len(task_data)
+
+    completed = {}
+    failed = {}
+    max_workers = config.max_workers
+    max_tasks_in_flight = max(config.max_tasks_in_flight, max_workers)
+    _logger.info("Scheduling %s tasks on %s workers..." % (len(task_data), max_workers))
+    task_data = order_tasks(task_data)
+    task_data_by_id = {task_id: task for _, task_id, _, task in task_data}
+    groups = group_tasks(task_data, max_workers)
+    if len(groups) < len(task_data):
+        _logger.info(f"{len(task_data)} tasks grouped into {len(groups)}")
+    # task or group id -> task_ids of its files
+    members = {}
+
+    def get_file_name(task_id):
+        return os.path.basename(task_data_by_id[task_id]["text"])
+
+    # bounded, so that the workers wait for the sender when the cluster is slower than the parsing
+    send_queue = multiprocessing.Queue(maxsize=config.send_queue_size)
+    sender = strixpipeline.bulk.BulkSender(send_queue, dead_letters=dead_letters)
+    sender.start()
+    progress = strixpipeline.progress.Progress(insert_data.index, task_data, sender)
+    progress.start()
+
+    with futures.ProcessPoolExecutor(
+        max_workers=max_workers, initializer=init_worker, initargs=(insert_data, send_queue, sender.throttle.max_bytes)
+    ) as executor:
+        remaining = iter(groups)
+        in_flight = {}
+        # task_id -> (file names, number of actions) for processed tasks that are not fully acknowledged yet
+        unconfirmed = {}
+        # a large file can be split into several tasks, it is journaled when all of them have been acknowledged
+        file_tasks = collections.Counter(os.path.basename(task["text"]) for _, _, _, task in task_data)
+        failed_files = set()
+
+        def journal_sent():
+            for task_id, (file_names, count) in list(unconfirmed.items()):
+                # acked before errors, an error is recorded before the actions are acked
+                if sender.acked[task_id] >= count:
+                    if task_id in sender.errors:
+                        failed_files.update(file_names)
+                    for file_name in file_names:
+                        file_tasks[file_name] -= 1
+                        if file_tasks[file_name] == 0 and file_name not in failed_files:
+                            journal.add(file_name)
+                    del unconfirmed[task_id]
+
+        def task_failed(task_id, e):
+            for member in members[task_id]:
+                failed[member] = e
+                progress.task_failed(member)
+                failed_files.add(get_file_name(member))
+
+        while True:
+            for group in remaining:
+                if len(group) == 1:
+                    task_type, task_id, _, task = group[0]
+                    members[task_id] = [task_id]
+                else:
+                    task_id = f"{group[0][1]}+{len(group) - 1}"
+                    members[task_id] = [member_id for _, member_id, _, _ in group]
+                try:
+                    if len(group) == 1:
+                        future = executor.submit(process_task, task_type, task_id, task)
+                    else:
+                        future = executor.submit(process_group, task_id, group)
+                    in_flight[future] = task_id
+                except futures.process.BrokenProcessPool as e:
+                    task_failed(task_id, e)
+                if len(in_flight) >= max_tasks_in_flight:
+                    break
+            if not in_flight:
+                break
+
+            done, _ = futures.wait(in_flight, timeout=5, return_when=futures.FIRST_COMPLETED)
+            for future in done:
+                task_id = in_flight.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    _logger.error("Failed to process %s" % task_id, exc_info=e)
+                    task_failed(task_id, e)
+                    continue
+                file_failures = result.pop("failed", {})
+                if len(members[task_id]) > 1:
+                    result["task_ids"] = members[task_id]
+                completed[task_id] = result
+                file_names = []
+                for member in members[task_id]:
+                    if member in file_failures:
+                        failed[member] = file_failures[member]
+                        progress.task_failed(member)
+                        failed_files.add(get_file_name(member))
+                    else:
+                        progress.task_done(member)
+                        file_names.append(get_file_name(member))
+                if journal:
+                    unconfirmed[task_id] = (file_names, result["count"])
+
+            if journal:
+                journal_sent()
+
+    sender.stop()
+    if journal:
+        journal_sent()
+    progress.stop()
+    for task_id, errors in sender.errors.items():
+        completed.pop(task_id, None)
+        for member in members[task_id]:
+            failed.setdefault(member, errors[0])
+    for task_id, result in completed.items():
+        result["count"] = sender.counts[task_id]
+        result["seconds"]["bulk_send"] = sender.send_seconds[task_id]
+
+    count = sum(result["count"] for result in completed.values())
+    _logger.info(f"{len(task_data) - len(failed)} of {len(task_data)} tasks processed, {count} documents added")
+    workers = strixpipeline.metrics.get_worker_utilization(completed.values(), t, time.time())
+    if workers:
+        mean = sum(worker["utilization"] for worker in workers) / len(workers)
+        utilization = ", ".join(f"{worker['utilization']:.0%}" for worker in workers)
+        _logger.info(f"Worker utilization: {mean:.0%} on average ({utilization})")
+    if failed:
+        for task_id, e in failed.items():
+            _logger.error(f"Failed: {task_id} ({type(e).__name__}: {e})")
+    _logger.info(insert_data.index + " pipeline complete, took %i min and %i sec. " % divmod(time.time() - t, 60))
+    return completed, failed
+
+
+def get_manifest_files(task_data, previous_manifest=None):
+    previous_files = previous_manifest["files"] if previous_manifest else {}
+    files = {}
+    for _, _, _, task in task_data:
+        file_name = os.path.basename(task["text"])
+        if file_name in files:
+            _logger.warning(f"More than one file named {file_name}, incremental updates will not work correctly")
+        files[file_name] = strixpipeline.manifest.get_file_entry(task["text"], previous_files.get(file_name))
+    return files
+
+
+def can_update_incrementally(index):
+    """
+    an incremental update is only possible if the live index was created by a run that saved a manifest,
+    using the same corpus configuration as now
+    """
+    manifest = strixpipeline.manifest.load(index)
+    if manifest is None:
+        _logger.info(f"No manifest found for {index}, a new index will be created")
+        return False
+    if manifest["config_hash"] != strixpipeline.manifest.get_config_hash(index):
+        _logger.info(f"Configuration for {index} has changed, a new index will be created")
+        return False
+    if elasticapi.get_index_from_alias(index) != manifest["index"]:
+        _logger.info(f"Manifest for {index} does not describe the current index, a new index will be created")
+        return False
+    return True
+
+
+def delete_documents_by_file(index, file_names, chunk_size=1000):
+    for i in range(0, len(file_names), chunk_size):
+        chunk = file_names[i : i + chunk_size]
+        res = es.delete_by_query(
+            index=index + "," + index + "_terms",
+            query={"terms": {"original_file": chunk}},
+            conflicts="proceed",
+            slices="auto",
+            refresh=True,
+            request_timeout=10000,
+        )
+        _logger.info(f"Deleted {res['deleted']} documents belonging to {len(chunk)} files")
+
+
+def do_run(index, incremental=False, resume=False):
+    """
+    :param incremental: only reindex files that have been added, changed or removed since the last run,
+                        check that this is possible using can_update_incrementally first
+    :param resume: continue the run in the checkpoint journal and skip the files that were done, check that this
+                   is possible using can_resume first
+    """
     strixpipeline.runhistory.create()
     before_t = time.time()
+    timer = strixpipeline.metrics.StageTimer()
 
     if not config.corpusconf.is_corpus(index):
         _logger.error('"' + index + " is not a configured corpus.")
         return
 
+    checkpoint_run = strixpipeline.checkpoint.load(index) if resume else None
+    if checkpoint_run:
+        incremental = checkpoint_run["incremental"]
+    previous_manifest = strixpipeline.manifest.load(index) if incremental else None
+
+    # the PCA of a live index is kept in incremental and resumed runs so that all documents are reduced in the same way
+    pca_dims = strixpipeline.vectorstore.get_vector_field_conf(index).get("pca_dims")
+    if pca_dims and not ((incremental or resume) and strixpipeline.vectorstore.load_pca(index) is not None):
+        with timer.stage("pca"):
+            paths = insert_data_strix.get_paths_for_corpus(index)
+            task_ids = [os.path.splitext(os.path.basename(path))[0] for path in paths]
+            explained = strixpipeline.vectorstore.fit_pca(index, pca_dims, task_ids)
+        _logger.info(f"Fitted PCA with {pca_dims} dimensions, explains {explained:.1%} of the variance")
+
+    with timer.stage("discovery"):
+        insert_data = insert_data_strix.InsertData(index)
+        task_data, tot_size = insert_data.prepare_urls()
+        files = get_manifest_files(task_data, previous_manifest)
+
+    done = strixpipeline.checkpoint.get_done_files(checkpoint_run, files) if checkpoint_run else set()
+    if checkpoint_run:
+        _logger.info(f"Resuming run started {checkpoint_run['started']}, {len(done)} files already done")
+    if incremental:
+        changed, removed = strixpipeline.manifest.get_changes(previous_manifest, files)
+        _logger.info(f"{len(changed)} new or changed files and {len(removed)} removed files")
+        task_data = [task for task in task_data if os.path.basename(task[3]["text"]) in changed]
+        to_delete = [file_name for file_name in changed + removed if file_name not in done]
+    else:
+        # documents of files that were partly sent before the run was interrupted
+        to_delete = [os.path.basename(task["text"]) for _, _, _, task in task_data] if checkpoint_run else []
+        to_delete = [file_name for file_name in to_delete if file_name not in done]
+    if to_delete:
+        with timer.stage("delete"):
+            delete_documents_by_file(index, to_delete)
+    task_data = [task for task in task_data if os.path.basename(task[3]["text"]) not in done]
+    with timer.stage("split"):
+        plan = insert_data.parse_plan
+        task_data = strixpipeline.splitindex.split_tasks(index, task_data, plan.split_document, plan.text_tags)
+
+    config_hash = strixpipeline.manifest.get_config_hash(index)
+    index_name = elasticapi.get_index_from_alias(index)
+    journal = strixpipeline.checkpoint.Journal(index, files)
+    if not checkpoint_run:
+        journal.start(index_name, config_hash, incremental)
+        # the failed files of earlier runs are sent again by this run, their items must not be replayed later
+        removed = strixpipeline.checkpoint.remove_dead_letters(index)
+        if removed:
+            _logger.info(f"Removed {removed} dead letters of an earlier run")
+    dead_letters = strixpipeline.checkpoint.DeadLetters(index, index_name)
+
     ci = create_index_strix.CreateIndex(index)
     ci.enable_insert_settings()
-    process_corpus(index)
-    ci.enable_postinsert_settings()
+    completed = {}
+    failed = {}
+    if task_data:
+        with timer.stage("process"):
+            completed, failed = process_corpus(insert_data, task_data, journal=journal, dead_letters=dead_letters)
+    with timer.stage("postinsert"):
+        ci.enable_postinsert_settings()
+    with timer.stage("forcemerge"):
+        merge_indices(index, only_expunge_deletes=incremental)
+
+    # failed files are left out of the manifest so that they are processed again by the next incremental run
+    failed_files = sorted({os.path.basename(task["text"]) for _, task_id, _, task in task_data if task_id in failed})
+    for file_name in failed_files:
+        del files[file_name]
+
+    strixpipeline.manifest.save(index, strixpipeline.manifest.create(index_name, config_hash, files))
+    if failed_files:
+        _logger.info("Use add --resume to retry the failed files")
+    else:
+        strixpipeline.checkpoint.remove(index)
+    if dead_letters.count:
+        _logger.warning(
+            f"{dead_letters.count} documents could not be indexed, they are saved in {dead_letters.path} "
+            f"and can be sent again with replay-dead-letters"
+        )
+
+    # the file stages are summed over all workers, the throughput is per second of the process stage
+    file_stages = {}
+    file_results = []
+    file_names = {task_id: os.path.basename(task["text"]) for _, task_id, _, task in task_data}
+    for task_id, result in completed.items():
+        strixpipeline.metrics.add_results(file_stages, result)
+        if "task_ids" in result:
+            file_result = {"files": [file_names[member] for member in result["task_ids"]]}
+        else:
+            file_result = {"file": file_names[task_id]}
+        file_results.append({**file_result, "task_id": task_id, **result})
+    run_stages = timer.get_result()["seconds"]
+    counts = file_stages.get("counts", {})
+    throughput = strixpipeline.metrics.get_throughput(counts, run_stages.get("process", 0))
+    workers = []
+    if completed:
+        start = min(result["started"] for result in completed.values())
+        end = max(result["started"] + result["time"] for result in completed.values())
+        workers = strixpipeline.metrics.get_worker_utilization(completed.values(), start, end)
+    if throughput:
+        _logger.info(
+            f"{throughput['tokens_per_s']:.0f} tokens/s, {throughput['docs_per_s']:.1f} docs/s, "
+            f"{throughput['bytes_per_s'] / 1e6:.1f} MB/s"
+        )
 
     total_t = time.time() - before_t
     strixpipeline.runhistory.put(
         {
             "index": index,
             "total_time": total_t,
+            "incremental": incremental,
+            "failed_files": failed_files,
             "elastic_hosts": config.elastic_hosts,
             "timestamp": datetime.datetime.now(),
+            "stages": run_stages,
+            "file_stages": file_stages.get("seconds", {}),
+            "counts": counts,
+            "throughput": throughput,
+            "files": file_results,
+            "workers": workers,
         }
     )
+    return failed_files
+
+
+def can_resume(index):
+    """
+    a run can be resumed if the checkpoint journal describes the current index and was written with the same
+    corpus configuration as now
+    """
+    checkpoint_run = strixpipeline.checkpoint.load(index)
+    if checkpoint_run is None:
+        _logger.info(f"No unfinished run found for {index}")
+        return False
+    if checkpoint_run["config_hash"] != strixpipeline.manifest.get_config_hash(index):
+        _logger.info(f"Configuration for {index} has changed since the unfinished run, it can not be resumed")
+        return False
+    if elasticapi.get_index_from_alias(index) != checkpoint_run["index"]:
+        _logger.info(f"The unfinished run of {index} was for another index, it can not be resumed")
+        return False
+    return True
+
+
+def replay_dead_letters(index, task_ids=None):
+    """
+    Send the bulk items in the dead-letter file of index again. Items that fail again are written to a new
+    dead-letter file. The items being sent are kept in a .replay file until the replay has finished, if it is
+    interrupted they are sent again by the next replay.
+    :param task_ids: only send the items of these tasks (files), the others are kept in the dead-letter file
+    :return: number of items that failed again
+    """
+    path = strixpipeline.checkpoint.get_dead_letter_path(index)
+    replay_path = path + ".replay"
+    if os.path.isfile(replay_path):
+        _logger.info(f"Resuming the interrupted replay of {replay_path}")
+        if os.path.isfile(path):
+            # items that failed during the interrupted replay are already in the .replay file, with another error
+            replaying = {
+                (entry["task_id"], entry["lines"]) for entry in strixpipeline.checkpoint.read_dead_letters(replay_path)
+            }
+            with open(path) as fp, open(replay_path, "a") as replay_fp:
+                for line in fp:
+                    entry = json.loads(line)
+                    if (entry["task_id"], entry["lines"]) not in replaying:
+                        replay_fp.write(line)
+            os.remove(path)
+    elif os.path.isfile(path):
+        os.replace(path, replay_path)
+    else:
+        _logger.info(f"No dead letters for {index}")
+        return 0
+
+    # items for an earlier index would bring back documents of old versions of the files
+    index_name = elasticapi.get_index_from_alias(index)
+    dead_letters = strixpipeline.checkpoint.DeadLetters(index, index_name)
+    stale = 0
+    for entry in strixpipeline.checkpoint.read_dead_letters(replay_path):
+        if entry.get("index") != index_name:
+            stale += 1
+        elif task_ids is not None and entry["task_id"] not in task_ids:
+            dead_letters.write(entry["task_id"], entry["status"], entry["error"], entry["lines"].encode("utf-8"))
+    kept = dead_letters.count
+    if stale:
+        _logger.warning(f"Skipped {stale} documents that were saved for another index than {index_name}")
+
+    send_queue = queue.Queue(maxsize=config.send_queue_size)
+    sender = strixpipeline.bulk.BulkSender(send_queue, dead_letters=dead_letters)
+    sender.start()
+    batch_task_id = None
+    body = bytearray()
+    num_actions = 0
+    for entry in strixpipeline.checkpoint.read_dead_letters(replay_path, task_ids):
+        if entry.get("index") != index_name:
+            continue
+        lines = entry["lines"].encode("utf-8")
+        if num_actions and (
+            entry["task_id"] != batch_task_id
+            or len(body) + len(lines) > config.bulk_max_bytes
+            or num_actions >= config.bulk_max_actions
+        ):
+            send_queue.put((batch_task_id, bytes(body), num_actions))
+            body = bytearray()
+            num_actions = 0
+        batch_task_id = entry["task_id"]
+        body += lines
+        num_actions += 1
+    if num_actions:
+        send_queue.put((batch_task_id, bytes(body), num_actions))
+    sender.stop()
+    os.remove(replay_path)
+
+    num_failed = dead_letters.count - kept
+    _logger.info(f"Sent {sender.sent_actions} documents again, {num_failed} failed")
+    return num_failed
+
+
+def compare_runs(index, num_runs=5, threshold=0.2):
+    """
+    Compare the latest run of index with the median of up to num_runs earlier runs of the same kind (full or
+    incremental) in .runhistory
+    :param threshold: relative throughput drop that is reported as a regression
+    :return: None if no run with metrics is recorded, otherwise a dict with the "timestamp" of the latest run, the
+             number of "earlier" runs, "rows" of {"name", "value", "baseline", "unit"} with the throughput measures
+             and the time per token of each stage, and "regressions", the throughput measures that regressed
+    """
+    runs = strixpipeline.runhistory.get_runs(index, size=10 * (num_runs + 1))
+    runs = [run for run in runs if run.get("throughput")]
+    if not runs:
+        return None
+    latest = runs[0]
+    earlier = [run for run in runs[1:] if run.get("incremental") == latest.get("incremental")][:num_runs]
+    comparison = {"timestamp": latest["timestamp"], "earlier": len(earlier), "rows": [], "regressions": []}
+    if not earlier:
+        return comparison
+
+    def median(values):
+        return statistics.median(values) if values else None
+
+    for name, value in latest["throughput"].items():
+        baseline = median([run["throughput"][name] for run in earlier if name in run["throughput"]])
+        comparison["rows"].append({"name": name, "value": value, "baseline": baseline, "unit": ""})
+        if baseline and value < baseline * (1 - threshold):
+            comparison["regressions"].append(name)
+
+    # time per token makes runs with different sizes comparable and shows which stage got slower
+    for key in ("stages", "file_stages"):
+        for name, value in latest.get(key, {}).items():
+            tokens = latest["counts"].get("tokens")
+            if not tokens:
+                continue
+            per_token = [
+                run[key][name] / run["counts"]["tokens"]
+                for run in earlier
+                if name in run.get(key, {}) and run["counts"].get("tokens")
+            ]
+            baseline = median(per_token)
+            comparison["rows"].append(
+                {
+                    "name": name,
+                    "value": value / tokens * 1e6,
+                    "baseline": baseline and baseline * 1e6,
+                    "unit": "µs/token",
+                }
+            )
+    return comparison
 
 
 def check_vector_settings(corpus):
@@ -160,10 +646,51 @@ def check_vectors_exist(corpus):
     return path.is_dir() and any(f.is_file() for f in path.iterdir())
 
 
+def extract_text(corpus, task_id, file_path, parse_settings, previous_source=None):
+    """
+    Write the text of each document in file_path to texts/<task_id>.jsonl, unless the file and parse settings are
+    the same as when the existing texts file was written (according to previous_source)
+    :return: description of the source file, to be passed as previous_source in the next run, and if the file was
+             skipped
+    """
+    texts_path = os.path.join(config.transformers_postprocess_dir, corpus, f"texts/{task_id}.jsonl")
+    previous_entry = previous_source["file"] if previous_source else None
+    source = {"file": strixpipeline.manifest.get_file_entry(file_path, previous_entry), "parse": parse_settings}
+    if (
+        previous_source
+        and os.path.isfile(texts_path)
+        and previous_source["file"]["hash"] == source["file"]["hash"]
+        and previous_source["parse"] == parse_settings
+    ):
+        return source, True
+
+    # the texts file is either the old or the complete new one, also if the parsing fails
+    tmp_path = texts_path + ".tmp"
+    try:
+        with open(tmp_path, "w") as fp:
+            for text in xmlparser.parse_dump_xml(
+                file_path,
+                parse_settings["split"],
+                text_attributes={"_id": {}},
+                text_tags=parse_settings["text_tags"],
+                backend=config.xml_parser,
+            ):
+                doc_id = text["text_attributes"]["_id"]
+                transformer_input = [doc_id, " ".join(text["dump"]).replace("\n", "")]
+                fp.write(f"{json.dumps(transformer_input, ensure_ascii=False)}\n")
+        os.replace(tmp_path, texts_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return source, False
+
+
 def do_vector_generation(corpus, vector_generation_type):
     """
     First parse the XML:s and extract the text, save it into files
-    Then run the document vector generation, either local or remote (vector_generation_type)
+    Then run the document vector generation, either local, remote or in this process with
+    config.vector_generator (vector_generation_type "python", see strixpipeline.vectorgen)
     If "transformers_postprocess_server" is set, pipeline will move files from previous run of <corpus>
     to "transformers_postprocess_server_dir" on the given server and run a script on the server
     If "transformers_postprocess_server" is *not* set, it will simply call "./run_transformers.sh" and it is up
@@ -175,25 +702,51 @@ def do_vector_generation(corpus, vector_generation_type):
     task_data, tot_size = insert_data.prepare_urls()
 
     corpus_conf = config.corpusconf.get_corpus_conf(corpus)
-    split_document = corpus_conf.get("split", "text")
-    text_tags = corpus_conf.get("text_tags")
+    parse_settings = {"split": corpus_conf.get("split", "text"), "text_tags": corpus_conf.get("text_tags")}
 
-    text_attributes = {"_id": {}}
+    # the files that the existing texts were extracted from, files that are unchanged since then are skipped
+    sources_path = os.path.join(config.transformers_postprocess_dir, corpus, "texts_sources.json")
+    try:
+        with open(sources_path) as fp:
+            previous_sources = json.load(fp)
+    except FileNotFoundError:
+        previous_sources = {}
 
-    for task_type, task_id, size, task in task_data:
-        transformer_input = []
-        file_path = task["text"]
-        for text in xmlparser.parse_pipeline_xml(
-            file_path, split_document, {}, text_attributes=text_attributes, text_tags=text_tags
-        ):
-            doc_id = text["text_attributes"]["_id"]
-            transformer_input.append([doc_id, " ".join(text["dump"]).replace("\n", "")])
-        with open(os.path.join(config.transformers_postprocess_dir, corpus, f"texts/{task_id}.jsonl"), "w") as fp:
-            for text in transformer_input:
-                fp.write(f"{json.dumps(text, ensure_ascii=False)}\n")
+    t = time.time()
+    sources = {}
+    skipped = 0
+    failed = []
+    with futures.ProcessPoolExecutor(max_workers=config.max_workers) as executor:
+        extract_futures = {}
+        for task_type, task_id, size, task in task_data:
+            future = executor.submit(
+                extract_text, corpus, task_id, task["text"], parse_settings, previous_sources.get(task_id)
+            )
+            extract_futures[future] = task_id
+        for future in futures.as_completed(extract_futures):
+            task_id = extract_futures[future]
+            try:
+                sources[task_id], was_skipped = future.result()
+                skipped += was_skipped
+            except Exception as e:
+                _logger.error("Failed to extract text from %s" % task_id, exc_info=e)
+                failed.append(task_id)
+
+    tmp_path = sources_path + ".tmp"
+    with open(tmp_path, "w") as fp:
+        json.dump(sources, fp, indent=1, sort_keys=True)
+    os.replace(tmp_path, sources_path)
+
+    _logger.info(
+        f"Extracted text from {len(sources) - skipped} files, {skipped} unchanged, took {time.time() - t:.1f}s"
+    )
+    if failed:
+        raise RuntimeError(f"Could not extract text from {len(failed)} files: {', '.join(sorted(failed))}")
 
     text_dir = os.path.join(config.transformers_postprocess_dir, f"{corpus}")
-    if vector_generation_type == "remote":
+    if vector_generation_type == "python":
+        strixpipeline.vectorgen.generate_vectors(corpus, [task_id for _, task_id, _, _ in task_data])
+    elif vector_generation_type == "remote":
         if not config.has_attr("transformers_postprocess_server"):
             raise RuntimeError(
                 "Add transformers_postprocess_server and transformers_postprocess_server_dir to run on remote"
@@ -210,9 +763,16 @@ def do_vector_generation(corpus, vector_generation_type):
         os.system(f"./run_transformers.sh {corpus} {text_dir}")
 
 
-def merge_indices(index):
+def merge_indices(index, only_expunge_deletes=False):
+    """
+    :param only_expunge_deletes: only merge segments with deleted documents, used after incremental updates
+                                 since merging a large index down to one segment is slow
+    """
     _logger.info("Merging segments")
-    es.indices.forcemerge(index=index + "," + index + "_terms", max_num_segments=1, request_timeout=10000)
+    if only_expunge_deletes:
+        es.indices.forcemerge(index=index + "," + index + "_terms", only_expunge_deletes=True, request_timeout=10000)
+    else:
+        es.indices.forcemerge(index=index + "," + index + "_terms", max_num_segments=1, request_timeout=10000)
     _logger.info("Done merging segments")
 
 
@@ -239,6 +799,7 @@ def do_delete(corpus):
         es.indices.delete(index=index)
         _logger.info("Done deleting index")
 
+    strixpipeline.manifest.remove(corpus)
     remove_config_file(corpus)
 
 
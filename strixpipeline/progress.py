@@ -0,0 +1,182 @@
+"""
+Live progress of process_corpus for following long runs. The status is rewritten to <progress_dir>/<index>.json
+every config.progress_interval seconds and, if config.metrics_port is set, served in the Prometheus text format
+on http://127.0.0.1:<metrics_port>/metrics.
+"""
+
+import collections
+import http.server
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import time
+
+from strixpipeline.config import config
+
+_logger = logging.getLogger(__name__)
+
+# name, type, help and key in the status for the metrics that are exported
+METRICS = [
+    ("files_total", "gauge", "Files scheduled in this run", "files_total"),
+    ("files_done", "gauge", "Files processed and sent", "files_done"),
+    ("files_failed", "gauge", "Files that failed", "files_failed"),
+    ("files_remaining", "gauge", "Files not processed yet", "files_remaining"),
+    ("bytes_total", "gauge", "Size of the scheduled files", "bytes_total"),
+    ("bytes_parsed_total", "counter", "Size of the processed files", "bytes_parsed"),
+    ("docs_sent_total", "counter", "Documents and term documents indexed", "docs_sent"),
+    ("bulk_bytes_sent_total", "counter", "Size of the sent bulk requests", "bulk_bytes_sent"),
+    ("bulk_requests_in_flight", "gauge", "Bulk requests waiting for a response", "bulk_requests_in_flight"),
+    ("rejections_total", "counter", "Bulk items rejected with 429", "rejections"),
+    ("bulk_retries_total", "counter", "Bulk requests sent again after rejections", "bulk_retries"),
+    ("bulk_concurrency", "gauge", "Current limit of concurrent bulk requests", "bulk_concurrency"),
+    ("bulk_max_bytes", "gauge", "Current limit of the bulk request size", "bulk_max_bytes"),
+    ("elapsed_seconds", "gauge", "Time since the run started", "elapsed_seconds"),
+    ("eta_seconds", "gauge", "Estimated time left, from the bytes parsed so far", "eta_seconds"),
+]
+
+
+def get_progress_path(index):
+    return os.path.join(config.progress_dir, index + ".json")
+
+
+def get_rss(pid):
+    """
+    :return: resident set size of a process in bytes, or None if /proc is not available
+    """
+    try:
+        with open(f"/proc/{pid}/statm") as fp:
+            return int(fp.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class Progress:
+    """
+    :param task_data: the tasks of the run, as returned by InsertData.prepare_urls and splitindex.split_tasks. The
+                      files are counted as done when all of their tasks are
+    :param sender: the BulkSender of the run, its totals are read while it is running
+    """
+
+    def __init__(self, index, task_data, sender):
+        self.index = index
+        self.sizes = {task_id: size for _, task_id, size, _ in task_data}
+        # file -> its tasks, a large file is processed as several tasks with the task_id of the file as "file_id"
+        self.file_tasks = collections.defaultdict(set)
+        for _, task_id, _, task in task_data:
+            self.file_tasks[task.get("file_id", task_id)].add(task_id)
+        self.sender = sender
+        self.done = set()
+        self.failed = set()
+        self.start_time = time.time()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.server = None
+
+    def task_done(self, task_id):
+        self.done.add(task_id)
+
+    def task_failed(self, task_id):
+        self.failed.add(task_id)
+
+    def get_status(self):
+        elapsed = time.time() - self.start_time
+        bytes_total = sum(self.sizes.values())
+        bytes_parsed = sum(self.sizes[task_id] for task_id in self.done | self.failed)
+        eta = elapsed * (bytes_total - bytes_parsed) / bytes_parsed if bytes_parsed else None
+        files_failed = sum(1 for task_ids in self.file_tasks.values() if task_ids & self.failed)
+        files_done = sum(1 for task_ids in self.file_tasks.values() if task_ids <= self.done)
+        return {
+            "index": self.index,
+            "timestamp": time.time(),
+            "files_total": len(self.file_tasks),
+            "files_done": files_done,
+            "files_failed": files_failed,
+            "files_remaining": len(self.file_tasks) - files_done - files_failed,
+            "bytes_total": bytes_total,
+            "bytes_parsed": bytes_parsed,
+            "docs_sent": self.sender.sent_actions,
+            "bulk_bytes_sent": self.sender.sent_bytes,
+            "bulk_requests_in_flight": self.sender.in_flight,
+            "rejections": self.sender.rejections,
+            "bulk_retries": self.sender.retries,
+            "bulk_concurrency": self.sender.throttle.concurrency,
+            "bulk_max_bytes": self.sender.throttle.max_bytes.value,
+            "worker_rss": {str(p.pid): get_rss(p.pid) for p in multiprocessing.active_children()},
+            "elapsed_seconds": elapsed,
+            "eta_seconds": eta,
+        }
+
+    def get_prometheus(self):
+        status = self.get_status()
+        labels = f'index="{self.index}"'
+        lines = []
+        for name, metric_type, description, key in METRICS:
+            if status[key] is None:
+                continue
+            lines.append(f"# HELP strix_pipeline_{name} {description}")
+            lines.append(f"# TYPE strix_pipeline_{name} {metric_type}")
+            lines.append(f"strix_pipeline_{name}{{{labels}}} {status[key]}")
+        lines.append("# HELP strix_pipeline_worker_rss_bytes Resident memory of the worker processes")
+        lines.append("# TYPE strix_pipeline_worker_rss_bytes gauge")
+        for pid, rss in status["worker_rss"].items():
+            if rss is not None:
+                lines.append(f'strix_pipeline_worker_rss_bytes{{{labels},pid="{pid}"}} {rss}')
+        return "\n".join(lines) + "\n"
+
+    def write(self):
+        path = get_progress_path(self.index)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as fp:
+            json.dump(self.get_status(), fp, indent=1)
+        os.replace(tmp_path, path)
+
+    def run(self):
+        while not self.stopped.wait(config.progress_interval):
+            try:
+                self.write()
+            except Exception as e:
+                _logger.warning(f"Could not write progress ({type(e).__name__}: {e})")
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="progress", daemon=True)
+        self.thread.start()
+        if config.metrics_port:
+            self.server = http.server.ThreadingHTTPServer(("127.0.0.1", config.metrics_port), self.get_handler())
+            threading.Thread(target=self.server.serve_forever, name="metrics", daemon=True).start()
+            _logger.info(f"Serving metrics on http://127.0.0.1:{config.metrics_port}/metrics")
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+        self.write()
+
+    def get_handler(self):
+        progress = self
+
+        class MetricsHandler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == "/metrics":
+                    body = progress.get_prometheus().encode("utf-8")
+                    content_type = "text/plain; version=0.0.4"
+                elif self.path == "/status":
+                    body = json.dumps(progress.get_status()).encode("utf-8")
+                    content_type = "application/json"
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return MetricsHandler
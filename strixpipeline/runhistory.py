@@ -20,12 +20,25 @@ def put(obj):
     es.index(index=index_name, document=obj)
 
 
+def get_runs(index, size=10):
+    """
+    :return: the latest runs of index, newest first
+    """
+    if not es.indices.exists(index=index_name):
+        return []
+    res = es.search(index=index_name, query={"term": {"index": index}}, sort=[{"timestamp": "desc"}], size=size)
+    return [hit["_source"] for hit in res["hits"]["hits"]]
+
+
 def create():
     mappings = {
         "properties": {
             "elastic_hosts": {"properties": {"host": {"type": "keyword"}, "port": {"type": "long"}}},
             "index": {"type": "keyword"},
             "git_commitid": {"type": "keyword"},
+            "timestamp": {"type": "date"},
+            # per file metrics are only kept for looking at a run, not for searching
+            "files": {"type": "object", "enabled": False},
         }
     }
     settings = {
@@ -0,0 +1,110 @@
+"""
+Splitting of large files into tasks for ranges of their split_document elements, so that the documents of one file
+can be parsed by several workers. The offsets come from xmlparser.scan_split_elements and are saved as a sidecar
+index in <split_index_dir>/<corpus>/<task_id>.json, which is used again as long as the size and mtime of the file,
+split_document and text_tags are the same.
+"""
+
+import bisect
+import json
+import logging
+import os
+
+from strixpipeline import vectorstore, xmlparser
+from strixpipeline.config import config
+
+_logger = logging.getLogger(__name__)
+
+# saved in the index, indexes written by an earlier version of scan_split_elements are made again
+SCAN_VERSION = 2
+
+
+def get_index_path(corpus, task_id):
+    return os.path.join(config.split_index_dir, corpus, f"{task_id}.json")
+
+
+def get_split_index(corpus, task_id, file_path, split_document, text_tags):
+    stat = os.stat(file_path)
+    # the contexts of the elements depend on the tags as well as on the file
+    file_info = {
+        "version": SCAN_VERSION,
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "split_document": split_document,
+        "text_tags": sorted(text_tags),
+    }
+    path = get_index_path(corpus, task_id)
+    try:
+        with open(path) as fp:
+            index = json.load(fp)
+        if all(index[key] == value for key, value in file_info.items()):
+            return index
+    except (FileNotFoundError, json.JSONDecodeError, KeyError):
+        pass
+
+    index = xmlparser.scan_split_elements(file_path, split_document, text_tags)
+    index.update(file_info)
+    if config.save_split_index:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as fp:
+            json.dump(index, fp)
+        os.replace(tmp_path, path)
+    return index
+
+
+def get_ranges(index, range_bytes):
+    """
+    group the elements into ranges of about range_bytes
+    :return: list of (start, end, context of the first element, context of the last element), the prefix of the
+             first context and the suffix of the last make the range well-formed
+    """
+    ranges = []
+    for start, end, context in index["elements"]:
+        if ranges and end - ranges[-1][0] <= range_bytes:
+            ranges[-1][1] = end
+            ranges[-1][3] = context
+        else:
+            ranges.append([start, end, context, context])
+    return ranges
+
+
+def split_tasks(corpus, task_data, split_document, text_tags):
+    """
+    Replace the tasks of files larger than config.split_file_bytes with tasks for ranges of about
+    config.split_range_bytes. The range tasks are named <task_id>#<n> and have the task_id of the file as
+    "file_id", since that is what the document vectors are saved under.
+    """
+    if not config.split_file_bytes:
+        return task_data
+    split_task_data = []
+    for task_type, task_id, size, task in task_data:
+        if size < config.split_file_bytes:
+            split_task_data.append((task_type, task_id, size, task))
+            continue
+        index = get_split_index(corpus, task_id, task["text"], split_document, text_tags)
+        ranges = get_ranges(index, config.split_range_bytes)
+        if len(ranges) < 2:
+            split_task_data.append((task_type, task_id, size, task))
+            continue
+        _logger.info(f"Splitting {task['text']} into {len(ranges)} tasks")
+        # the range tasks all read the vectors of the file, so they must not import them at the same time
+        vectorstore.import_vectors(corpus, task_id)
+        element_starts = [start for start, _, _ in index["elements"]]
+        for n, (start, end, start_context, end_context) in enumerate(ranges):
+            prefix = index["contexts"][start_context][0]
+            suffix = index["contexts"][end_context][1]
+            range_task = dict(
+                task,
+                file_id=task_id,
+                range={
+                    "start": start,
+                    "end": end,
+                    "prefix": prefix.encode("latin-1"),
+                    "suffix": suffix.encode("latin-1"),
+                    # the number of the first document of the range in the file, used in the _ids
+                    "first_document": bisect.bisect_left(element_starts, start),
+                },
+            )
+            split_task_data.append((task_type, f"{task_id}#{n}", end - start, range_task))
+    return split_task_data
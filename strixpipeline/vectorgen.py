@@ -0,0 +1,128 @@
+"""
+Document vector generation in the pipeline process, as an alternative to the external run_transformers.sh.
+
+A generator is a class with `dims` and a method `encode(texts)` that returns a float32 matrix with one row per
+text. config.vector_generator is either the name of a generator in GENERATORS or "package.module:ClassName", and
+the generator is created with the dims of the sent_vector field and config.vector_generator_options as keyword
+arguments. The texts extracted by do_vector_generation are encoded in batches of config.vector_batch_size on
+config.vector_threads threads and written straight to the vector store.
+"""
+
+import hashlib
+import importlib
+import json
+import logging
+import os
+import re
+import time
+from concurrent import futures
+
+import numpy as np
+
+from strixpipeline.config import config
+import strixpipeline.vectorstore as vectorstore
+
+_logger = logging.getLogger(__name__)
+
+
+class HashingVectorGenerator:
+    """
+    Deterministic vectors from feature hashing of the lowercased words of a text. Needs no model, so it
+    can be used to test the whole pipeline offline.
+    """
+
+    word_re = re.compile(r"\w+")
+
+    def __init__(self, dims=768):
+        self.dims = dims
+
+    def encode(self, texts):
+        matrix = np.zeros((len(texts), self.dims), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for word in self.word_re.findall(text.lower()):
+                digest = hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest()
+                value = int.from_bytes(digest, "little")
+                matrix[row, (value >> 1) % self.dims] += 1.0 if value & 1 else -1.0
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        # texts without words get a zero vector
+        np.divide(matrix, norms, out=matrix, where=norms > 0)
+        return matrix
+
+
+GENERATORS = {"hashing": HashingVectorGenerator}
+
+
+def get_generator(corpus):
+    name = config.vector_generator
+    if name in GENERATORS:
+        generator_class = GENERATORS[name]
+    elif ":" in name:
+        module_name, class_name = name.split(":", 1)
+        generator_class = getattr(importlib.import_module(module_name), class_name)
+    else:
+        raise ValueError(f'Unknown vector_generator "{name}", use one of {", ".join(GENERATORS)} or "module:Class"')
+    dims = vectorstore.get_vector_field_conf(corpus)["dims"]
+    return generator_class(dims=dims, **config.vector_generator_options)
+
+
+def read_batches(texts_path, batch_size):
+    """
+    :return: generator of (doc_ids, texts) with at most batch_size documents from a texts file
+    """
+    doc_ids = []
+    texts = []
+    with open(texts_path) as fp:
+        for row in fp:
+            doc_id, text = json.loads(row)
+            doc_ids.append(doc_id)
+            texts.append(text)
+            if len(texts) == batch_size:
+                yield doc_ids, texts
+                doc_ids = []
+                texts = []
+    if texts:
+        yield doc_ids, texts
+
+
+def encode_file(generator, executor, texts_path, batch_size):
+    doc_ids = []
+    batches = []
+    for batch_ids, batch_texts in read_batches(texts_path, batch_size):
+        doc_ids.extend(batch_ids)
+        batches.append(executor.submit(generator.encode, batch_texts))
+    if not batches:
+        return doc_ids, np.zeros((0, generator.dims), dtype=np.float32)
+    return doc_ids, np.concatenate([batch.result() for batch in batches])
+
+
+def generate_vectors(corpus, task_ids):
+    """
+    Encode texts/<task_id>.jsonl for each task_id and write the vectors to the vector store. Files whose
+    vectors are newer than the texts are skipped.
+    """
+    generator = get_generator(corpus)
+    batch_size = config.vector_batch_size
+    texts_dir = os.path.join(config.transformers_postprocess_dir, corpus, "texts")
+
+    t = time.time()
+    num_docs = 0
+    skipped = 0
+    with futures.ThreadPoolExecutor(max_workers=config.vector_threads) as executor:
+        for index, task_id in enumerate(task_ids):
+            texts_path = os.path.join(texts_dir, f"{task_id}.jsonl")
+            _, npy_path, _ = vectorstore.get_paths(corpus, task_id)
+            if os.path.isfile(npy_path) and os.path.getmtime(npy_path) >= os.path.getmtime(texts_path):
+                skipped += 1
+                continue
+            try:
+                doc_ids, matrix = encode_file(generator, executor, texts_path, batch_size)
+            except Exception as e:
+                raise RuntimeError(f"Could not generate vectors for {task_id}") from e
+            vectorstore.write_vectors(corpus, task_id, doc_ids, matrix)
+            num_docs += len(doc_ids)
+            _logger.info(f"Generated {len(doc_ids)} vectors for {task_id} ({index + 1}/{len(task_ids)})")
+
+    _logger.info(
+        f"Generated {num_docs} vectors with {config.vector_generator}, {skipped} files unchanged, "
+        f"took {time.time() - t:.1f}s"
+    )
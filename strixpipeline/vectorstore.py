@@ -0,0 +1,194 @@
+"""
+Binary store for the document vectors in <transformers_postprocess_dir>/<corpus>/vectors.
+
+The vector generation writes `<task_id>.jsonl` with one `[doc_id, [float, ...]]` per row. These are imported to
+`<task_id>.npy`, a float32 matrix with one row per document, and `<task_id>.ids.json`, the doc_ids in row order.
+The import is done by the worker that first reads the vectors of a file, or for a file that is split into several
+tasks, in the main process before the tasks are scheduled. The matrix is memory-mapped read-only
+and the rows are passed on to orjson as numpy arrays, so the vectors are never converted to Python lists.
+
+The vectors can optionally be reduced to `pca_dims` dimensions with a PCA that is fitted over all vector files of
+the corpus before indexing and saved in <transformers_postprocess_dir>/<corpus>/pca.npz.
+"""
+
+import json
+import logging
+import os
+import tempfile
+
+import numpy as np
+
+from strixpipeline.config import config
+
+_logger = logging.getLogger(__name__)
+
+
+def get_vector_field_conf(corpus):
+    """
+    settings for the sent_vector field, config.vector_field is overridden by config.vector_field_modes[<mode_id>]
+    and by "vector_field" in the corpus configuration
+    """
+    corpus_conf = config.corpusconf.get_corpus_conf(corpus)
+    field_conf = {"dims": 768}
+    field_conf.update(config.vector_field)
+    field_conf.update(config.vector_field_modes.get(corpus_conf.get("mode_id"), {}))
+    field_conf.update(corpus_conf.get("vector_field", {}))
+    return field_conf
+
+
+def get_dense_vector_options(corpus):
+    """
+    :return: keyword arguments for the DenseVector mapping of sent_vector
+    """
+    field_conf = get_vector_field_conf(corpus)
+    options = {"dims": field_conf.get("pca_dims") or field_conf["dims"]}
+    for key in ("similarity", "index", "index_options", "element_type"):
+        if key in field_conf:
+            options[key] = field_conf[key]
+    return options
+
+
+def get_vectors_dir(corpus):
+    return os.path.join(config.transformers_postprocess_dir, corpus, "vectors")
+
+
+def get_paths(corpus, task_id):
+    vectors_dir = get_vectors_dir(corpus)
+    return (
+        os.path.join(vectors_dir, f"{task_id}.jsonl"),
+        os.path.join(vectors_dir, f"{task_id}.npy"),
+        os.path.join(vectors_dir, f"{task_id}.ids.json"),
+    )
+
+
+def import_jsonl(jsonl_path, npy_path, ids_path):
+    doc_ids = []
+    vectors = []
+    with open(jsonl_path) as fp:
+        for row in fp:
+            [doc_id, doc_vector] = json.loads(row)
+            doc_ids.append(doc_id)
+            vectors.append(doc_vector)
+    write(npy_path, ids_path, doc_ids, np.array(vectors, dtype=np.float32))
+
+
+def write(npy_path, ids_path, doc_ids, matrix):
+    # write to temporary files of this process first, a store is only used when both files are complete
+    vectors_dir = os.path.dirname(npy_path)
+    npy_fd, npy_tmp_path = tempfile.mkstemp(dir=vectors_dir, suffix=".npy.tmp")
+    ids_fd, ids_tmp_path = tempfile.mkstemp(dir=vectors_dir, suffix=".ids.json.tmp")
+    try:
+        with open(npy_fd, "wb") as fp:
+            np.save(fp, matrix)
+        with open(ids_fd, "w") as fp:
+            json.dump(doc_ids, fp)
+        os.replace(ids_tmp_path, ids_path)
+        os.replace(npy_tmp_path, npy_path)
+    except BaseException:
+        for tmp_path in (npy_tmp_path, ids_tmp_path):
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        raise
+
+
+def write_vectors(corpus, task_id, doc_ids, matrix):
+    """
+    store the vectors of a file directly, without a JSONL file
+    """
+    _, npy_path, ids_path = get_paths(corpus, task_id)
+    os.makedirs(os.path.dirname(npy_path), exist_ok=True)
+    write(npy_path, ids_path, doc_ids, np.asarray(matrix, dtype=np.float32))
+
+
+def needs_import(jsonl_path, npy_path):
+    if not os.path.isfile(jsonl_path):
+        return False
+    return not os.path.isfile(npy_path) or os.path.getmtime(npy_path) < os.path.getmtime(jsonl_path)
+
+
+def import_vectors(corpus, task_id):
+    """
+    import the JSONL file of a task to the binary store if it has not been imported since it was written
+    """
+    jsonl_path, npy_path, ids_path = get_paths(corpus, task_id)
+    if needs_import(jsonl_path, npy_path):
+        import_jsonl(jsonl_path, npy_path, ids_path)
+
+
+def get_pca_path(corpus):
+    return os.path.join(config.transformers_postprocess_dir, corpus, "pca.npz")
+
+
+def fit_pca(corpus, pca_dims, task_ids):
+    """
+    Fit a PCA over the vectors of the files of the corpus and save the mean and the first pca_dims principal
+    components. The covariance is accumulated file by file so the vectors never need to fit in memory at once.
+    The vectors are read from the binary stores, which are written by both the external vector generation (through
+    import_jsonl) and vectorgen.
+    :param task_ids: the files of the corpus, vectors of files that are no longer in it are not used
+    """
+    count = 0
+    vector_sum = None
+    outer_sum = None
+    for task_id in task_ids:
+        import_vectors(corpus, task_id)
+        _, npy_path, _ = get_paths(corpus, task_id)
+        if not os.path.isfile(npy_path):
+            _logger.warning(f"No vectors for {task_id}, it is not used for the PCA")
+            continue
+        matrix = np.load(npy_path, mmap_mode="r").astype(np.float64)
+        if not len(matrix):
+            continue
+        if vector_sum is None:
+            vector_sum = np.zeros(matrix.shape[1])
+            outer_sum = np.zeros((matrix.shape[1], matrix.shape[1]))
+        count += len(matrix)
+        vector_sum += matrix.sum(axis=0)
+        outer_sum += matrix.T @ matrix
+
+    if count <= pca_dims:
+        raise RuntimeError(f"Need more than {pca_dims} vectors to fit a PCA with {pca_dims} dimensions, got {count}")
+    mean = vector_sum / count
+    covariance = outer_sum / count - np.outer(mean, mean)
+    # eigh returns the eigenvalues in ascending order
+    eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+    components = eigenvectors[:, ::-1][:, :pca_dims].T
+    explained = eigenvalues[::-1][:pca_dims].sum() / eigenvalues.sum()
+
+    pca_path = get_pca_path(corpus)
+    with open(pca_path + ".tmp", "wb") as fp:
+        np.savez(fp, mean=mean.astype(np.float32), components=np.ascontiguousarray(components, dtype=np.float32))
+    os.replace(pca_path + ".tmp", pca_path)
+    return explained
+
+
+def load_pca(corpus):
+    """
+    :return: (mean, components) of the PCA for the corpus or None if there is none
+    """
+    try:
+        with np.load(get_pca_path(corpus)) as pca:
+            return pca["mean"], pca["components"]
+    except FileNotFoundError:
+        return None
+
+
+class VectorFile:
+    def __init__(self, corpus, task_id, pca=None):
+        """
+        :param pca: (mean, components) from load_pca to reduce the vectors with
+        """
+        self.pca = pca
+        import_vectors(corpus, task_id)
+        _, npy_path, ids_path = get_paths(corpus, task_id)
+        with open(ids_path) as fp:
+            self.rows = {doc_id: row for row, doc_id in enumerate(json.load(fp))}
+        self.matrix = np.load(npy_path, mmap_mode="r")
+
+    def get(self, doc_id):
+        # asarray gives a plain ndarray view of the row, orjson does not serialize the memmap subclass
+        vector = np.asarray(self.matrix[self.rows[doc_id]])
+        if self.pca is not None:
+            mean, components = self.pca
+            vector = components @ (vector - mean)
+        return vector
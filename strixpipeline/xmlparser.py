@@ -1,5 +1,10 @@
 import re
+import contextlib
+import functools
+import io
+import mmap
 import xml.etree.cElementTree as etree
+from xml.parsers import expat
 import strixpipeline.mappingutil as mappingutil
 from collections import Counter
 
@@ -11,36 +16,59 @@ def parse_pipeline_xml(
     struct_annotations=(),
     token_count_id=False,
     text_attributes=None,
-    process_token=lambda x: None,
+    process_token=None,
     add_most_common_words=False,
     save_whitespace_per_token=False,
     pos_index_attributes=(),
     text_tags=None,
+    backend="etree",
 ):
     """
+    Generator that yields each document as soon as its split_document element closes,
+    so that only one document at a time is kept in memory
+
     split_document: everything under this node will go into separate documents
     word_annotations: a map of tag names and the attributes of those tags that
               will be included in annotation on word
+    process_token: optional callback that is given a dict with the annotations of each token
+    backend: XML parser to use, one of PARSER_BACKENDS, all backends give the same result
     """
-    if text_attributes is None:
-        text_attributes = {}
-    if text_tags is None:
-        text_tags = []
-    strix_parser = StrixParser(
+    plan = ParsePlan(
         split_document,
         word_annotations,
-        struct_annotations,
-        token_count_id,
-        text_attributes,
-        process_token,
-        add_most_common_words,
-        save_whitespace_per_token,
-        pos_index_attributes,
-        text_tags,
+        struct_annotations=struct_annotations,
+        token_count_id=token_count_id,
+        text_attributes=text_attributes,
+        add_most_common_words=add_most_common_words,
+        save_whitespace_per_token=save_whitespace_per_token,
+        pos_index_attributes=pos_index_attributes,
+        text_tags=text_tags,
     )
-    iterparse_parser(file_name, strix_parser)
-    res = strix_parser.get_result()
-    return res
+    yield from parse_with_plan(file_name, plan, process_token=process_token, backend=backend)
+
+
+def parse_dump_xml(file_name, split_document, text_attributes=None, text_tags=None, backend="expat"):
+    """
+    Fast version of parse_pipeline_xml for when only the text is needed. Yields each document with "dump"
+    and, if text_attributes are given, "text_attributes", but skips everything else that is done for the tokens.
+    The expat backend has a driver of its own for this and is the fastest.
+    """
+    plan = ParsePlan(split_document, {}, text_attributes=text_attributes, text_tags=text_tags)
+    yield from parse_with_plan(file_name, plan, backend=backend, dump_only=True)
+
+
+def parse_with_plan(file_name, plan, process_token=None, backend="etree", dump_only=False):
+    """
+    Same as parse_pipeline_xml, but using a ParsePlan that has already been compiled
+    file_name: path or binary file object, e.g. a RangeReader
+    dump_only: see parse_dump_xml
+    """
+    if backend not in PARSER_BACKENDS:
+        raise ValueError(f'Unknown XML parser backend "{backend}", use one of {", ".join(PARSER_BACKENDS)}')
+    if dump_only:
+        yield from DUMP_PARSER_BACKENDS[backend](file_name, DumpParser(plan))
+    else:
+        yield from PARSER_BACKENDS[backend](file_name, StrixParser(plan, process_token))
 
 
 def parse_properties(annotation, in_value):
@@ -53,40 +81,490 @@ def parse_properties(annotation, in_value):
     return out_value
 
 
-class StrixParser:
+def compile_properties(annotation):
+    """
+    compile the regular expressions of an annotation with "properties" once, for use in parse_compiled_properties
+    """
+    compiled = []
+    for prop_name, prop in annotation["properties"].items():
+        if "properties" in prop:
+            compiled.append((prop_name, compile_properties(prop)))
+        else:
+            compiled.append((prop_name, re.compile(prop["value"])))
+    return compiled
+
+
+def parse_compiled_properties(properties, in_value):
+    out_value = {}
+    for prop_name, prop in properties:
+        if isinstance(prop, list):
+            out_value[prop_name] = parse_compiled_properties(prop, in_value)
+        else:
+            out_value[prop_name] = prop.search(in_value).group(1)
+    return out_value
+
+
+# Decoders from the raw value of an XML attribute to the value of an annotation. The decoded values are
+# cached and shared between tokens, so they must not be modified.
+
+
+def decode_value(value):
+    return value
+
+
+def split_set(value):
+    return list(filter(bool, value.split("|")))
+
+
+def strip_ranks(value):
+    return [v.split(":")[0] for v in value.split("|") if v]
+
+
+def decode_ranked_value(value):
+    values = [v.split(":")[0] for v in split_set(value)]
+    return values[0] if values else None
+
+
+def decode_node_value(value):
+    return "|".join(strip_ranks(value))
+
+
+def decode_node_set_value(value):
+    return [v for v in strip_ranks(value) if v]
+
+
+def decode_node_ranked_value(value):
+    values = decode_node_set_value(value)
+    return values[0] if values else None
+
+
+def decode_whitespace(value):
+    whitespaces = value.replace("\\s", " ").replace("\\n", "y").replace("\\t", "x")
+    return whitespaces.replace("x", "").replace("y", "\n")
+
+
+def decode_geocontext(value):
+    return value.split("|")[1:-1]
+
+
+def get_token_decoder(annotation):
+    """
+    :return: the XML attribute that the annotation is read from and a function that decodes the attribute value
+    """
+    is_set = annotation.get("set", False)
+    is_ranked = annotation.get("ranked", False)
+    if "nodeName" in annotation:
+        if is_ranked:
+            return annotation["nodeName"], decode_node_ranked_value
+        if is_set:
+            return annotation["nodeName"], decode_node_set_value
+        return annotation["nodeName"], decode_node_value
+    if is_ranked:
+        return annotation["name"], decode_ranked_value
+    if is_set:
+        return annotation["name"], split_set
+    return annotation["name"], decode_value
+
+
+def decode_struct_value(properties, is_set, value):
+    if is_set:
+        value = split_set(value)
+    if properties is not None:
+        if is_set:
+            value = [parse_compiled_properties(properties, x) for x in value]
+        else:
+            value = parse_compiled_properties(properties, value)
+    return value
+
+
+def convert_text_value(is_set, is_double, value):
+    if is_set or (value[:1] == "|" and value[-1:] == "|"):
+        value = split_set(value)
+    if is_double:
+        value = "Infinity" if value == "inf" else value
+    return value
+
+
+class ParsePlan:
+    """
+    The annotation configuration of a corpus compiled into lookup tables and one converter function per
+    annotation, so that the parser does not need to look at the configuration for each tag or token.
+    Create once per run, it can be pickled and sent to worker processes.
+    """
+
     def __init__(
         self,
         split_document,
         word_annotations,
-        struct_annotations,
-        token_count_id,
-        text_attributes,
-        process_token,
-        add_most_common_words,
-        save_whitespace_per_token,
-        pos_index_attributes,
-        text_tags,
+        struct_annotations=None,
+        token_count_id=False,
+        text_attributes=None,
+        add_most_common_words=False,
+        save_whitespace_per_token=False,
+        pos_index_attributes=(),
+        text_tags=None,
+        cache_size=65536,
     ):
-        # input
+        """
+        :param cache_size: maximum number of decoded values to cache for each annotation, see create_caches
+        """
+        if text_attributes is None:
+            text_attributes = {}
+        if text_tags is None:
+            text_tags = []
+        if not struct_annotations:
+            struct_annotations = {}
+
         self.split_document = split_document
-        self.word_annotations = word_annotations
-        self.struct_annotations = struct_annotations
         self.token_count_id = token_count_id
-        self.text_attributes = text_attributes
-        self.process_token = process_token
+        self.cache_size = cache_size
+        self.caches = None
         self.add_most_common_words = add_most_common_words
         self.save_whitespace_per_token = save_whitespace_per_token
-        self.pos_index_attributes = pos_index_attributes
-        self.text_tags = text_tags
+        self.pos_index_attributes = set(pos_index_attributes)
+        self.text_tags = set(text_tags)
+        self.has_text_attributes = bool(text_attributes)
+        self.indexed_text_attributes = {
+            name for name, text_attribute in text_attributes.items() if text_attribute.get("index", True)
+        }
+
+        # <token>-attributes, one converter for each
+        token_annotations = word_annotations.get("token", [])
+        self.annotation_names = [annotation["name"] for annotation in token_annotations]
+        self.token_decoders = [get_token_decoder(annotation) for annotation in token_annotations]
+        # when more than one annotation has the same name, the last one is used
+        self.annotation_index = {name: index for index, name in enumerate(self.annotation_names)}
+        self.pos_index_annotations = [
+            (name, index) for name, index in self.annotation_index.items() if name in self.pos_index_attributes
+        ]
+
+        # annotations on enclosing elements that are added to each token, tag -> [(name, attribute)]
+        self.context_annotations = {}
+        for tag, annotations in word_annotations.items():
+            if tag != "token":
+                self.context_annotations[tag] = [
+                    (annotation["name"], annotation.get("nodeName", annotation["name"])) for annotation in annotations
+                ]
+
+        # tag -> [(name, attribute, required, decoder)]
+        self.struct_annotations = {}
+        self.struct_pos_index = []
+        for tag, annotations in struct_annotations.items():
+            compiled = []
+            for annotation in annotations:
+                is_set = annotation.get("set", False)
+                if is_set or "properties" in annotation:
+                    properties = compile_properties(annotation) if "properties" in annotation else None
+                    decoder = functools.partial(decode_struct_value, properties, is_set)
+                else:
+                    decoder = None
+                attribute = annotation.get("nodeName", annotation["name"])
+                compiled.append((annotation["name"], attribute, "nodeName" in annotation, decoder))
+                key = tag + "_" + annotation["name"]
+                if key in self.pos_index_attributes:
+                    self.struct_pos_index.append((key, tag, annotation["name"]))
+            self.struct_annotations[tag] = compiled
+
+        # reverse lookup from XML attribute to text attribute(s), attribute -> [(name, converter)] for the
+        # split_document element and tag -> attribute -> [(name, converter)] for the elements above it
+        self.document_attributes = {}
+        self.upper_level_attributes = {}
+        for name, text_attribute in text_attributes.items():
+            converter = functools.partial(
+                convert_text_value, text_attribute.get("set", False), text_attribute.get("type", "") == "double"
+            )
+            sources = [name]
+            if text_attribute.get("nodeName") not in (None, name):
+                sources.append(text_attribute["nodeName"])
+            for source in sources:
+                self.document_attributes.setdefault(source, []).append((name, converter))
+                for tag in self.text_tags:
+                    if tag != split_document and source.startswith(tag + "_"):
+                        attribute = source[len(tag) + 1 :]
+                        self.upper_level_attributes.setdefault(tag, {}).setdefault(attribute, []).append(
+                            (name, converter)
+                        )
+
+    def create_caches(self):
+        """
+        Wrap the decoders in bounded LRU caches. Values of Sparv attributes repeat a lot, so most of them are decoded
+        only once and equal values share memory. The caches belong to the process that uses the plan and are not
+        pickled.
+        """
+        self.caches = {}
+
+        def cached(name, decoder):
+            self.caches[name] = functools.lru_cache(maxsize=self.cache_size)(decoder)
+            return self.caches[name]
+
+        self.cached_token_decoders = [
+            (attribute, cached(name, decoder))
+            for name, (attribute, decoder) in zip(self.annotation_names, self.token_decoders)
+        ]
+        self.cached_struct_annotations = {}
+        for tag, annotations in self.struct_annotations.items():
+            self.cached_struct_annotations[tag] = [
+                (name, attribute, required, cached(tag + "_" + name, decoder) if decoder is not None else None)
+                for name, attribute, required, decoder in annotations
+            ]
+        self.cached_decode_whitespace = cached("_tail", decode_whitespace)
+        self.cached_decode_geocontext = cached("sentence__geocontext", decode_geocontext)
+
+    def get_cache_stats(self):
+        """
+        :return: hits, misses and current size of each cache
+        """
+        if not self.caches:
+            return {}
+        return {name: cache.cache_info()._asdict() for name, cache in self.caches.items()}
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        for key in [
+            "caches",
+            "cached_token_decoders",
+            "cached_struct_annotations",
+            "cached_decode_whitespace",
+            "cached_decode_geocontext",
+        ]:
+            state.pop(key, None)
+        state["caches"] = None
+        return state
+
+
+def annotation_to_str(value):
+    if isinstance(value, list):
+        if len(value) > 0:
+            return mappingutil.set_delimiter + mappingutil.set_delimiter.join(value) + mappingutil.set_delimiter
+        return mappingutil.set_delimiter
+    if value is None:
+        return mappingutil.empty_set
+    return str(value)
+
+
+class StructSpan:
+    """
+    A structural element (sentence, ne, ...) in a document. Start and length are recorded while parsing and
+    are resolved onto each token when the term documents are created.
+    """
+
+    __slots__ = ("attrs", "start", "length")
+
+    def __init__(self, attrs):
+        self.attrs = attrs
+        self.start = None
+        self.length = None
+
+    def get_token_struct(self, position):
+        struct = {"attrs": self.attrs}
+        if position == self.start:
+            struct["is_start"] = True
+        struct["start_wid"] = self.start
+        if self.length is not None:
+            struct["length"] = self.length
+        return struct
+
+
+class TokenColumns:
+    """
+    Column-oriented store for the tokens of one document. Each token annotation is kept in a list with one
+    value per token and the dict for a token (used as "term" in the term documents) is only created when
+    the store is iterated.
+    """
+
+    __slots__ = ("words", "columns", "annotation_names", "context", "structs", "whitespace", "token_count_id")
+
+    def __init__(self, annotation_names, token_count_id):
+        self.words = []
+        self.annotation_names = annotation_names
+        self.columns = [[] for _ in annotation_names]
+        # annotations from enclosing elements, shared between tokens until they change
+        self.context = []
+        # the open structural elements for each token as a tuple of (tag, StructSpan), shared in the same way
+        self.structs = []
+        self.whitespace = []
+        self.token_count_id = token_count_id
+
+    def __len__(self):
+        return len(self.words)
+
+    def __iter__(self):
+        columns = list(zip(self.annotation_names, self.columns))
+        for position, word in enumerate(self.words):
+            attrs = dict(self.context[position])
+            for annotation_name, column in columns:
+                attrs[annotation_name] = column[position]
+            if self.token_count_id:
+                attrs["wid"] = position
+            for tag, span in self.structs[position]:
+                attrs[tag] = span.get_token_struct(position)
+            token = {"word": word, "attrs": attrs, "position": position}
+            whitespace = self.whitespace[position]
+            if whitespace is not None:
+                token["whitespace"] = whitespace
+            yield token
+
+
+class TextAttributeParser:
+    """
+    Base for the parsers, handles the elements in text_tags that give the text attributes of the documents
+    """
+
+    def __init__(self, plan):
+        self.plan = plan
+        self.split_document = plan.split_document
+        self.text_tags = plan.text_tags
+        self.has_text_attributes = plan.has_text_attributes
+        if plan.caches is None:
+            plan.create_caches()
+        self.decode_whitespace = plan.cached_decode_whitespace
+
+        self.current_parts = []
+        self.start_tag = ""
+        # attributes of the current document, and those given by the text_tags elements around it
+        self.part_attributes = {}
+        self.upper_level = {}
+
+    def get_result(self):
+        """
+        return the documents that have been completed since the last call
+        """
+        parts = self.current_parts
+        self.current_parts = []
+        return parts
+
+    def handle_text_tag(self, tag, attrs):
+        if not self.start_tag:
+            self.start_tag = tag
+        if tag == self.split_document:
+            self.part_attributes = {}
+            document_attributes = self.plan.document_attributes
+            for attribute, value in attrs.items():
+                for new_name, converter in document_attributes.get(attribute, ()):
+                    self.part_attributes[new_name] = converter(value)
+            for key, value in self.upper_level.items():
+                self.part_attributes[key] = value
+        else:
+            upper_level_attributes = self.plan.upper_level_attributes.get(tag, {})
+            for attribute, value in attrs.items():
+                for new_name, converter in upper_level_attributes.get(attribute, ()):
+                    self.upper_level[new_name] = converter(value)
+
+    def add_text_attributes(self, current_part):
+        if "year" not in self.part_attributes.keys():
+            # TODO do not augment data inside XML-parser
+            date_from = ""
+            date_to = ""
+            given_date = ""
+            if "datefrom" in self.part_attributes.keys():
+                date_from = self.part_attributes["datefrom"][0:4]
+            if "dateto" in self.part_attributes.keys():
+                date_to = self.part_attributes["dateto"][0:4]
+
+            if "date" in self.part_attributes.keys():
+                given_date = self.part_attributes["date"][0:4]
+            elif "datum" in self.part_attributes.keys():
+                given_date = self.part_attributes["datum"][0:4]
+            elif "topic_year" in self.part_attributes.keys():
+                given_date = self.part_attributes["topic_year"]
+
+            # TODO find permanent solution
+            if not date_from and (not date_to and (not given_date)):
+                self.part_attributes["year"] = "2050"
+            elif given_date:
+                self.part_attributes["year"] = given_date
+            elif date_to and not date_from:
+                self.part_attributes["year"] = date_to
+            elif date_from and not date_to:
+                self.part_attributes["year"] = date_from
+            elif date_from == date_to:
+                self.part_attributes["year"] = date_from
+            elif date_from != date_to:
+                self.part_attributes["year"] = date_from + ", " + date_to
+
+        indexed_text_attributes = self.plan.indexed_text_attributes
+        for key, val in self.part_attributes.items():
+            if key in indexed_text_attributes:
+                current_part["text_" + key] = val
+        current_part["text_attributes"] = self.part_attributes
+
+
+class DumpParser(TextAttributeParser):
+    """
+    Only reconstructs the text ("dump") of each document, the same way as StrixParser
+    """
+
+    def __init__(self, plan):
+        super().__init__(plan)
+        self.dump = []
+        self.dump_fragments = []
+        self.in_word = False
+        self.word_attrs = {}
+        self.current_word_content = ""
+
+    def handle_starttag(self, tag, attrs):
+        # the split_document element gives the attributes of its document also when it is not in text_tags
+        if self.has_text_attributes and (tag in self.text_tags or tag == self.split_document):
+            self.handle_text_tag(tag, attrs)
+        elif tag == "token":
+            self.in_word = True
+            self.word_attrs = attrs
+
+    def handle_endtag(self, tag):
+        if tag == self.split_document:
+            current_part = {}
+            if self.has_text_attributes:
+                self.add_text_attributes(current_part)
+            self.dump.append("".join(self.dump_fragments))
+            current_part["dump"] = self.dump
+            self.current_parts.append(current_part)
+            self.dump = []
+            self.dump_fragments = []
+        elif tag == "token":
+            token = self.current_word_content.strip()
+            if token:
+                self.dump_fragments.append(token)
+            self.in_word = False
+            self.current_word_content = ""
+
+    def handle_data(self, data, tag_value):
+        if self.in_word:
+            self.current_word_content += data.strip()
+        elif tag_value == "token":
+            for ws in self.decode_whitespace(self.word_attrs.get("_tail", "")):
+                self.dump_fragments.append(ws)
+                if "\n" in ws[-1]:
+                    self.dump.append("".join(self.dump_fragments))
+                    self.dump_fragments = []
+
+
+class StrixParser(TextAttributeParser):
+    def __init__(self, plan, process_token=None):
+        super().__init__(plan)
+        # input
+        self.token_count_id = plan.token_count_id
+        self.process_token = process_token
+        self.add_most_common_words = plan.add_most_common_words
+        self.save_whitespace_per_token = plan.save_whitespace_per_token
+        self.struct_annotations = plan.cached_struct_annotations
+        self.context_annotations = plan.context_annotations
+        self.token_decoders = plan.cached_token_decoders
+        self.decode_geocontext = plan.cached_decode_geocontext
+        self.annotation_names = plan.annotation_names
+        self.annotation_index = plan.annotation_index
 
         # state
-        self.current_part_tokens = []
         self.current_word_annotations = {}
-        self.all_word_level_annotations = set()
+        # tag -> StructSpan for the open structural elements
         self.current_struct_annotations = {}
+        # cached tuple of current_struct_annotations, None when it needs to be recreated
+        self.open_spans = ()
+        # spans that have not seen their first token yet
+        self.new_spans = []
 
-        self.current_token_lookup = []
-        self.dump = [""]
+        self.tokens = TokenColumns(self.annotation_names, self.token_count_id)
+        self.dump = []
+        self.dump_fragments = []
         self.token_count = 0
         self.lines = [[0]]
         self.most_common_words = []
@@ -97,162 +575,76 @@ class StrixParser:
         self.word_attrs = {}
         self.current_word_content = ""
 
-        self.current_parts = []
-        self.start_tag = ""
-
-    def get_result(self):
-        return self.current_parts
-
     def handle_starttag(self, tag, attrs):
-        if self.text_attributes and tag in self.text_tags:
-            if not self.start_tag:
-                self.start_tag = tag
-                self.upper_level = {}
-            if tag == self.split_document:
-                self.part_attributes = {}
-                for text_attr, text_attr_obj in self.text_attributes.items():
-                    for attribute in attrs:
-                        if attribute == text_attr:
-                            node_name = attribute
-                            new_name = attribute
-                        elif attribute == text_attr_obj.get("nodeName", None):
-                            node_name = attribute
-                            new_name = text_attr
-                        else:
-                            continue
-
-                        text_attr_value = attrs[node_name]
-                        if self.text_attributes[new_name].get("set", False) or (
-                            text_attr_value[0] == "|" and text_attr_value[-1] == "|"
-                        ):
-                            text_attr_value = list(filter(bool, text_attr_value.split("|")))
-                        if self.text_attributes[new_name].get("type", "") == "double":
-                            text_attr_value = "Infinity" if text_attr_value == "inf" else text_attr_value
-                        self.part_attributes[new_name] = text_attr_value
-                for key, value in self.upper_level.items():
-                    self.part_attributes[key] = value
-            if tag != self.split_document:
-                for text_attr, text_attr_obj in self.text_attributes.items():
-                    for attribute in attrs:
-                        if tag + "_" + attribute == text_attr:
-                            node_name = attribute
-                            new_name = text_attr
-                        elif tag + "_" + attribute == text_attr_obj.get("nodeName", None):
-                            node_name = attribute
-                            new_name = text_attr
-                        else:
-                            continue
-
-                        text_attr_value = attrs[node_name]
-                        if self.text_attributes[new_name].get("set", False) or (
-                            text_attr_value[0] == "|" and text_attr_value[-1] == "|"
-                        ):
-                            text_attr_value = list(filter(bool, text_attr_value.split("|")))
-                        if self.text_attributes[new_name].get("type", "") == "double":
-                            text_attr_value = "Infinity" if text_attr_value == "inf" else text_attr_value
-                        self.upper_level[new_name] = text_attr_value
+        # the split_document element gives the attributes of its document also when it is not in text_tags
+        if self.has_text_attributes and (tag in self.text_tags or tag == self.split_document):
+            self.handle_text_tag(tag, attrs)
         elif tag == "token":
             self.in_word = True
             self.word_attrs = attrs
 
         elif tag in self.struct_annotations:
-            self.current_struct_annotations[tag] = {"attrs": {}}
-            annotations = self.struct_annotations[tag]
+            struct_attrs = {}
+            span = StructSpan(struct_attrs)
+            self.current_struct_annotations[tag] = span
+            self.new_spans.append(span)
+            self.open_spans = None
 
-            for annotation in annotations:
-                annotation_name = annotation["name"]
-                if "nodeName" in annotation:
-                    a_value = attrs[annotation["nodeName"]]
-                elif annotation_name in attrs:
-                    a_value = attrs[annotation_name]
+            for annotation_name, attribute, required, decoder in self.struct_annotations[tag]:
+                if required or attribute in attrs:
+                    a_value = attrs[attribute]
                 else:
                     break
+                if decoder is not None:
+                    a_value = decoder(a_value)
+                struct_attrs[annotation_name] = a_value
 
-                if annotation.get("set", False):
-                    a_value = list(filter(bool, a_value.split("|")))
-
-                if "properties" in annotation:
-                    if annotation.get("set", False):
-                        a_value = [parse_properties(annotation, x) for x in a_value]
-                    else:
-                        a_value = parse_properties(annotation, a_value)
-
-                self.current_struct_annotations[tag]["attrs"][annotation_name] = a_value
-
-        elif tag != "token" and tag in self.word_annotations:
-            annotations = self.word_annotations[tag]
-
-            for annotation in annotations:
-                annotation_name = annotation["name"]
-                if "nodeName" in annotation:
-                    a_value = attrs[annotation["nodeName"]]
-                else:
-                    a_value = attrs[annotation_name]
-
-                self.current_word_annotations[annotation_name] = a_value
+        elif tag in self.context_annotations:
+            # copy since the previous dict is shared by the tokens already seen
+            current_word_annotations = dict(self.current_word_annotations)
+            for annotation_name, attribute in self.context_annotations[tag]:
+                current_word_annotations[annotation_name] = attrs[attribute]
+            self.current_word_annotations = current_word_annotations
 
     def handle_endtag(self, tag):
         if tag == self.split_document:
             current_part = {}
-            if self.text_attributes:
-                if "year" not in self.part_attributes.keys():
-                    # TODO do not augment data inside XML-parser
-                    date_from = ""
-                    date_to = ""
-                    given_date = ""
-                    if "datefrom" in self.part_attributes.keys():
-                        date_from = self.part_attributes["datefrom"][0:4]
-                    if "dateto" in self.part_attributes.keys():
-                        date_to = self.part_attributes["dateto"][0:4]
-
-                    if "date" in self.part_attributes.keys():
-                        given_date = self.part_attributes["date"][0:4]
-                    elif "datum" in self.part_attributes.keys():
-                        given_date = self.part_attributes["datum"][0:4]
-                    elif "topic_year" in self.part_attributes.keys():
-                        given_date = self.part_attributes["topic_year"]
-
-                    # TODO find permanent solution
-                    if not date_from and (not date_to and (not given_date)):
-                        self.part_attributes["year"] = "2050"
-                    elif given_date:
-                        self.part_attributes["year"] = given_date
-                    elif date_to and not date_from:
-                        self.part_attributes["year"] = date_to
-                    elif date_from and not date_to:
-                        self.part_attributes["year"] = date_from
-                    elif date_from == date_to:
-                        self.part_attributes["year"] = date_from
-                    elif date_from != date_to:
-                        self.part_attributes["year"] = date_from + ", " + date_to
-
-                for key, val in self.part_attributes.items():
-                    if key in self.text_attributes and self.text_attributes[key].get("index", True):
-                        current_part["text_" + key] = val
-                current_part["text_attributes"] = self.part_attributes
-
-            current_part["token_lookup"] = self.current_token_lookup
+            if self.has_text_attributes:
+                self.add_text_attributes(current_part)
+
+            tokens = self.tokens
+            current_part["token_lookup"] = tokens
 
             if len(self.lines[-1]) == 1 and self.lines[-1][0] != -1:
                 self.lines[-1] = [self.lines[-1][0], self.token_count - 1]
+            self.dump.append("".join(self.dump_fragments))
             current_part["dump"] = self.dump
             current_part["lines"] = self.lines
 
-            current_part["word_count"] = len(self.current_part_tokens)
+            current_part["word_count"] = len(tokens)
 
-            current_part["text"] = mappingutil.token_separator.join(map(lambda x: x["token"], self.current_part_tokens))
+            current_part["text"] = mappingutil.token_separator.join(tokens.words)
 
-            for key in self.all_word_level_annotations:
-                res = mappingutil.token_separator.join(
-                    map(
-                        lambda x: x.get(key, mappingutil.empty_set),
-                        self.current_part_tokens,
+            if len(tokens) > 0:
+                if self.token_count_id:
+                    current_part["wid"] = mappingutil.token_separator.join(map(str, range(len(tokens))))
+                for annotation_name, index in self.plan.pos_index_annotations:
+                    current_part["pos_" + annotation_name] = mappingutil.token_separator.join(
+                        map(annotation_to_str, tokens.columns[index])
                     )
-                )
-                if key == "wid":
-                    current_part["wid"] = res
-                elif key in self.pos_index_attributes:
-                    current_part["pos_" + key] = res
+                for key, tag_name, annotation_name in self.plan.struct_pos_index:
+                    values = []
+                    found = False
+                    for open_spans in tokens.structs:
+                        for span_tag, span in open_spans:
+                            if span_tag == tag_name and annotation_name in span.attrs:
+                                values.append(annotation_to_str(span.attrs[annotation_name]))
+                                found = True
+                                break
+                        else:
+                            values.append(mappingutil.empty_set)
+                    if found:
+                        current_part["pos_" + key] = mappingutil.token_separator.join(values)
 
             if self.ner_tags:
                 current_part["ner_tags"] = ", ".join(
@@ -279,120 +671,65 @@ class StrixParser:
             self.current_parts.append(current_part)
 
             self.token_count = 0
-            self.current_part_tokens = []
-            self.current_token_lookup = []
+            self.tokens = TokenColumns(self.annotation_names, self.token_count_id)
             self.current_word_annotations = {}
             self.current_struct_annotations = {}
-            self.dump = [""]
+            self.open_spans = ()
+            self.new_spans = []
+            self.dump = []
+            self.dump_fragments = []
             self.lines = [[0]]
             self.most_common_words = []
             self.ner_tags = []
             self.geo_locations = []
-            self.all_word_level_annotations = set()
             # self.start_tag = ""
         elif tag in self.struct_annotations:
-            # at close we go thorugh each <w>-tag in the structural element and
-            # assign the length (which can't be known until the element closes)
-            # TODO do this once for ALL structural elements to avoid editing each token more than one
-            #   (save all structs and do this when the document is done)
-            if "length" in self.current_struct_annotations[tag]:
-                annotation_length = self.current_struct_annotations[tag]["length"]
-                for token in self.current_token_lookup[-annotation_length:]:
-                    token["attrs"][tag]["length"] = annotation_length
-            del self.current_struct_annotations[tag]
+            # the length can't be known until the element closes, the tokens get it from the span
+            # when the term documents are created
+            span = self.current_struct_annotations.pop(tag)
+            if span.start is not None:
+                span.length = self.token_count - span.start
+            self.open_spans = None
         elif tag == "token":
             token = self.current_word_content.strip()
             if len(token) != 0:
-                token_data = dict(self.current_word_annotations)
-                for annotation in self.word_annotations.get("token", []):
-                    annotation_name = annotation["name"]
-                    if "nodeName" in annotation:
-                        annotation_value = []
-                        for lemma in self.word_attrs.get(annotation["nodeName"]).split("|"):
-                            if lemma and (":" not in lemma):
-                                annotation_value.append(lemma)
-                            elif lemma and (":" in lemma):
-                                annotation_value.append(lemma.split(":")[0])
-                            else:
-                                pass
-                        if annotation_value:
-                            annotation_value = "|".join(annotation_value)
-                        else:
-                            annotation_value = ""
-                    else:
-                        annotation_value = self.word_attrs.get(annotation_name)
-                    if annotation.get("set", False) or annotation.get("ranked", False):
-                        annotation_value = list(filter(bool, annotation_value.split("|")))
-                    if annotation.get("ranked", False):
-                        values = [v.split(":")[0] for v in annotation_value]
-                        annotation_value = values[0] if values else None
-                    token_data[annotation_name] = annotation_value
-                    self.all_word_level_annotations.add(annotation_name)
+                tokens = self.tokens
+                word_attrs = self.word_attrs
+                for (attribute, decoder), column in zip(self.token_decoders, tokens.columns):
+                    column.append(decoder(word_attrs.get(attribute)))
 
-                if self.token_count_id:
-                    token_data["wid"] = self.token_count
-                    self.all_word_level_annotations.add("wid")
-
-                struct_data = {}
-                struct_annotations = {}
-                for tag_name, annotations in self.current_struct_annotations.items():
-                    struct_annotations[tag_name] = {"attrs": annotations["attrs"]}
-                    if "start_wid" not in annotations:
-                        annotations["start_wid"] = token_data["wid"]
-                        annotations["start_pos"] = self.token_count
-                        struct_annotations[tag_name]["is_start"] = True
-                    struct_annotations[tag_name]["start_wid"] = annotations["start_wid"]
-                    annotations["length"] = self.token_count - annotations["start_pos"] + 1
-
-                    if "attrs" in annotations:
-                        for annotation_name, v in annotations["attrs"].items():
-                            x = tag_name + "_" + annotation_name
-                            struct_data[x] = v
-                            self.all_word_level_annotations.add(x)
-
-                self.process_token(token_data)
-                all_data = dict(token_data)
-                all_data.update(struct_data)
-
-                if "ne_name" in struct_data.keys():
-                    if struct_data["ne_type"] != "MSR" and (struct_data["ne_type"] != "TME"):
-                        self.ner_tags.append(struct_data["ne_name"])
-                if "sentence__geocontext" in struct_data:
-                    locations = struct_data["sentence__geocontext"].split("|")[1:-1]
+                if self.new_spans:
+                    for span in self.new_spans:
+                        span.start = self.token_count
+                    self.new_spans = []
+                if self.open_spans is None:
+                    self.open_spans = tuple(self.current_struct_annotations.items())
+
+                tokens.words.append(token)
+                tokens.context.append(self.current_word_annotations)
+                tokens.structs.append(self.open_spans)
+                tokens.whitespace.append(None)
+
+                if self.process_token is not None:
+                    self.process_token(self.get_token_data(-1))
+
+                ne = self.current_struct_annotations.get("ne")
+                if ne is not None and "name" in ne.attrs:
+                    if ne.attrs["type"] != "MSR" and (ne.attrs["type"] != "TME"):
+                        self.ner_tags.append(ne.attrs["name"])
+                sentence = self.current_struct_annotations.get("sentence")
+                if sentence is not None and "_geocontext" in sentence.attrs:
+                    locations = self.decode_geocontext(sentence.attrs["_geocontext"])
                     self.geo_locations.extend(locations)
 
-                str_attrs = {}
-                for attr, v in sorted(all_data.items()):
-                    if isinstance(v, list):
-                        v = (
-                            mappingutil.set_delimiter + mappingutil.set_delimiter.join(v) + mappingutil.set_delimiter
-                            if len(v) > 0
-                            else mappingutil.set_delimiter
-                        )
-                    if v is None:
-                        v = mappingutil.empty_set
-                    str_attrs[attr] = str(v)
-
-                self.dump[-1] += token
-                str_attrs["token"] = token
-                self.current_part_tokens.append(str_attrs)
-
-                token_lookup_data = dict(token_data)
-                token_lookup_data.update(struct_annotations)
-                self.current_token_lookup.append(
-                    {
-                        "word": token,
-                        "attrs": token_lookup_data,
-                        "position": self.token_count,
-                    }
-                )
+                self.dump_fragments.append(token)
 
                 self.token_count += 1
 
-                if self.add_most_common_words and token_data["pos"] == "NN":
-                    if "lemma" in token_data:
+                if self.add_most_common_words and self.get_token_value("pos") == "NN":
+                    if "lemma" in self.annotation_index or "lemma" in self.current_word_annotations:
                         annotation_value = [
-                            lemma for lemma in token_data["lemma"] if ":" not in lemma and ("--" not in lemma)
+                            lemma for lemma in self.get_token_value("lemma") if ":" not in lemma and ("--" not in lemma)
                         ]
                     else:
                         annotation_value = [
@@ -406,25 +743,40 @@ class StrixParser:
             self.in_word = False
             self.current_word_content = ""
 
+    def get_token_value(self, annotation_name):
+        """
+        value of an annotation on the last token
+        """
+        index = self.annotation_index.get(annotation_name)
+        if index is not None:
+            return self.tokens.columns[index][-1]
+        return self.current_word_annotations[annotation_name]
+
+    def get_token_data(self, position):
+        token_data = dict(self.tokens.context[position])
+        for annotation_name, column in zip(self.annotation_names, self.tokens.columns):
+            token_data[annotation_name] = column[position]
+        if self.token_count_id:
+            token_data["wid"] = position if position >= 0 else len(self.tokens) + position
+        return token_data
+
     def handle_data(self, data, tag_value):
         if self.in_word:
             self.current_word_content += data.strip()
         else:
             if tag_value == "token":
-                whitespaces = (
-                    self.word_attrs.get("_tail", "").replace("\\s", " ").replace("\\n", "y").replace("\\t", "x")
-                )
-                whitespaces = whitespaces.replace("x", "").replace("y", "\n")
+                whitespaces = self.decode_whitespace(self.word_attrs.get("_tail", ""))
                 for ws in whitespaces:
-                    self.dump[-1] += ws
+                    self.dump_fragments.append(ws)
                     if self.save_whitespace_per_token:
                         try:
-                            self.current_token_lookup[-1]["whitespace"] = ws
+                            self.tokens.whitespace[-1] = ws
                         except IndexError:
                             pass
                     if "\n" in ws[-1]:
                         current_token = self.token_count - 1
-                        self.dump.append("")
+                        self.dump.append("".join(self.dump_fragments))
+                        self.dump_fragments = []
                         [begin] = self.lines[-1]
                         if begin == current_token + 1:
                             self.lines[-1] = [-1]
@@ -433,17 +785,158 @@ class StrixParser:
                         self.lines.append([current_token + 1])
 
 
-def iterparse_parser(file_name, strix_parser):
-    book_iter = etree.iterparse(file_name, events=("start", "end"))
+ROOT_RE = re.compile(rb"<([^?!/\s>][^\s/>]*)[^>]*>")
+ATTRIBUTE_RE = re.compile(rb"""([^\s=/]+)\s*=\s*("[^"]*"|'[^']*')""")
+
+
+def get_tag_name(start_tag):
+    return re.match(rb"<([^\s/>]+)", start_tag).group(1)
+
 
-    # solution from http://infix.se/2009/05/10/text-safe-xml-processing-with-iterparse
-    def delayediter(iterable):
-        iterable = iter(iterable)
-        prev = next(iterable)
-        for item in iterable:
-            yield prev
-            prev = item
+def scan_split_elements(file_name, split_document, text_tags=()):
+    """
+    Fast pre-scan that finds the byte offsets of the split_document elements of a file, so that ranges of them can
+    be parsed in parallel with RangeReader. Outside the split_document elements the start and end tags of all
+    elements are looked at, and inside them only the end tag is searched for. Comments and CDATA containing tags
+    outside the split_document elements, or containing its end tag inside them, are not supported.
+
+    Each range needs the elements around it. A context has the bytes to put before a range: everything up to and
+    including the root start tag, an empty element for each text_tags element seen so far with the attributes it has
+    given (a parser keeps them until they are given again) and the start tags of all open elements. And the bytes to
+    put after a range: the end tags of the open elements. A range that starts at an element with one context and
+    ends at an element with another is made well-formed by the prefix of the first and the suffix of the second.
+
+    :return: {"elements": [[start, end, context], ...], "contexts": [[prefix, suffix], ...]} where the bytes of
+             the contexts are decoded as latin-1 so that they can be saved as JSON
+    """
+    split = split_document.encode("utf-8")
+    text_tag_names = {tag.encode("utf-8") for tag in text_tags}
+    tag_re = re.compile(rb"<(/?)([^\s/>!?]+)(?=[\s/>])[^>]*>")
+    split_end_re = re.compile(rb"</" + re.escape(split) + rb"\s*>")
+
+    elements = []
+    contexts = []
+    # (prefix, suffix) -> number of the context, elements in the same surroundings share one
+    context_numbers = {}
+    with open(file_name, "rb") as fp:
+        if not fp.seek(0, io.SEEK_END):
+            return {"elements": elements, "contexts": contexts}
+        with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            root = ROOT_RE.search(data)
+            if root is None or root.group(0).endswith(b"/>"):
+                return {"elements": elements, "contexts": contexts}
+            header = data[: root.end()]
+            root_end = b"</" + root.group(1) + b">"
+
+            # tag -> attribute -> quoted value, for the text tags seen so far
+            seen = {}
+            # start tags of the open elements
+            stack = []
+            context = None
+            pos = root.end()
+            while True:
+                match = tag_re.search(data, pos)
+                if match is None:
+                    break
+                closing, tag = match.groups()
+                start_tag = match.group(0)
+                self_closing = start_tag.endswith(b"/>")
+                if tag == split and not closing:
+                    if context is None:
+                        prefix = header
+                        for seen_tag, attrs in seen.items():
+                            prefix += b"<" + seen_tag + b"".join(b" " + k + b"=" + v for k, v in attrs.items()) + b"/>"
+                        prefix += b"".join(stack)
+                        suffix = (
+                            b"".join(b"</" + get_tag_name(open_tag) + b">" for open_tag in reversed(stack)) + root_end
+                        )
+                        context = context_numbers.get((prefix, suffix))
+                        if context is None:
+                            context = context_numbers[(prefix, suffix)] = len(contexts)
+                            contexts.append([prefix.decode("latin-1"), suffix.decode("latin-1")])
+                    if self_closing:
+                        end = match.end()
+                    else:
+                        end_match = split_end_re.search(data, match.end())
+                        if end_match is None:
+                            raise ValueError(f"{file_name}: <{split_document}> at byte {match.start()} is not closed")
+                        end = end_match.end()
+                    elements.append([match.start(), end, context])
+                    pos = end
+                    continue
+
+                if closing:
+                    if stack and get_tag_name(stack[-1]) == tag:
+                        stack.pop()
+                else:
+                    if tag in text_tag_names:
+                        attrs = seen.pop(tag, {})
+                        attrs.update(ATTRIBUTE_RE.findall(start_tag))
+                        seen[tag] = attrs
+                    if not self_closing:
+                        stack.append(start_tag)
+                context = None
+                pos = match.end()
+    return {"elements": elements, "contexts": contexts}
+
+
+class RangeReader(io.RawIOBase):
+    """
+    Binary file object with prefix, then the bytes start:end of file_name and then suffix, for parsing a range of
+    split_document elements found by scan_split_elements
+    """
+
+    def __init__(self, file_name, start, end, prefix=b"", suffix=b""):
+        super().__init__()
+        self.fp = open(file_name, "rb")
+        self.fp.seek(start)
+        self.end = end
+        self.segments = [prefix, None, suffix]
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while self.segments:
+            segment = self.segments[0]
+            if segment is None:
+                size = min(len(buffer), self.end - self.fp.tell())
+                if size > 0:
+                    return self.fp.readinto(memoryview(buffer)[:size])
+            elif segment:
+                size = min(len(buffer), len(segment))
+                buffer[:size] = segment[:size]
+                self.segments[0] = segment[size:]
+                return size
+            self.segments.pop(0)
+        return 0
+
+    def close(self):
+        self.fp.close()
+        super().close()
+
+
+def open_source(file_name):
+    """
+    open a path for the parsers, file objects are used as they are
+    """
+    if isinstance(file_name, (str, bytes)) or hasattr(file_name, "__fspath__"):
+        return open(file_name, "rb")
+    return contextlib.nullcontext(file_name)
+
+
+# solution from http://infix.se/2009/05/10/text-safe-xml-processing-with-iterparse
+def delayediter(iterable):
+    iterable = iter(iterable)
+    prev = next(iterable)
+    for item in iterable:
         yield prev
+        prev = item
+    yield prev
+
+
+def iterparse_parser(file_name, strix_parser):
+    book_iter = etree.iterparse(file_name, events=("start", "end"))
 
     book_iter = delayediter(book_iter)
 
@@ -457,6 +950,159 @@ def iterparse_parser(file_name, strix_parser):
             if element.tail:
                 strix_parser.handle_data(element.tail, element.tag)
             root.clear()
+            if strix_parser.current_parts:
+                yield from strix_parser.get_result()
+
+        if event == "start":
+            strix_parser.handle_starttag(element.tag, element.attrib)
+
+
+def lxml_parser(file_name, strix_parser):
+    """
+    Same as iterparse_parser but using lxml, which needs to be installed separately
+    """
+    try:
+        from lxml import etree as lxml_etree
+    except ImportError:
+        raise RuntimeError('lxml is not installed, install it or use another XML parser backend (e.g. "etree")')
+
+    book_iter = delayediter(
+        lxml_etree.iterparse(file_name, events=("start", "end"), huge_tree=True, remove_comments=True, remove_pis=True)
+    )
+
+    _, root = next(book_iter)
+    strix_parser.handle_starttag(root.tag, root.attrib)
+    for event, element in book_iter:
+        if event == "end":
+            if element.text:
+                strix_parser.handle_data(element.text, element.tag)
+            strix_parser.handle_endtag(element.tag)
+            if element.tail:
+                strix_parser.handle_data(element.tail, element.tag)
+            # clearing the root while lxml is building the tree is not safe, instead clear the
+            # element and remove the siblings that are already handled
+            element.clear(keep_tail=False)
+            parent = element.getparent()
+            if parent is not None:
+                while element.getprevious() is not None:
+                    del parent[0]
+            if strix_parser.current_parts:
+                yield from strix_parser.get_result()
 
         if event == "start":
             strix_parser.handle_starttag(element.tag, element.attrib)
+
+
+def expat_parser(file_name, strix_parser, chunk_size=1 << 20):
+    """
+    Drives strix_parser directly from pyexpat callbacks without creating any elements. The callbacks
+    are made in the same order as in iterparse_parser: when an element closes its text is given, then the
+    end tag and then the tail, which is only complete when the next tag starts or ends.
+    """
+    parser = expat.ParserCreate()
+    parser.buffer_text = True
+    parser.buffer_size = 1 << 16
+
+    # text of each open element
+    stack = []
+    # the last closed element and its tail, waiting for the next tag
+    pending = []
+    data_target = []
+
+    def flush_pending():
+        tag, text, tail = pending.pop()
+        if text:
+            strix_parser.handle_data("".join(text), tag)
+        strix_parser.handle_endtag(tag)
+        if tail:
+            strix_parser.handle_data("".join(tail), tag)
+
+    def start_element(tag, attrs):
+        nonlocal data_target
+        if pending:
+            flush_pending()
+        data_target = []
+        stack.append((tag, data_target))
+        strix_parser.handle_starttag(tag, attrs)
+
+    def end_element(_):
+        nonlocal data_target
+        if pending:
+            flush_pending()
+        tag, text = stack.pop()
+        data_target = []
+        pending.append((tag, text, data_target))
+
+    def character_data(data):
+        data_target.append(data)
+
+    parser.StartElementHandler = start_element
+    parser.EndElementHandler = end_element
+    parser.CharacterDataHandler = character_data
+
+    with open_source(file_name) as fp:
+        while True:
+            chunk = fp.read(chunk_size)
+            parser.Parse(chunk, not chunk)
+            if not chunk:
+                break
+            if strix_parser.current_parts:
+                yield from strix_parser.get_result()
+    if pending:
+        flush_pending()
+    yield from strix_parser.get_result()
+
+
+def expat_dump_parser(file_name, dump_parser, chunk_size=1 << 20):
+    """
+    Same as expat_parser for a DumpParser, which only needs the text of the tokens and the tails after them,
+    so no text is kept for the other elements
+    """
+    parser = expat.ParserCreate()
+    parser.buffer_text = True
+    parser.buffer_size = 1 << 16
+
+    handle_starttag = dump_parser.handle_starttag
+    handle_endtag = dump_parser.handle_endtag
+    handle_data = dump_parser.handle_data
+    # text inside a token or after the end of a token, waiting for the next tag
+    text = []
+    after_token = False
+
+    def start_element(tag, attrs):
+        nonlocal after_token
+        if text:
+            handle_data("".join(text), "token" if after_token else None)
+            text.clear()
+        after_token = False
+        handle_starttag(tag, attrs)
+
+    def end_element(tag):
+        nonlocal after_token
+        if text:
+            handle_data("".join(text), "token" if after_token else tag)
+            text.clear()
+        handle_endtag(tag)
+        after_token = tag == "token"
+
+    def character_data(data):
+        if after_token or dump_parser.in_word:
+            text.append(data)
+
+    parser.StartElementHandler = start_element
+    parser.EndElementHandler = end_element
+    parser.CharacterDataHandler = character_data
+
+    with open_source(file_name) as fp:
+        while True:
+            chunk = fp.read(chunk_size)
+            parser.Parse(chunk, not chunk)
+            if not chunk:
+                break
+            if dump_parser.current_parts:
+                yield from dump_parser.get_result()
+    yield from dump_parser.get_result()
+
+
+PARSER_BACKENDS = {"etree": iterparse_parser, "expat": expat_parser, "lxml": lxml_parser}
+DUMP_PARSER_BACKENDS = {"etree": iterparse_parser, "expat": expat_dump_parser, "lxml": lxml_parser}
@@ -0,0 +1,182 @@
+import os
+import sys
+import tempfile
+
+import pytest
+import yaml
+
+BENCHMARKS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks")
+sys.path.insert(0, BENCHMARKS_DIR)
+
+# strixpipeline.config reads the configuration when it is imported, so it has to be written first
+WORK_DIR = tempfile.mkdtemp(prefix="strix-pipeline-tests-")
+FAKE_ES_PORT = 9251
+os.makedirs(os.path.join(WORK_DIR, "settings", "corpora"))
+with open(os.path.join(WORK_DIR, "config.yaml"), "w") as fp:
+    yaml.dump(
+        {
+            "elastic_hosts": [{"host": "127.0.0.1", "port": FAKE_ES_PORT, "scheme": "http"}],
+            "base_dir": WORK_DIR,
+            "texts_dir": os.path.join(WORK_DIR, "texts"),
+            "settings_dir": os.path.join(WORK_DIR, "settings"),
+            "transformers_postprocess_dir": os.path.join(WORK_DIR, "transformers"),
+            "number_of_shards": 1,
+            "number_of_replicas": 0,
+            "terms_number_of_shards": 1,
+            "terms_number_of_replicas": 0,
+        },
+        fp,
+    )
+sys.argv += ["--config", os.path.join(WORK_DIR, "config.yaml")]
+
+import sparv_generator  # noqa: E402
+from run_benchmarks import InlineCorpusConfig  # noqa: E402
+from strixpipeline.config import config  # noqa: E402
+
+CORPUS_ID = "test"
+
+
+@pytest.fixture(scope="session")
+def corpus_conf():
+    corpus_conf = sparv_generator.get_corpus_config(CORPUS_ID)
+    config.set_attr("corpusconf", InlineCorpusConfig(corpus_conf))
+    return corpus_conf
+
+
+@pytest.fixture(scope="session")
+def parse_plan(corpus_conf):
+    import strixpipeline.insertdata as insertdata
+
+    return insertdata.InsertData(CORPUS_ID).parse_plan
+
+
+@pytest.fixture(scope="session")
+def sparv_file(tmp_path_factory):
+    """
+    a generated Sparv file with the text_tags of the corpus configuration of sparv_generator
+    """
+    path = tmp_path_factory.mktemp("sparv") / "generated.xml"
+    sparv_generator.SparvGenerator(docs=20, tokens=300, vocabulary_size=500, ne_rate=0.1).write(str(path), CORPUS_ID)
+    return str(path)
+
+
+@pytest.fixture
+def config_attrs():
+    """
+    set config attributes for a test, they are restored afterwards
+    """
+    saved = {}
+
+    def set_attrs(**attrs):
+        for name, value in attrs.items():
+            saved.setdefault(name, config.config.get(name))
+            config.set_attr(name, value)
+
+    yield set_attrs
+    for name, value in saved.items():
+        config.set_attr(name, value)
+
+
+@pytest.fixture
+def fake_cluster():
+    """
+    benchmarks/fake_bulk_server.py on the port in the configuration, it records the items that it answers. The
+    connections are closed after each response, since the clients in the pipeline modules outlive the server.
+    """
+    import fake_bulk_server
+
+    server, cluster = fake_bulk_server.start(
+        FAKE_ES_PORT, keep_alive=False, capacity=100, latency=0.001, record_items=True
+    )
+    yield cluster
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(scope="session")
+def get_documents():
+    """
+    :return: function that gives the documents from xmlparser as a list that can be compared, token_lookup may be
+             any iterable
+    """
+
+    def get_documents(documents):
+        result = []
+        for document in documents:
+            document = dict(document)
+            if "token_lookup" in document:
+                document["token_lookup"] = list(document["token_lookup"])
+            result.append(document)
+        return result
+
+    return get_documents
+
+
+class CorpusRun:
+    """
+    pipeline.do_run on generated files in texts_dir, see the corpus_run fixture
+    """
+
+    def __init__(self, texts_dir):
+        self.texts_dir = texts_dir
+        # the index behind the corpus alias
+        self.index_name = f"{CORPUS_ID}_1"
+        # the runhistory entries of the runs
+        self.runs = []
+
+    def write(self, file_name, docs=2, seed=1):
+        path = os.path.join(self.texts_dir, file_name)
+        sparv_generator.SparvGenerator(docs=docs, tokens=40, vocabulary_size=100, seed=seed).write(path, CORPUS_ID)
+        return path
+
+    def run(self, **kwargs):
+        from strixpipeline import pipeline
+
+        return pipeline.do_run(CORPUS_ID, **kwargs)
+
+
+@pytest.fixture
+def corpus_run(corpus_conf, config_attrs, tmp_path, monkeypatch):
+    """
+    runs pipeline.do_run without the index management, which fake_cluster does not have, and without vectors
+    """
+    from strixpipeline import pipeline
+
+    texts_dir = tmp_path / "texts" / CORPUS_ID
+    texts_dir.mkdir(parents=True)
+    config_attrs(
+        texts_dir=str(tmp_path / "texts"),
+        manifest_dir=str(tmp_path / "manifests"),
+        checkpoint_dir=str(tmp_path / "checkpoints"),
+        progress_dir=str(tmp_path / "progress"),
+        split_index_dir=str(tmp_path / "split_indexes"),
+        max_workers=1,
+        max_tasks_in_flight=2,
+    )
+    corpus_run = CorpusRun(str(texts_dir))
+
+    class CreateIndex:
+        def __init__(self, index):
+            pass
+
+        def enable_insert_settings(self):
+            pass
+
+        def enable_postinsert_settings(self):
+            pass
+
+    class VectorFile:
+        def __init__(self, *args, **kwargs):
+            pass
+
+        def get(self, doc_id):
+            return None
+
+    monkeypatch.setattr(pipeline.elasticapi, "get_index_from_alias", lambda alias: corpus_run.index_name)
+    monkeypatch.setattr(pipeline.create_index_strix, "CreateIndex", CreateIndex)
+    monkeypatch.setattr(pipeline, "merge_indices", lambda index, only_expunge_deletes=False: None)
+    monkeypatch.setattr(pipeline.strixpipeline.runhistory, "create", lambda: None)
+    monkeypatch.setattr(pipeline.strixpipeline.runhistory, "put", corpus_run.runs.append)
+    # the workers are forked and get the stub too
+    monkeypatch.setattr(pipeline.insert_data_strix.vectorstore, "VectorFile", VectorFile)
+    return corpus_run
@@ -0,0 +1,216 @@
+"""
+create_batches, and BulkSender and Throttle against benchmarks/fake_bulk_server.py
+"""
+
+import collections
+import multiprocessing
+import os
+import queue
+
+import orjson
+import pytest
+
+from strixpipeline import bulk, checkpoint
+
+
+@pytest.fixture(autouse=True)
+def fast_retries(config_attrs):
+    config_attrs(bulk_backoff=0.001, bulk_backoff_max=0.01, bulk_min_bytes=1024, bulk_poll_thread_pool=0)
+
+
+def get_batches(task_id, num_batches, actions_per_batch=20):
+    batches = []
+    for n in range(num_batches):
+        actions = [
+            {"_index": "test", "_id": f"{task_id}-{n}-{i}", "_source": {"text": "x" * 100}}
+            for i in range(actions_per_batch)
+        ]
+        body = b"".join(bulk.serialize_action(action) for action in actions)
+        batches.append((task_id, body, len(actions)))
+    return batches
+
+
+def get_actions(num_actions, text_size=100):
+    return [{"_index": "test", "_id": f"a-{i}", "_source": {"text": "x" * text_size}} for i in range(num_actions)]
+
+
+def test_batch_max_bytes():
+    actions = get_actions(10)
+    action_bytes = len(bulk.serialize_action(actions[0]))
+    batches = list(bulk.create_batches(actions, 3 * action_bytes + 1, 1000))
+    assert [num_actions for _, num_actions in batches] == [3, 3, 3, 1]
+    assert all(len(body) <= 3 * action_bytes + 1 for body, _ in batches)
+    assert b"".join(body for body, _ in batches) == b"".join(bulk.serialize_action(action) for action in actions)
+
+
+def test_batch_max_actions():
+    batches = list(bulk.create_batches(get_actions(10), 1 << 20, 4))
+    assert [num_actions for _, num_actions in batches] == [4, 4, 2]
+
+
+def test_batch_shared_max_bytes():
+    actions = get_actions(6)
+    action_bytes = len(bulk.serialize_action(actions[0]))
+    max_bytes = multiprocessing.Value("q", 4 * action_bytes, lock=False)
+    batches = bulk.create_batches(actions, max_bytes, 1000)
+    assert next(batches)[1] == 4
+    # read again for the next request
+    max_bytes.value = action_bytes
+    assert [num_actions for _, num_actions in batches] == [1, 1]
+
+
+def test_large_action_is_sent_alone():
+    actions = get_actions(2) + get_actions(1, text_size=1000) + get_actions(2)
+    batches = list(bulk.create_batches(actions, 500, 1000))
+    assert [num_actions for _, num_actions in batches] == [2, 1, 2]
+    assert len(batches[1][0]) > 1000
+
+
+def test_batch_framing():
+    actions = get_actions(2) + [{"_op_type": "delete", "_index": "test", "_id": "d-0"}]
+    [(body, num_actions)] = bulk.create_batches(actions, 1 << 20, 1000)
+    assert num_actions == 3
+    assert body.endswith(b"\n")
+    lines = body.split(b"\n")[:-1]
+    assert len(lines) == 5
+    assert orjson.loads(lines[0]) == {"index": {"_index": "test", "_id": "a-0"}}
+    assert orjson.loads(lines[1]) == {"text": "x" * 100}
+    assert orjson.loads(lines[2]) == {"index": {"_index": "test", "_id": "a-1"}}
+    assert orjson.loads(lines[4]) == {"delete": {"_index": "test", "_id": "d-0"}}
+    assert bulk.split_actions(body) == [bulk.serialize_action(action) for action in actions]
+
+
+def send(batches, throttle=None, dead_letters=None):
+    send_queue = queue.Queue()
+    sender = bulk.BulkSender(send_queue, throttle=throttle, dead_letters=dead_letters)
+    sender.start()
+    for batch in batches:
+        send_queue.put(batch)
+    sender.stop()
+    return sender
+
+
+def test_throttle_shrinks_and_recovers(fake_cluster):
+    throttle = bulk.Throttle(concurrency=4, max_concurrency=4, max_bytes=64 * 1024)
+    fake_cluster.reject_rate = 0.5
+    sender = send(get_batches("pressure", 20), throttle=throttle)
+    assert sender.rejections > 0
+    assert throttle.decreases > 0
+    assert throttle.concurrency < 4
+    assert throttle.max_bytes.value < 64 * 1024
+
+    fake_cluster.reject_rate = 0.0
+    sender = send(get_batches("recovery", 60), throttle=throttle)
+    assert sender.rejections == 0
+    assert throttle.concurrency == 4
+    assert throttle.max_bytes.value == 64 * 1024
+
+
+def test_rejected_request_is_throttled(fake_cluster):
+    throttle = bulk.Throttle(concurrency=1, max_concurrency=1)
+    fake_cluster.rejected_requests = 1
+    sender = send(get_batches("task", 1), throttle=throttle)
+    assert fake_cluster.stats["requests"] == 2
+    assert sender.rejections == 20
+    assert sender.retries == 1
+    assert throttle.decreases == 1
+    assert sender.counts["task"] == 20
+
+
+def test_only_rejected_items_are_resent(fake_cluster, config_attrs):
+    config_attrs(bulk_max_retries=20)
+    fake_cluster.reject_rate = 0.3
+    batches = get_batches("task", 10)
+    sender = send(batches)
+
+    statuses = collections.defaultdict(list)
+    for _id, status in fake_cluster.items:
+        statuses[_id].append(status)
+    assert len(statuses) == 200
+    assert sender.retries > 0
+    for _id, item_statuses in statuses.items():
+        # sent until it was indexed, and never again
+        assert item_statuses[-1] == 201
+        assert item_statuses.count(201) == 1
+    assert sender.counts["task"] == 200
+    assert sender.sent_actions == 200
+    assert not sender.errors
+
+
+def test_dead_letters(fake_cluster, config_attrs, tmp_path):
+    config_attrs(bulk_max_retries=2)
+    fake_cluster.reject_rate = 1.0
+    dead_letters = checkpoint.DeadLetters("test", path=str(tmp_path / "test.dead.jsonl"))
+    send(get_batches("ok", 1) + get_batches("failing", 2), dead_letters=dead_letters)
+
+    entries = list(checkpoint.read_dead_letters(dead_letters.path))
+    assert dead_letters.count == len(entries) == 60
+    assert collections.Counter(entry["task_id"] for entry in entries) == {"ok": 20, "failing": 40}
+    assert all(entry["status"] == 429 for entry in entries)
+    # each item was sent once and retried twice
+    assert len(fake_cluster.items) == 3 * 60
+    assert list(checkpoint.read_dead_letters(dead_letters.path, task_ids=["ok"]))[0]["lines"].startswith(
+        '{"index":{"_id":"ok-0-0"'
+    )
+
+
+def test_interrupted_replay(fake_cluster, config_attrs, tmp_path, monkeypatch):
+    from strixpipeline import pipeline
+
+    config_attrs(checkpoint_dir=str(tmp_path / "checkpoints"))
+    monkeypatch.setattr(pipeline.elasticapi, "get_index_from_alias", lambda alias: "test_1")
+    path = checkpoint.get_dead_letter_path("test")
+    # the replay of a and b was interrupted after b had failed again, then c failed in a run
+    replaying = checkpoint.DeadLetters("test", "test_1", path=path + ".replay")
+    dead_letters = checkpoint.DeadLetters("test", "test_1")
+    for task_id, body, _ in get_batches("a", 1, 2) + get_batches("b", 1, 2):
+        replaying.write(task_id, 429, "rejected", body)
+    for task_id, body, _ in get_batches("b", 1, 2):
+        dead_letters.write(task_id, 503, "unavailable", body)
+    for task_id, body, _ in get_batches("c", 1, 2):
+        dead_letters.write(task_id, 429, "rejected", body)
+
+    assert pipeline.replay_dead_letters("test") == 0
+    assert sorted(_id for _id, _ in fake_cluster.items) == ["a-0-0", "a-0-1", "b-0-0", "b-0-1", "c-0-0", "c-0-1"]
+    assert not os.path.exists(path)
+    assert not os.path.exists(path + ".replay")
+
+
+def test_replay_skips_other_index(fake_cluster, config_attrs, tmp_path, monkeypatch):
+    from strixpipeline import pipeline
+
+    config_attrs(checkpoint_dir=str(tmp_path / "checkpoints"))
+    monkeypatch.setattr(pipeline.elasticapi, "get_index_from_alias", lambda alias: "test_2")
+    old_index = checkpoint.DeadLetters("test", "test_1")
+    for task_id, body, _ in get_batches("old", 1, 2):
+        old_index.write(task_id, 429, "rejected", body)
+    current_index = checkpoint.DeadLetters("test", "test_2")
+    for task_id, body, _ in get_batches("current", 1, 2):
+        current_index.write(task_id, 429, "rejected", body)
+
+    assert pipeline.replay_dead_letters("test") == 0
+    assert sorted(_id for _id, _ in fake_cluster.items) == ["current-0-0", "current-0-1"]
+    assert not os.path.exists(checkpoint.get_dead_letter_path("test"))
+
+
+def test_replay_after_rebuild(fake_cluster, corpus_run, config_attrs):
+    from strixpipeline import pipeline
+
+    config_attrs(bulk_max_retries=0)
+    corpus_run.write("a.xml")
+    fake_cluster.reject_rate = 1.0
+    assert corpus_run.run() == ["a.xml"]
+    entries = list(checkpoint.read_dead_letters(checkpoint.get_dead_letter_path("test")))
+    assert entries
+    assert all(entry["index"] == "test_1" for entry in entries)
+
+    # a new index with a changed version of the file
+    corpus_run.index_name = "test_2"
+    corpus_run.write("a.xml", docs=1, seed=2)
+    fake_cluster.reject_rate = 0.0
+    assert corpus_run.run() == []
+    assert not os.path.exists(checkpoint.get_dead_letter_path("test"))
+
+    num_items = len(fake_cluster.items)
+    assert pipeline.replay_dead_letters("test") == 0
+    assert len(fake_cluster.items) == num_items
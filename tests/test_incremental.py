@@ -0,0 +1,95 @@
+"""
+Change detection with the manifest and incremental runs against benchmarks/fake_bulk_server.py
+"""
+
+import os
+
+from strixpipeline import insertdata, manifest, pipeline
+
+CORPUS_ID = "test"
+
+
+def get_entry(file_hash):
+    return {"path": "/texts/x.xml", "size": 1, "mtime": 1, "hash": file_hash}
+
+
+def get_processed_files(run):
+    return sorted(name for result in run["files"] for name in result.get("files", [result.get("file")]))
+
+
+def get_deleted_files(fake_cluster):
+    return sorted(name for _, query in fake_cluster.delete_queries for name in query["terms"]["original_file"])
+
+
+def test_get_changes():
+    previous = manifest.create("test_1", "config", {name: get_entry(name) for name in ["same", "changed", "removed"]})
+    files = {"same": get_entry("same"), "changed": get_entry("other"), "added": get_entry("added")}
+    changed, removed = manifest.get_changes(previous, files)
+    assert sorted(changed) == ["added", "changed"]
+    assert removed == ["removed"]
+
+
+def test_incremental_run(fake_cluster, corpus_run):
+    for name in ["a.xml", "b.xml", "c.xml"]:
+        corpus_run.write(name)
+    assert corpus_run.run() == []
+    assert get_processed_files(corpus_run.runs[-1]) == ["a.xml", "b.xml", "c.xml"]
+    assert not fake_cluster.delete_queries
+    assert pipeline.can_update_incrementally(CORPUS_ID)
+
+    corpus_run.write("b.xml", docs=3, seed=2)
+    corpus_run.write("d.xml")
+    os.remove(os.path.join(corpus_run.texts_dir, "c.xml"))
+    assert corpus_run.run(incremental=True) == []
+    assert get_processed_files(corpus_run.runs[-1]) == ["b.xml", "d.xml"]
+    assert get_deleted_files(fake_cluster) == ["b.xml", "c.xml", "d.xml"]
+    assert sorted(manifest.load(CORPUS_ID)["files"]) == ["a.xml", "b.xml", "d.xml"]
+
+    # nothing has changed
+    fake_cluster.delete_queries.clear()
+    assert corpus_run.run(incremental=True) == []
+    assert get_processed_files(corpus_run.runs[-1]) == []
+    assert not fake_cluster.delete_queries
+
+
+def test_config_change_forces_full_run(fake_cluster, corpus_run, config_attrs):
+    corpus_run.write("a.xml")
+    assert corpus_run.run() == []
+    assert pipeline.can_update_incrementally(CORPUS_ID)
+
+    config_attrs(term_storage="sentence")
+    assert not pipeline.can_update_incrementally(CORPUS_ID)
+
+
+def test_other_index_forces_full_run(fake_cluster, corpus_run):
+    corpus_run.write("a.xml")
+    assert corpus_run.run() == []
+    corpus_run.index_name = "test_2"
+    assert not pipeline.can_update_incrementally(CORPUS_ID)
+
+
+def test_failed_files_are_left_out_of_manifest(fake_cluster, corpus_run, config_attrs):
+    # a failing file in a group would fail the other files of the group too
+    config_attrs(group_task_bytes=0)
+    corpus_run.write("a.xml")
+    corpus_run.write("b.xml")
+    fake_cluster.refused_ids.add(insertdata.get_document_id(CORPUS_ID, "b.xml", 1, "text1"))
+    assert corpus_run.run() == ["b.xml"]
+    assert sorted(manifest.load(CORPUS_ID)["files"]) == ["a.xml"]
+
+    # the next incremental run sends the failed file again
+    fake_cluster.refused_ids.clear()
+    assert corpus_run.run(incremental=True) == []
+    assert get_processed_files(corpus_run.runs[-1]) == ["b.xml"]
+    assert get_deleted_files(fake_cluster) == ["b.xml"]
+    assert sorted(manifest.load(CORPUS_ID)["files"]) == ["a.xml", "b.xml"]
+
+
+def test_delete_documents_by_file(fake_cluster):
+    file_names = [f"f{i}.xml" for i in range(5)]
+    pipeline.delete_documents_by_file(CORPUS_ID, file_names, chunk_size=2)
+    assert fake_cluster.delete_queries == [
+        ("test,test_terms", {"terms": {"original_file": ["f0.xml", "f1.xml"]}}),
+        ("test,test_terms", {"terms": {"original_file": ["f2.xml", "f3.xml"]}}),
+        ("test,test_terms", {"terms": {"original_file": ["f4.xml"]}}),
+    ]
@@ -0,0 +1,121 @@
+"""
+The packed term documents of term_storage "sentence" and "window"
+"""
+
+import copy
+
+import pytest
+import sparv_generator
+from run_benchmarks import InlineCorpusConfig
+
+from strixpipeline import insertdata
+
+CORPUS_ID = "test"
+
+
+@pytest.fixture
+def insert_data(corpus_conf):
+    return insertdata.InsertData(CORPUS_ID)
+
+
+def get_tokens(sentence_lengths, ne_positions):
+    """
+    tokens like the token_lookup of xmlparser, in sentences of the given lengths, the tokens at ne_positions
+    are in one ne element
+    """
+    tokens = []
+    position = 0
+    ne_span = {"attrs": {"name": "Göteborg"}, "start_wid": ne_positions[0], "length": len(ne_positions)}
+    for sentence_index, length in enumerate(sentence_lengths):
+        sentence_start = position
+        for _ in range(length):
+            sentence = {"attrs": {"id": f"s{sentence_index}"}, "start_wid": sentence_start, "length": length}
+            if position == sentence_start:
+                sentence["is_start"] = True
+            attrs = {"pos": "NN", "wid": position, "sentence": sentence}
+            if position in ne_positions:
+                attrs["ne"] = dict(ne_span)
+            token = {"word": f"w{position}", "attrs": attrs, "position": position}
+            if position % 2 == 0:
+                token["whitespace"] = " "
+            tokens.append(token)
+            position += 1
+    return tokens
+
+
+def get_packed(insert_data, tokens):
+    return list(insert_data.create_term_positions("text1", "a.xml", iter(tokens), (CORPUS_ID, "a.xml", 0, "text1")))
+
+
+def test_window(insert_data, config_attrs):
+    config_attrs(term_storage="window", term_window_size=4)
+    # the sentences do not start new documents
+    documents = get_packed(insert_data, get_tokens([3, 7], ne_positions=[0]))
+    assert [document["length"] for document in documents] == [4, 4, 2]
+    assert [document["start"] for document in documents] == [0, 4, 8]
+    assert [document["positions"] for document in documents] == [
+        {"gte": 0, "lte": 3},
+        {"gte": 4, "lte": 7},
+        {"gte": 8, "lte": 9},
+    ]
+    assert documents[1]["terms"]["word"] == ["w4", "w5", "w6", "w7"]
+    assert documents[2]["terms"]["attrs"]["wid"] == [8, 9]
+
+
+def test_sentence(insert_data, config_attrs):
+    config_attrs(term_storage="sentence", term_window_size=4)
+    # a sentence longer than the window is split
+    documents = get_packed(insert_data, get_tokens([3, 6, 1], ne_positions=[0]))
+    assert [(document["start"], document["length"]) for document in documents] == [(0, 3), (3, 4), (7, 2), (9, 1)]
+    assert [document["positions"] for document in documents] == [
+        {"gte": 0, "lte": 2},
+        {"gte": 3, "lte": 6},
+        {"gte": 7, "lte": 8},
+        {"gte": 9, "lte": 9},
+    ]
+    assert documents[1]["terms"]["attrs"]["sentence"][0]["is_start"]
+    assert documents[3]["terms"]["attrs"]["sentence"][0]["attrs"] == {"id": "s2"}
+
+
+def test_sentence_needs_sentence_struct(corpus_conf, config_attrs):
+    corpus_conf = copy.deepcopy(corpus_conf)
+    del corpus_conf["analyze_config"]["struct_attributes"]["sentence"]
+    config_attrs(term_storage="sentence", corpusconf=InlineCorpusConfig(corpus_conf))
+    with pytest.raises(ValueError, match="sentence"):
+        insertdata.InsertData(CORPUS_ID)
+
+
+def test_missing_attributes_are_null(insert_data, config_attrs):
+    config_attrs(term_storage="window", term_window_size=8)
+    tokens = get_tokens([4], ne_positions=[1, 2])
+    [document] = get_packed(insert_data, tokens)
+    assert document["terms"]["attrs"]["ne"] == [None, tokens[1]["attrs"]["ne"], tokens[2]["attrs"]["ne"], None]
+    assert document["terms"]["whitespace"] == [" ", None, " ", None]
+    assert document["terms"]["attrs"]["pos"] == ["NN"] * 4
+    assert document["_index"] == "test_terms"
+    assert document["_id"] == insertdata.get_document_id(CORPUS_ID, "a.xml", 0, "text1", 0)
+    assert (document["doc_id"], document["original_file"]) == ("text1", "a.xml")
+
+
+def test_document_ids(corpus_conf, config_attrs, tmp_path, monkeypatch):
+    class VectorFile:
+        def __init__(self, *args, **kwargs):
+            pass
+
+        def get(self, doc_id):
+            return None
+
+    monkeypatch.setattr(insertdata.vectorstore, "VectorFile", VectorFile)
+    texts_dir = tmp_path / "texts" / CORPUS_ID
+    (texts_dir / "sub").mkdir(parents=True)
+    config_attrs(texts_dir=str(tmp_path / "texts"), term_storage="token")
+    generator = sparv_generator.SparvGenerator(docs=2, tokens=10, vocabulary_size=20, seed=1)
+    # the same file name in a subdirectory, and a file where the doc_id is repeated
+    paths = [texts_dir / "a.xml", texts_dir / "sub" / "a.xml", texts_dir / "b.xml"]
+    for path in paths:
+        generator.write(str(path), CORPUS_ID)
+    paths[2].write_text(paths[2].read_text().replace('_id="text1"', '_id="text0"'))
+
+    insert_data = insertdata.InsertData(CORPUS_ID)
+    ids = [action["_id"] for path in paths for action in insert_data.process_work("a", {"text": str(path)})]
+    assert len(set(ids)) == len(ids)
@@ -0,0 +1,127 @@
+"""
+The stage timing of a run, and the live progress of a run and its Prometheus exposition
+"""
+
+import json
+import re
+import types
+
+import pytest
+
+from strixpipeline import metrics, progress
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self):
+        return self.now
+
+    def perf_counter(self):
+        return self.now
+
+
+def get_sender():
+    throttle = types.SimpleNamespace(concurrency=2, max_bytes=types.SimpleNamespace(value=4096))
+    return types.SimpleNamespace(sent_actions=0, sent_bytes=0, in_flight=0, rejections=0, retries=0, throttle=throttle)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(progress, "time", clock)
+    return clock
+
+
+def test_nested_timed(clock, monkeypatch):
+    monkeypatch.setattr(metrics, "time", clock)
+    timer = metrics.StageTimer()
+
+    def parse():
+        for i in range(3):
+            clock.now += 1
+            yield i
+
+    def convert(items):
+        for item in timer.timed("parse", items):
+            clock.now += 2
+            yield item
+
+    with timer.stage("process"):
+        for _ in timer.timed("convert", convert(parse())):
+            clock.now += 4
+    # outside of any stage
+    clock.now += 8
+
+    seconds = timer.get_result()["seconds"]
+    assert seconds == {"parse": 3, "convert": 6, "process": 12}
+    assert sum(seconds.values()) == clock.now - 8
+
+
+def test_nested_stages(clock, monkeypatch):
+    monkeypatch.setattr(metrics, "time", clock)
+    timer = metrics.StageTimer()
+    with timer.stage("outer"):
+        clock.now += 1
+        with timer.stage("inner"):
+            clock.now += 2
+        clock.now += 3
+    assert timer.get_result()["seconds"] == {"outer": 4, "inner": 2}
+
+
+def test_progress(clock, config_attrs, tmp_path):
+    config_attrs(progress_dir=str(tmp_path / "progress"))
+    # f3 is split into two tasks
+    task_data = [
+        ("text", "f1", 100, {}),
+        ("text", "f2", 300, {}),
+        ("text", "f3#0", 300, {"file_id": "f3"}),
+        ("text", "f3#1", 300, {"file_id": "f3"}),
+    ]
+    sender = get_sender()
+    run_progress = progress.Progress("test", task_data, sender)
+
+    status = run_progress.get_status()
+    assert (status["files_total"], status["files_remaining"], status["bytes_total"]) == (3, 3, 1000)
+    assert status["eta_seconds"] is None
+    assert "eta_seconds" not in run_progress.get_prometheus()
+
+    clock.now = 10.0
+    run_progress.task_done("f1")
+    run_progress.task_failed("f2")
+    sender.sent_actions = 50
+    sender.rejections = 3
+    status = run_progress.get_status()
+    assert (status["files_done"], status["files_failed"], status["files_remaining"]) == (1, 1, 1)
+    assert status["bytes_parsed"] == 400
+    assert status["docs_sent"] == 50
+    assert status["elapsed_seconds"] == 10.0
+    # 400 of 1000 bytes in 10 seconds
+    assert status["eta_seconds"] == pytest.approx(15.0)
+
+    text = run_progress.get_prometheus()
+    assert text.endswith("\n")
+    lines = text.splitlines()
+    assert 'strix_pipeline_files_done{index="test"} 1' in lines
+    assert 'strix_pipeline_files_failed{index="test"} 1' in lines
+    assert 'strix_pipeline_docs_sent_total{index="test"} 50' in lines
+    assert 'strix_pipeline_rejections_total{index="test"} 3' in lines
+    assert 'strix_pipeline_bulk_max_bytes{index="test"} 4096' in lines
+    assert 'strix_pipeline_eta_seconds{index="test"} 15.0' in lines
+    assert "# TYPE strix_pipeline_docs_sent_total counter" in lines
+    assert "# TYPE strix_pipeline_files_remaining gauge" in lines
+    for line in lines:
+        if not line.startswith("#"):
+            assert re.fullmatch(r'strix_pipeline_\w+\{index="test"(,pid="\d+")?\} [-+.\deE]+', line)
+
+    run_progress.write()
+    with open(progress.get_progress_path("test")) as fp:
+        assert json.load(fp)["files_done"] == 1
+
+    run_progress.task_done("f3#0")
+    status = run_progress.get_status()
+    assert (status["files_done"], status["files_remaining"], status["bytes_parsed"]) == (1, 1, 700)
+    run_progress.task_done("f3#1")
+    status = run_progress.get_status()
+    assert (status["files_done"], status["files_failed"], status["files_remaining"]) == (2, 1, 0)
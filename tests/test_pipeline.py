@@ -0,0 +1,196 @@
+"""
+Grouping of small files in process_corpus, the text extraction for the vectors and the comparison of runs
+"""
+
+import json
+import os
+
+import pytest
+
+from strixpipeline import checkpoint, pipeline
+
+
+class FakeInsertData:
+    """
+    gives five actions per file, the files in failing raise an exception after two of them
+    """
+
+    index = "test"
+
+    def __init__(self, failing=()):
+        self.failing = set(failing)
+
+    def process(self, task_type, task_id, task, timer=None):
+        for i in range(5):
+            if task_id in self.failing and i == 2:
+                raise ValueError(f"{task_id} is broken")
+            yield {"_index": "test", "_id": f"{task_id}-{i}", "_source": {"i": i}}
+
+
+def get_tasks(sizes):
+    return [("text", f"f{i}", size, {"text": f"/texts/f{i}.xml"}) for i, size in enumerate(sizes)]
+
+
+def get_sizes(group):
+    return sum(size for _, _, size, _ in group)
+
+
+def test_group_sizes_are_balanced(config_attrs):
+    config_attrs(group_task_bytes=1000, group_max_files=1000)
+    task_data = pipeline.order_tasks(get_tasks(range(1, 101)))
+    groups = pipeline.group_tasks(task_data, 1)
+    assert sorted(task_id for group in groups for _, task_id, _, _ in group) == sorted(t[1] for t in task_data)
+    # the files are at most 100 bytes, so a group is closed when it has more than 900
+    for group in groups[:-1]:
+        assert 900 < get_sizes(group) <= 1000
+    assert get_sizes(groups[-1]) <= 1000
+
+
+def test_group_max_files(config_attrs):
+    config_attrs(group_task_bytes=1000, group_max_files=10)
+    groups = pipeline.group_tasks(get_tasks([1] * 45), 1)
+    assert [len(group) for group in groups] == [10, 10, 10, 10, 5]
+
+
+def test_large_files_are_not_grouped(config_attrs):
+    config_attrs(group_task_bytes=1000, group_max_files=1000)
+    task_data = get_tasks([5000, 2000] + [10] * 200)
+    groups = pipeline.group_tasks(task_data, 1)
+    assert groups[0] == [task_data[0]]
+    assert groups[1] == [task_data[1]]
+    assert all(len(group) > 1 for group in groups[2:])
+
+
+@pytest.mark.parametrize("max_workers", [1, 2, 4])
+def test_enough_groups_for_the_workers(config_attrs, max_workers):
+    config_attrs(group_task_bytes=1000, group_max_files=1000)
+    groups = pipeline.group_tasks(get_tasks([10] * 40), max_workers)
+    assert len(groups) >= 4 * max_workers
+    assert len({len(group) for group in groups}) == 1
+
+
+def test_no_grouping(config_attrs):
+    config_attrs(group_task_bytes=0)
+    task_data = get_tasks([10] * 5)
+    assert pipeline.group_tasks(task_data, 1) == [[task] for task in task_data]
+
+
+@pytest.fixture
+def journal(config_attrs, tmp_path):
+    config_attrs(checkpoint_dir=str(tmp_path / "checkpoints"), progress_dir=str(tmp_path / "progress"))
+    files = {f"f{i}.xml": {"hash": f"hash{i}"} for i in range(12)}
+    journal = checkpoint.Journal("test", files)
+    journal.start("test_1", "config", False)
+    return journal
+
+
+@pytest.fixture
+def grouped(config_attrs):
+    # groups of three files
+    config_attrs(group_task_bytes=1000, group_max_files=3, max_workers=1, max_tasks_in_flight=2)
+
+
+def test_file_failing_in_group(fake_cluster, journal, grouped):
+    completed, failed = pipeline.process_corpus(FakeInsertData(failing=["f4"]), get_tasks([10] * 12), journal=journal)
+    assert list(failed) == ["f4"]
+    assert isinstance(failed["f4"], ValueError)
+    assert all(len(result["task_ids"]) == 3 for result in completed.values())
+    assert set(checkpoint.load("test")["files"]) == {f"f{i}.xml" for i in range(12)} - {"f4.xml"}
+    # the actions of the other files in the group are sent
+    assert sum(result["count"] for result in completed.values()) == 11 * 5 + 2
+
+
+def test_bulk_error_fails_group(fake_cluster, journal, grouped):
+    fake_cluster.refused_ids.add("f4-3")
+    task_data = get_tasks([10] * 12)
+    groups = pipeline.group_tasks(pipeline.order_tasks(task_data), 1)
+    [group] = [group for group in groups if "f4" in [task_id for _, task_id, _, _ in group]]
+    members = {task_id for _, task_id, _, _ in group}
+    assert len(members) == 3
+
+    completed, failed = pipeline.process_corpus(FakeInsertData(), task_data, journal=journal)
+    assert set(failed) == members
+    assert not any("f4" in result["task_ids"] for result in completed.values())
+    journaled = set(checkpoint.load("test")["files"])
+    assert journaled == {f"f{i}.xml" for i in range(12)} - {f"{task_id}.xml" for task_id in members}
+
+
+PARSE_SETTINGS = {"split": "text", "text_tags": ["text"]}
+
+
+@pytest.fixture
+def texts_path(config_attrs, tmp_path):
+    config_attrs(transformers_postprocess_dir=str(tmp_path / "transformers"))
+    os.makedirs(tmp_path / "transformers" / "test" / "texts")
+    return str(tmp_path / "transformers" / "test" / "texts" / "generated.jsonl")
+
+
+def read_texts(texts_path):
+    with open(texts_path) as fp:
+        return [json.loads(line) for line in fp]
+
+
+def test_extract_text_skips_unchanged_files(sparv_file, texts_path, monkeypatch):
+    source, skipped = pipeline.extract_text("test", "generated", sparv_file, PARSE_SETTINGS)
+    assert not skipped
+    texts = read_texts(texts_path)
+    assert [doc_id for doc_id, _ in texts] == [f"text{i}" for i in range(20)]
+
+    def parse_dump_xml(*args, **kwargs):
+        raise AssertionError("an unchanged file was parsed again")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(pipeline.xmlparser, "parse_dump_xml", parse_dump_xml)
+        assert pipeline.extract_text("test", "generated", sparv_file, PARSE_SETTINGS, source) == (source, True)
+    assert read_texts(texts_path) == texts
+
+    # other parse settings
+    settings = {"split": "text", "text_tags": None}
+    _, skipped = pipeline.extract_text("test", "generated", sparv_file, settings, source)
+    assert not skipped
+
+
+def test_extract_text_interrupted(sparv_file, texts_path, monkeypatch):
+    pipeline.extract_text("test", "generated", sparv_file, PARSE_SETTINGS)
+    texts = read_texts(texts_path)
+
+    def parse_dump_xml(*args, **kwargs):
+        yield {"text_attributes": {"_id": "text0"}, "dump": ["ett", "två"]}
+        raise KeyboardInterrupt()
+
+    monkeypatch.setattr(pipeline.xmlparser, "parse_dump_xml", parse_dump_xml)
+    with pytest.raises(KeyboardInterrupt):
+        pipeline.extract_text("test", "generated", sparv_file, PARSE_SETTINGS)
+    assert read_texts(texts_path) == texts
+    assert os.listdir(os.path.dirname(texts_path)) == ["generated.jsonl"]
+
+
+def get_run(timestamp, tokens_per_s, parse_seconds, incremental=False):
+    return {
+        "timestamp": timestamp,
+        "incremental": incremental,
+        "throughput": {"tokens_per_s": tokens_per_s},
+        "stages": {"process": 10.0},
+        "file_stages": {"parse": parse_seconds},
+        "counts": {"tokens": 1000},
+    }
+
+
+def test_compare_runs(monkeypatch, capsys):
+    runs = [get_run(4, 50.0, 20.0), get_run(3, 100.0, 10.0), get_run(2, 5.0, 1.0, incremental=True)]
+    runs += [get_run(1, 110.0, 10.0), get_run(0, 90.0, 12.0)]
+    monkeypatch.setattr(pipeline.strixpipeline.runhistory, "get_runs", lambda index, size: runs)
+    comparison = pipeline.compare_runs("test", num_runs=5, threshold=0.2)
+    assert comparison["timestamp"] == 4
+    assert comparison["earlier"] == 3
+    assert comparison["regressions"] == ["tokens_per_s"]
+    rows = {row["name"]: row for row in comparison["rows"]}
+    assert rows["tokens_per_s"]["value"] == 50.0
+    assert rows["tokens_per_s"]["baseline"] == 100.0
+    assert rows["parse"]["value"] == pytest.approx(20000.0)
+    assert rows["parse"]["baseline"] == pytest.approx(10000.0)
+    assert rows["parse"]["unit"] == "µs/token"
+    assert capsys.readouterr().out == ""
+
+    monkeypatch.setattr(pipeline.strixpipeline.runhistory, "get_runs", lambda index, size: [])
+    assert pipeline.compare_runs("test") is None
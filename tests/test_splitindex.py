@@ -0,0 +1,208 @@
+"""
+Documents parsed from the ranges of a split file must be the same as when the whole file is parsed.
+"""
+
+import json
+import os
+
+import pytest
+
+from strixpipeline import splitindex, xmlparser
+
+BACKENDS = ["etree", "expat"]
+try:
+    import lxml  # noqa: F401
+
+    BACKENDS.append("lxml")
+except ImportError:
+    pass
+
+
+def get_text(doc_id, words, **attrs):
+    attrs = "".join(f' {name}="{value}"' for name, value in attrs.items())
+    tokens = "".join(f'<token pos="NN" _tail="\\s">{word}</token>\n' for word in words)
+    return f'<text _id="{doc_id}"{attrs}>\n<sentence id="s-{doc_id}">\n{tokens}</sentence>\n</text>\n'
+
+
+# nested text_tags, where the second book only gives some of the attributes, a self-closing split element and
+# documents outside of any book
+NESTED = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n<corpus id="test">\n'
+    '<book title="Första" year="1900">\n'
+    + get_text("t1", ["en", "två"], title="Ett")
+    + get_text("t2", ["tre"], title="Två")
+    + '<text _id="t3" title="Tom"/>\n'
+    + "</book>\n"
+    + '<book title="Andra">\n<part>\n'
+    + get_text("t4", ["fyra", "fem"], title="Fyra")
+    + get_text("t5", ["sex"], title="Fem")
+    + "</part>\n</book>\n"
+    + get_text("t6", ["sju"], title="Sex")
+    + "</corpus>\n"
+)
+
+
+@pytest.fixture(scope="module")
+def book_plan():
+    return xmlparser.ParsePlan(
+        "text",
+        {"token": [{"name": "pos"}]},
+        struct_annotations={"sentence": [{"name": "id"}]},
+        text_attributes={"_id": {}, "title": {}, "book_title": {}, "book_year": {}},
+        token_count_id=True,
+        text_tags=["book", "text"],
+    )
+
+
+@pytest.fixture
+def nested_file(tmp_path):
+    path = tmp_path / "nested.xml"
+    path.write_text(NESTED, encoding="utf-8")
+    return str(path)
+
+
+def parse_ranges(file_name, index, ranges, plan, backend):
+    documents = []
+    for start, end, start_context, end_context in ranges:
+        prefix = index["contexts"][start_context][0].encode("latin-1")
+        suffix = index["contexts"][end_context][1].encode("latin-1")
+        source = xmlparser.RangeReader(file_name, start, end, prefix, suffix)
+        documents += xmlparser.parse_with_plan(source, plan, backend=backend)
+    return documents
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_nested_text_tags(backend, book_plan, nested_file, get_documents):
+    expected = get_documents(xmlparser.parse_with_plan(nested_file, book_plan, backend=backend))
+    index = xmlparser.scan_split_elements(nested_file, "text", ["book", "text"])
+    assert len(index["elements"]) == 6
+    # each document in a range of its own
+    ranges = [[start, end, context, context] for start, end, context in index["elements"]]
+    documents = get_documents(parse_ranges(nested_file, index, ranges, book_plan, backend))
+    assert documents == expected
+
+    attributes = {document["text_attributes"]["_id"]: document["text_attributes"] for document in documents}
+    assert attributes["t3"]["book_title"] == "Första"
+    assert attributes["t4"]["book_title"] == "Andra"
+    assert attributes["t4"]["book_year"] == "1900"
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_generated_corpus(backend, parse_plan, sparv_file, get_documents):
+    expected = get_documents(xmlparser.parse_with_plan(sparv_file, parse_plan, backend=backend))
+    index = xmlparser.scan_split_elements(sparv_file, parse_plan.split_document, parse_plan.text_tags)
+    ranges = splitindex.get_ranges(index, os.path.getsize(sparv_file) // 4)
+    assert 1 < len(ranges) < len(index["elements"])
+    documents = get_documents(parse_ranges(sparv_file, index, ranges, parse_plan, backend))
+    assert documents == expected
+
+
+def test_get_ranges():
+    index = {"elements": [[0, 10, 0], [10, 20, 0], [25, 30, 1], [30, 40, 1], [40, 50, 1], [50, 55, 2]]}
+    assert splitindex.get_ranges(index, 20) == [[0, 20, 0, 0], [25, 40, 1, 1], [40, 55, 1, 2]]
+
+
+# texts in wrappers that are not text_tags, also a self-closing one between the texts and a wrapper with attributes
+# that the documents do not get
+PAGES = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n<corpus id="test">\n<book title="Första" year="1900">\n'
+    + '<page n="1">\n'
+    + get_text("t1", ["en", "två"], title="Ett")
+    + '</page>\n<page n="2">\n<figure/>\n'
+    + get_text("t2", ["tre"], title="Två")
+    + get_text("t3", ["fyra"], title="Tre")
+    + "</page>\n</book>\n<appendix>\n<page>\n"
+    + get_text("t4", ["fem"], title="Fyra")
+    + "</page>\n</appendix>\n</corpus>\n"
+)
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+@pytest.mark.parametrize("range_bytes", [1, 250, 10_000])
+def test_ranges_across_wrappers(backend, range_bytes, book_plan, tmp_path, get_documents):
+    path = tmp_path / "pages.xml"
+    path.write_text(PAGES, encoding="utf-8")
+    expected = get_documents(xmlparser.parse_with_plan(str(path), book_plan, backend=backend))
+    index = xmlparser.scan_split_elements(str(path), "text", ["book", "text"])
+    assert len(index["elements"]) == 4
+    assert '<page n="2">' in index["contexts"][index["elements"][1][2]][0]
+    ranges = splitindex.get_ranges(index, range_bytes)
+    documents = get_documents(parse_ranges(str(path), index, ranges, book_plan, backend))
+    assert documents == expected
+    assert documents[3]["text_attributes"]["book_title"] == "Första"
+
+
+def test_unclosed_element(tmp_path):
+    path = tmp_path / "unclosed.xml"
+    path.write_text('<corpus>\n<text _id="t1">\n<token>x</token>\n</corpus>\n', encoding="utf-8")
+    with pytest.raises(ValueError, match="not closed"):
+        xmlparser.scan_split_elements(str(path), "text")
+
+
+def test_split_tasks(book_plan, nested_file, get_documents, config_attrs, tmp_path):
+    config_attrs(split_file_bytes=1, split_range_bytes=1, split_index_dir=str(tmp_path / "split_indexes"))
+    task = {"text": nested_file}
+    size = os.path.getsize(nested_file)
+    tasks = splitindex.split_tasks("test", [("text", "nested", size, task)], "text", ["book", "text"])
+    assert [task_id for _, task_id, _, _ in tasks] == [f"nested#{n}" for n in range(6)]
+    assert all(task["file_id"] == "nested" for _, _, _, task in tasks)
+    assert [task["range"]["first_document"] for _, _, _, task in tasks] == list(range(6))
+
+    documents = []
+    for _, _, _, task in tasks:
+        text_range = task["range"]
+        source = xmlparser.RangeReader(
+            task["text"], text_range["start"], text_range["end"], text_range["prefix"], text_range["suffix"]
+        )
+        documents += xmlparser.parse_with_plan(source, book_plan)
+    expected = get_documents(xmlparser.parse_with_plan(nested_file, book_plan))
+    assert get_documents(documents) == expected
+
+
+def test_split_index_is_reused(nested_file, config_attrs, tmp_path):
+    config_attrs(split_index_dir=str(tmp_path / "split_indexes"))
+    index = splitindex.get_split_index("test", "nested", nested_file, "text", {"book", "text"})
+    with open(splitindex.get_index_path("test", "nested")) as fp:
+        assert json.load(fp) == index
+    assert splitindex.get_split_index("test", "nested", nested_file, "text", {"text", "book"}) == index
+
+    # the contexts depend on text_tags
+    rescanned = splitindex.get_split_index("test", "nested", nested_file, "text", {"text"})
+    assert rescanned["text_tags"] == ["text"]
+    assert rescanned["contexts"] != index["contexts"]
+
+
+def test_range_reader_is_closed(corpus_conf, sparv_file, config_attrs, tmp_path, monkeypatch):
+    import strixpipeline.insertdata as insertdata
+
+    config_attrs(split_file_bytes=1, split_range_bytes=1, split_index_dir=str(tmp_path / "split_indexes"))
+    insert_data = insertdata.InsertData("test")
+    plan = insert_data.parse_plan
+    size = os.path.getsize(sparv_file)
+    tasks = splitindex.split_tasks(
+        "test", [("text", "generated", size, {"text": sparv_file})], plan.split_document, plan.text_tags
+    )
+
+    readers = []
+
+    class RangeReader(xmlparser.RangeReader):
+        def __init__(self, *args):
+            super().__init__(*args)
+            readers.append(self)
+
+    class VectorFile:
+        def __init__(self, *args, **kwargs):
+            pass
+
+        def get(self, doc_id):
+            return None
+
+    monkeypatch.setattr(xmlparser, "RangeReader", RangeReader)
+    monkeypatch.setattr(insertdata.vectorstore, "VectorFile", VectorFile)
+    # parsed to the end, and stopped after the first action
+    list(insert_data.process_work(tasks[0][1], tasks[0][3]))
+    actions = insert_data.process_work(tasks[1][1], tasks[1][3])
+    next(actions)
+    actions.close()
+    assert len(readers) == 2
+    assert all(reader.closed for reader in readers)
@@ -0,0 +1,93 @@
+"""
+The vector store, and the PCA with vectors from vectorgen
+"""
+
+import json
+import os
+
+import numpy as np
+import pytest
+
+from strixpipeline import vectorgen, vectorstore
+from strixpipeline.config import config
+
+CORPUS_ID = "test"
+
+
+@pytest.fixture
+def texts(corpus_conf, config_attrs, tmp_path):
+    """
+    texts/<task_id>.jsonl for two files, as written by the text extraction
+    """
+    config_attrs(transformers_postprocess_dir=str(tmp_path / "transformers"), vector_generator="hashing")
+    texts_dir = os.path.join(config.transformers_postprocess_dir, CORPUS_ID, "texts")
+    os.makedirs(texts_dir)
+    words = ["ett", "två", "tre", "fyra", "fem", "sex", "sju", "åtta"]
+    for task_id in ("file1", "file2"):
+        with open(os.path.join(texts_dir, f"{task_id}.jsonl"), "w") as fp:
+            for i in range(10):
+                text = " ".join(words[(i + j) % len(words)] for j in range(i % 5 + 1)) + f" {task_id}"
+                fp.write(json.dumps([f"{task_id}-{i}", text]) + "\n")
+    return ["file1", "file2"]
+
+
+def write_jsonl(jsonl_path, rows):
+    os.makedirs(os.path.dirname(jsonl_path), exist_ok=True)
+    with open(jsonl_path, "w") as fp:
+        for doc_id, vector in rows:
+            fp.write(json.dumps([doc_id, vector]) + "\n")
+
+
+def test_import_round_trip(config_attrs, tmp_path):
+    config_attrs(transformers_postprocess_dir=str(tmp_path / "transformers"))
+    jsonl_path, npy_path, ids_path = vectorstore.get_paths(CORPUS_ID, "file1")
+    write_jsonl(jsonl_path, [("a", [0.5, 1.0, -2.0]), ("b", [3.0, 0.0, 0.25])])
+    assert vectorstore.needs_import(jsonl_path, npy_path)
+
+    vectors = vectorstore.VectorFile(CORPUS_ID, "file1")
+    assert isinstance(np.load(npy_path, mmap_mode="r"), np.memmap)
+    assert vectors.matrix.dtype == np.float32
+    with open(ids_path) as fp:
+        assert json.load(fp) == ["a", "b"]
+    assert vectors.get("b").tolist() == [3.0, 0.0, 0.25]
+    assert type(vectors.get("a")) is np.ndarray
+    with pytest.raises(KeyError):
+        vectors.get("missing")
+    assert not vectorstore.needs_import(jsonl_path, npy_path)
+    assert not any(name.endswith(".tmp") for name in os.listdir(vectorstore.get_vectors_dir(CORPUS_ID)))
+
+    # new vectors are imported again
+    write_jsonl(jsonl_path, [("a", [1.0, 1.0, 1.0]), ("c", [2.0, 2.0, 2.0])])
+    mtime = os.path.getmtime(npy_path) + 10
+    os.utime(jsonl_path, (mtime, mtime))
+    assert vectorstore.needs_import(jsonl_path, npy_path)
+    vectors = vectorstore.VectorFile(CORPUS_ID, "file1")
+    assert vectors.get("c").tolist() == [2.0, 2.0, 2.0]
+    assert "b" not in vectors.rows
+
+
+def test_fit_pca_on_generated_vectors(texts):
+    vectorgen.generate_vectors(CORPUS_ID, texts)
+    assert not any(name.endswith(".jsonl") for name in os.listdir(vectorstore.get_vectors_dir(CORPUS_ID)))
+
+    explained = vectorstore.fit_pca(CORPUS_ID, 4, texts)
+    assert 0 < explained <= 1
+    mean, components = vectorstore.load_pca(CORPUS_ID)
+    assert components.shape == (4, 768)
+
+    vectors = vectorstore.VectorFile(CORPUS_ID, "file1", pca=(mean, components))
+    assert vectors.get("file1-3").shape == (4,)
+    assert np.allclose(np.linalg.norm(components, axis=1), 1, atol=1e-5)
+
+
+def test_fit_pca_on_current_files(texts):
+    vectorgen.generate_vectors(CORPUS_ID, texts)
+    # vectors of a file that has been removed from the corpus
+    vectorstore.write_vectors(CORPUS_ID, "removed", [f"removed-{i}" for i in range(10)], np.full((10, 768), 100.0))
+
+    vectorstore.fit_pca(CORPUS_ID, 4, texts)
+    mean, _ = vectorstore.load_pca(CORPUS_ID)
+    assert np.abs(mean).max() < 1
+
+    with pytest.raises(RuntimeError, match="got 0"):
+        vectorstore.fit_pca(CORPUS_ID, 4, ["missing"])
@@ -0,0 +1,113 @@
+"""
+All parser backends must give the same documents as the default "etree" backend, and the same documents for the
+edge cases as the parser did before it was rewritten (tests/data/edge_cases_baseline.json).
+"""
+
+import json
+import os
+
+import pytest
+
+from strixpipeline import xmlparser
+
+TOKEN_ATTRS = 'msd="NN" lemma="|" lex="|" sense="|" ref="1" dephead="0" deprel="SS"'
+
+# comments, CDATA, entities in attributes and text, a token without _tail and an empty document
+EDGE_CASES = f"""<?xml version="1.0" encoding="UTF-8"?>
+<!-- generated by a test -->
+<corpus id="test">
+<text title="Tom &amp; Jerry &lt;1&gt; &quot;x&quot;" _id="edge1" datefrom="20200101" dateto="20201231" genre="|a&amp;b|">
+<!-- a comment in a document -->
+<paragraph>
+<sentence id="s1" _geocontext="|">
+<token pos="NN" {TOKEN_ATTRS} _tail="\\s">A&amp;B</token>
+<token pos="PM" {TOKEN_ATTRS}>&lt;x&gt;</token>
+<!-- a comment between tokens -->
+<token pos="NN" {TOKEN_ATTRS} _tail="\\n"><![CDATA[<cdata> & more]]></token>
+<ne name="Lund" type="LOC" ex="ENAMEX">
+<token pos="PM" {TOKEN_ATTRS} _tail="">Lund</token>
+</ne>
+</sentence>
+</paragraph>
+</text>
+<text title="Empty" _id="edge2" datefrom="20200101" dateto="20201231" genre="|">
+</text>
+<text title="Last" _id="edge3" datefrom="20200101" dateto="20201231" genre="|">
+<paragraph>
+<sentence id="s2" _geocontext="|Lund|">
+<token pos="NN" {TOKEN_ATTRS}>slut</token>
+</sentence>
+</paragraph>
+</text>
+</corpus>
+"""
+
+
+def get_backends():
+    backends = ["etree", "expat"]
+    try:
+        import lxml  # noqa: F401
+
+        backends.append("lxml")
+    except ImportError:
+        pass
+    return backends
+
+
+@pytest.fixture(scope="module")
+def edge_file(tmp_path_factory):
+    path = tmp_path_factory.mktemp("edge") / "edge.xml"
+    path.write_text(EDGE_CASES, encoding="utf-8")
+    return str(path)
+
+
+@pytest.mark.parametrize("backend", get_backends())
+def test_generated_corpus_parity(backend, parse_plan, sparv_file, get_documents):
+    expected = get_documents(xmlparser.parse_with_plan(sparv_file, parse_plan, backend="etree"))
+    documents = get_documents(xmlparser.parse_with_plan(sparv_file, parse_plan, backend=backend))
+    assert len(expected) == 20
+    assert documents == expected
+
+
+@pytest.mark.parametrize("backend", get_backends())
+def test_edge_case_parity(backend, parse_plan, edge_file, get_documents):
+    expected = get_documents(xmlparser.parse_with_plan(edge_file, parse_plan, backend="etree"))
+    documents = get_documents(xmlparser.parse_with_plan(edge_file, parse_plan, backend=backend))
+    assert [document["text_attributes"]["_id"] for document in expected] == ["edge1", "edge2", "edge3"]
+    assert documents == expected
+
+
+@pytest.mark.parametrize("backend", get_backends())
+def test_edge_cases_baseline(backend, parse_plan, edge_file, get_documents):
+    """
+    the expected documents were written by parse_pipeline_xml of the original StrixParser, compared as JSON since
+    that is how they are sent
+    """
+    with open(os.path.join(os.path.dirname(__file__), "data", "edge_cases_baseline.json"), encoding="utf-8") as fp:
+        expected = json.load(fp)
+    documents = get_documents(xmlparser.parse_with_plan(edge_file, parse_plan, backend=backend))
+    assert json.loads(json.dumps(documents)) == expected
+
+
+def test_edge_cases(parse_plan, edge_file, get_documents):
+    first, empty, last = get_documents(xmlparser.parse_with_plan(edge_file, parse_plan, backend="etree"))
+    assert first["text_attributes"]["title"] == 'Tom & Jerry <1> "x"'
+    words = [token["word"] for token in first["token_lookup"]]
+    assert words == ["A&B", "<x>", "<cdata> & more", "Lund"]
+    assert empty["word_count"] == 0
+    assert last["word_count"] == 1
+
+
+@pytest.mark.parametrize("backend", get_backends())
+def test_dump_parity(backend, parse_plan, sparv_file):
+    expected = list(xmlparser.parse_with_plan(sparv_file, parse_plan, backend="etree", dump_only=True))
+    documents = list(xmlparser.parse_with_plan(sparv_file, parse_plan, backend=backend, dump_only=True))
+    assert documents == expected
+
+
+@pytest.mark.parametrize("backend", get_backends())
+def test_dump_without_text_tags(backend, sparv_file):
+    expected = list(xmlparser.parse_dump_xml(sparv_file, "text", {"_id": {}}, text_tags=["text"], backend=backend))
+    documents = list(xmlparser.parse_dump_xml(sparv_file, "text", {"_id": {}}, backend=backend))
+    assert [document["text_attributes"]["_id"] for document in documents] == [f"text{i}" for i in range(20)]
+    assert documents == expected